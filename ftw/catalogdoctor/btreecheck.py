@@ -0,0 +1,235 @@
+from BTrees.check import Checker
+from BTrees.Interfaces import IBTree
+from BTrees.Interfaces import ITreeSet
+from ftw.catalogdoctor.sharding import _init_worker
+from ftw.catalogdoctor.sharding import _run_in_worker
+from ftw.catalogdoctor.sharding import open_readonly_database
+from ftw.catalogdoctor.utils import get_tree_depth
+from persistent import Persistent
+from plone import api
+import multiprocessing
+
+
+# persistent objects referenced by an index, e.g. the text index and the
+# lexicon of a `ZCTextIndex`, are searched for BTrees up to this depth.
+MAX_NESTING = 2
+
+
+def is_btree(obj):
+    return IBTree.providedBy(obj) or ITreeSet.providedBy(obj)
+
+
+def find_trees(obj, attributes=(), nesting=MAX_NESTING):
+    """Find the BTrees stored in the attributes of a persistent object.
+
+    Yield the attribute path of each BTree as tuple of attribute names.
+    Volatile attributes are skipped.
+    """
+    obj._p_activate()
+    for name, value in sorted(vars(obj).items()):
+        if name.startswith('_v_'):
+            continue
+        if is_btree(value):
+            yield attributes + (name,)
+        elif nesting and isinstance(value, Persistent):
+            for path in find_trees(
+                    value, attributes + (name,), nesting - 1):
+                yield path
+
+
+class TreeLocation(object):
+    """Locate a BTree of the catalog or of one of its indexes.
+
+    Locations are passed to worker processes, which resolve them in their
+    own database connection.
+    """
+    def __init__(self, index_name, attributes):
+        self.index_name = index_name
+        self.attributes = attributes
+
+    @property
+    def name(self):
+        if self.index_name is None:
+            return '.'.join(self.attributes)
+        return '.'.join(('indexes', self.index_name) + self.attributes)
+
+    def resolve(self, catalog):
+        obj = catalog
+        if self.index_name is not None:
+            obj = catalog.indexes[self.index_name]
+        for name in self.attributes:
+            obj = getattr(obj, name)
+        return obj
+
+
+class TreeChecker(Checker):
+    """Check the value-based invariants of a BTree and count its buckets.
+
+    Errors are collected instead of raised.
+    """
+    def __init__(self, obj):
+        Checker.__init__(self, obj)
+        self.buckets = 0
+        self.length = 0
+
+    def visit_bucket(self, obj, path, parent, is_mapping,
+                     keys, values, lo, hi):
+        Checker.visit_bucket(
+            self, obj, path, parent, is_mapping, keys, values, lo, hi)
+        self.buckets += 1
+        self.length += len(keys)
+
+
+def check_tree(portal_catalog, location):
+    """Check the structure of the BTree at location.
+
+    `BTree._check` verifies the C-level pointers, i.e. the chain of buckets
+    linked by `_next`. `TreeChecker` verifies that keys are sorted and lie
+    within the bounds given by the inner nodes.
+    """
+    catalog = portal_catalog._catalog
+    tree = location.resolve(catalog)
+    result = TreeCheckResult(location.name)
+
+    try:
+        tree._check()
+    except AssertionError as exc:
+        result.errors.append(str(exc))
+
+    checker = TreeChecker(tree)
+    checker.walk()
+    result.errors.extend(checker.errors)
+    result.buckets = checker.buckets
+    result.length = checker.length
+    result.depth = get_tree_depth(tree)
+
+    # deactivate the buckets loaded by the check
+    connection = catalog._p_jar
+    if connection is not None:
+        connection.cacheGC()
+        connection.cacheMinimize()
+    return result
+
+
+class BTreeCheck(object):
+    """Check the structural integrity of the catalog's BTrees.
+
+    Damaged BTrees, e.g. with buckets containing keys out of order or a
+    broken chain of buckets, make lookups and iteration return wrong results.
+    This looks like inconsistent catalog data to the health check but can't
+    be fixed by surgery.
+
+    The BTrees `uids`, `paths` and `data` of the catalog as well as all
+    BTrees stored in the attributes of indexes are checked, BTrees nested in
+    the values of other BTrees are not. With more than one process the
+    BTrees are checked in parallel by worker processes, each with its own
+    database connection pinned to the latest committed transaction. Each
+    BTree is reported to the formatter as soon as
+    it has been checked.
+    """
+    def __init__(self, catalog=None, processes=1, formatter=None,
+                 open_database=open_readonly_database):
+        self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
+        self.catalog = self.portal_catalog._catalog
+        self.processes = processes
+        self.formatter = formatter
+        self.open_database = open_database
+
+    def get_locations(self):
+        locations = [TreeLocation(None, (name,))
+                     for name in ('uids', 'paths', 'data')]
+
+        # lexicons are shared by several indexes, check them once
+        seen = set()
+        for index_name, index in sorted(self.catalog.indexes.items()):
+            for attributes in find_trees(index):
+                location = TreeLocation(index_name, attributes)
+                tree = location.resolve(self.catalog)
+                if id(tree) in seen:
+                    continue
+                seen.add(id(tree))
+                locations.append(location)
+        return locations
+
+    def iter_results(self, locations):
+        if self.processes <= 1:
+            for location in locations:
+                yield check_tree(self.portal_catalog, location)
+            return
+
+        catalog_path = '/'.join(self.portal_catalog.getPhysicalPath())
+        tid = self.portal_catalog._p_jar.db().storage.lastTransaction()
+        pool = multiprocessing.Pool(
+            self.processes, initializer=_init_worker,
+            initargs=(catalog_path, self.open_database, tid))
+        try:
+            tasks = [(check_tree, location, ()) for location in locations]
+            for tree_result in pool.imap_unordered(_run_in_worker, tasks):
+                yield tree_result
+        finally:
+            pool.close()
+            pool.join()
+
+    def run(self):
+        result = BTreeCheckResult()
+        for tree_result in self.iter_results(self.get_locations()):
+            result.add_tree_result(tree_result)
+            if self.formatter:
+                tree_result.write_result(self.formatter)
+        return result
+
+
+class TreeCheckResult(object):
+    """Provide the result of checking one BTree."""
+
+    def __init__(self, name):
+        self.name = name
+        self.length = 0
+        self.buckets = 0
+        self.depth = 0
+        self.errors = []
+
+    def is_healthy(self):
+        return not self.errors
+
+    def write_result(self, formatter):
+        formatter.info(
+            " {}: {} keys in {} buckets, depth {}{}".format(
+                self.name, self.length, self.buckets, self.depth,
+                '' if self.is_healthy() else ', damaged'))
+
+
+class BTreeCheckResult(object):
+    """Provide the result of one BTree check run."""
+
+    def __init__(self):
+        self.tree_results = []
+
+    def add_tree_result(self, tree_result):
+        self.tree_results.append(tree_result)
+
+    def get_damaged_trees(self):
+        return sorted(
+            (tree_result for tree_result in self.tree_results
+             if not tree_result.is_healthy()),
+            key=lambda tree_result: tree_result.name)
+
+    def is_healthy(self):
+        return not self.get_damaged_trees()
+
+    def write_result(self, formatter):
+        """Log result to logger."""
+
+        damaged = self.get_damaged_trees()
+        if not damaged:
+            formatter.info("All {} BTrees are structurally intact.".format(
+                len(self.tree_results)))
+            return
+
+        formatter.info("Found structural damage in {} of {} BTrees:".format(
+            len(damaged), len(self.tree_results)))
+        for tree_result in damaged:
+            formatter.info(" {}:".format(tree_result.name))
+            for error in tree_result.errors:
+                for line in error.splitlines():
+                    formatter.info('\t{}'.format(line))
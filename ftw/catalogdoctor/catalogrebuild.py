@@ -0,0 +1,610 @@
+from Acquisition import aq_base
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from BTrees.OOBTree import OOBTree
+from collections import deque
+from ftw.catalogdoctor.btreecheck import is_btree
+from ftw.catalogdoctor.exceptions import CantPerformSurgery
+from ftw.catalogdoctor.exceptions import TimeBudgetExceeded
+from ftw.catalogdoctor.incremental import find_changed_oids
+from ftw.catalogdoctor.incremental import iter_buckets
+from ftw.catalogdoctor.sharding import _init_worker
+from ftw.catalogdoctor.sharding import _run_in_worker
+from ftw.catalogdoctor.sharding import open_readonly_database
+from persistent import Persistent
+from persistent.mapping import PersistentMapping
+from plone import api
+from plone.indexer.interfaces import IIndexableObject
+from Products.CMFCore.interfaces import ICatalogAware
+from Products.PluginIndexes.util import safe_callable
+from Products.ZCTextIndex.ZCTextIndex import ZCTextIndex
+from ZODB.POSException import ConflictError
+from zope.component import queryMultiAdapter
+from zope.component.hooks import setSite
+import copy
+import multiprocessing
+import time
+import transaction
+
+
+# the state of an unfinished rebuild is stored in this attribute of
+# portal_catalog, it only contains persistent objects from ZODB and ZCatalog.
+STATE_ATTRIBUTE = '_catalogdoctor_rebuild'
+STATE_VERSION = 2
+
+
+def get_source_names(catalog):
+    """Return the names of the object attributes read by the indexes and the
+    metadata columns of catalog.
+    """
+    names = set(catalog.names)
+    # path indexes fall back to the physical path
+    names.add('getPhysicalPath')
+    for index in catalog.indexes.values():
+        names.add(index.getId())
+        get_index_source_names = getattr(index, 'getIndexSourceNames', None)
+        if get_index_source_names is not None:
+            names.update(get_index_source_names())
+        # date range and recurring date indexes read additional attributes
+        for getter_name in ('getSinceField', 'getUntilField'):
+            getter = getattr(index, getter_name, None)
+            if getter is not None:
+                names.add(getter())
+        names.add(getattr(index, 'attr_recurdef', None))
+
+    names.discard(None)
+    names.discard('')
+    return sorted(names)
+
+
+def get_rid_keyed_trees(catalog):
+    """Return the rid-keyed BTrees changed when an object is cataloged."""
+
+    trees = [catalog.paths, catalog.data]
+    for name, index in sorted(catalog.indexes.items()):
+        trees.append(getattr(index, '_unindex', None))
+        if isinstance(index, ZCTextIndex):
+            trees.append(index.index._docwords)
+    return [tree for tree in trees if is_btree(tree)]
+
+
+def compute_values(obj, portal_catalog, names):
+    """Return the values of the attributes named names of the indexable
+    wrapper of obj.
+
+    Attributes are called like indexes do it, missing attributes are
+    omitted.
+    """
+    wrapper = obj
+    if not IIndexableObject.providedBy(obj):
+        wrapper = queryMultiAdapter((obj, portal_catalog), IIndexableObject)
+        if wrapper is None:
+            wrapper = obj
+
+    values = {}
+    for name in names:
+        try:
+            value = getattr(wrapper, name)
+            if safe_callable(value):
+                value = value()
+        except (AttributeError, TypeError):
+            continue
+        values[name] = value
+    return values
+
+
+def compute_chunk(portal_catalog, paths, names, sync):
+    """Compute the values to catalog for each path of a chunk.
+
+    Return `(path, values, error)` tuples. `values` is `None` when there is
+    no catalog aware object at path. Errors raised while computing values
+    are returned as `error`. With `sync` the latest committed state of the
+    database is loaded first, as done by worker processes.
+    """
+    if sync:
+        transaction.abort()
+
+    portal = aq_parent(aq_inner(portal_catalog))
+    setSite(portal)
+    results = []
+    for path in paths:
+        try:
+            obj = portal.unrestrictedTraverse(path, None)
+            # make sure traversal did not acquire an object from elsewhere
+            if (obj is None or not ICatalogAware.providedBy(obj)
+                    or '/'.join(obj.getPhysicalPath()) != path):
+                results.append((path, None, None))
+            else:
+                results.append(
+                    (path, compute_values(obj, portal_catalog, names), None))
+        except ConflictError:
+            raise
+        except Exception as exc:
+            results.append(
+                (path, None, '{}: {}'.format(type(exc).__name__, exc)))
+
+    connection = portal_catalog._p_jar
+    if connection is not None:
+        connection.cacheGC()
+    return results
+
+
+class IndexableValues(object):
+    """Provide precomputed values to the indexes and the metadata columns
+    of a catalog.
+
+    Values are returned as callables, indexes call them like the methods of
+    the original object, e.g. `getPhysicalPath`. Missing values raise an
+    `AttributeError`.
+    """
+    def __init__(self, values):
+        self._values = values
+
+    def __getattr__(self, name):
+        try:
+            value = self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+        if value is None:
+            return None
+        return lambda: value
+
+
+class CatalogRebuild(object):
+    """Rebuild the catalog from content into a fresh catalog.
+
+    The content tree is walked in order of physical paths, as by
+    `clearFindAndRebuild` objects providing `ICatalogAware` are cataloged.
+    The paths are grouped into chunks. The values read by the indexes and
+    the metadata columns are computed for each chunk by worker processes,
+    each with its own read-only database connection. Only applying the
+    computed values to the fresh catalog is serialized, it happens in the
+    current process and each chunk is committed separately.
+
+    The fresh catalog is stored together with the progress in an attribute
+    of portal_catalog, an interrupted rebuild is resumed after the last
+    committed chunk. Meanwhile the live catalog remains in use. Once all
+    content has been cataloged, objects whose catalog entries changed since
+    the rebuild has been started are cataloged again. The changes are found
+    in the transactions committed since, the storage must support iteration
+    and must not be packed meanwhile. Then the fresh catalog replaces the
+    live catalog and the changes committed to the live catalog in between
+    are applied to the new catalog.
+
+    Objects that can't be cataloged are remembered in the progress and
+    retried before the swap and before the rebuild is finished. As long as
+    any of them fail the rebuild is not continued, objects must not go
+    missing from the live catalog silently.
+    """
+    default_chunk_size = 1000
+    max_attempts = 3
+    max_catch_up_rounds = 3
+    # chunks computed in advance per worker process
+    chunks_per_process = 2
+
+    def __init__(self, catalog=None, processes=1, chunk_size=None,
+                 time_budget=None, restart=False, formatter=None,
+                 open_database=open_readonly_database):
+        self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
+        self.processes = processes
+        self.chunk_size = chunk_size or self.default_chunk_size
+        self.time_budget = time_budget
+        self.restart = restart
+        self.formatter = formatter
+        self.open_database = open_database
+        self.pool = None
+        self.deadline = None
+        self.state = None
+        self.result = None
+        self.names = None
+
+    @property
+    def catalog(self):
+        return self.portal_catalog._catalog
+
+    @property
+    def storage(self):
+        return self.portal_catalog._p_jar.db().storage
+
+    def info(self, msg):
+        if self.formatter:
+            self.formatter.info(msg)
+
+    def run(self):
+        self.result = CatalogRebuildResult()
+        if self.time_budget is not None:
+            self.deadline = time.time() + self.time_budget
+
+        self.state = self.load_state()
+        if self.state is None:
+            self.state = self.create_state()
+        else:
+            self.info('Resuming rebuild of catalog.')
+
+        self.names = get_source_names(self.catalog)
+        try:
+            if self.state['phase'] == 'walk':
+                self.walk()
+                self.state['phase'] = 'catch-up'
+                transaction.commit()
+
+            if self.state['phase'] == 'catch-up':
+                for catch_up_round in range(self.max_catch_up_rounds):
+                    changed = self.catch_up(
+                        self.catalog, self.get_new_catalog())
+                    if changed <= self.chunk_size:
+                        break
+                if not self.retry_failed(self.get_new_catalog()):
+                    return self.result
+                self.swap()
+
+            # apply changes committed to the previous catalog until the swap
+            self.catch_up(self.state['catalog'], self.catalog)
+            if not self.retry_failed(self.catalog):
+                return self.result
+            self.finish()
+        except TimeBudgetExceeded:
+            self.result.interrupted = True
+        finally:
+            self.report_failed()
+
+        return self.result
+
+    def load_state(self):
+        state = getattr(aq_base(self.portal_catalog), STATE_ATTRIBUTE, None)
+        if state is None:
+            return None
+
+        if self.restart or state.get('version') != STATE_VERSION:
+            delattr(self.portal_catalog, STATE_ATTRIBUTE)
+            transaction.commit()
+            return None
+        return state
+
+    def create_state(self):
+        # fail early, changes can't be caught up without iteration
+        if not hasattr(self.storage, 'iterator'):
+            raise CantPerformSurgery(
+                'The storage does not support iteration.')
+
+        # the live catalog may be changed from now on, changes committed
+        # after this tid are caught up.
+        tid = self.storage.lastTransaction()
+        transaction.abort()
+
+        state = PersistentMapping()
+        state['version'] = STATE_VERSION
+        state['tid'] = tid
+        state['phase'] = 'walk'
+        state['last_path'] = None
+        # path -> error of the objects that could not be cataloged
+        state['failed'] = OOBTree()
+        state['catalog'] = self.create_catalog()
+        setattr(self.portal_catalog, STATE_ATTRIBUTE, state)
+        transaction.commit()
+        self.info('Started rebuild of catalog.')
+        return state
+
+    def create_catalog(self):
+        """Return an empty catalog with the indexes and metadata columns of
+        the live catalog.
+
+        Indexes are copied and cleared, clearing replaces all persistent
+        data of the copy.
+        """
+        catalog = type(aq_base(self.catalog))()
+        catalog.schema = dict(self.catalog.schema)
+        catalog.names = tuple(self.catalog.names)
+        catalog.updateBrains()
+
+        indexes = {}
+        for name, index in self.catalog.indexes.items():
+            empty = copy.copy(aq_base(index))
+            if getattr(empty, '_counter', None) is not None:
+                # don't invalidate the query cache of the live index
+                empty._counter = None
+            indexes[name] = empty
+        catalog.indexes = indexes
+
+        # indexes acquire e.g. their lexicon from portal_catalog
+        wrapped = catalog.__of__(self.portal_catalog)
+        for name, index in sorted(self.catalog.indexes.items()):
+            empty = wrapped.getIndex(name)
+            clear = getattr(empty, 'clear', None)
+            if clear is not None:
+                clear()
+
+            for attribute, value in vars(aq_base(empty)).items():
+                if attribute.startswith('_v_'):
+                    continue  # e.g. the lexicon cached by a ZCTextIndex
+                if (isinstance(value, Persistent)
+                        and value is vars(index).get(attribute)):
+                    raise CantPerformSurgery(
+                        'Index {} of type {} shares {} with the live '
+                        'index.'.format(name, type(index).__name__,
+                                        attribute))
+        return catalog
+
+    def get_new_catalog(self):
+        return self.state['catalog'].__of__(self.portal_catalog)
+
+    def walk(self):
+        after = self.state['last_path']
+        if after is not None:
+            after = tuple(after.split('/'))
+
+        portal = aq_parent(aq_inner(self.portal_catalog))
+        paths = ('/'.join(path) for path in self.iter_paths(portal, after))
+        self.process(paths, self.get_new_catalog(), track_last_path=True)
+
+    def iter_paths(self, container, after=None):
+        """Yield the physical paths of the catalog aware objects below
+        container in sorted order.
+
+        With `after` only paths sorting after it are yielded, subtrees
+        completely before it are skipped.
+        """
+        for object_id in sorted(container.objectIds()):
+            obj = container._getOb(object_id, None)
+            if obj is None:
+                continue
+
+            path = obj.getPhysicalPath()
+            if after is not None and path <= after:
+                if after[:len(path)] != path:
+                    continue
+            elif ICatalogAware.providedBy(obj):
+                yield path
+
+            if safe_callable(getattr(aq_base(obj), 'objectIds', None)):
+                for subpath in self.iter_paths(obj, after):
+                    yield subpath
+
+    def iter_chunks(self, paths):
+        chunk = []
+        for path in paths:
+            chunk.append(path)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def submit(self, chunk):
+        """Start computing the values of a chunk, return a callable
+        returning them.
+        """
+        if self.pool is None:
+            return lambda: compute_chunk(
+                self.portal_catalog, chunk, self.names, False)
+
+        async_result = self.pool.apply_async(
+            _run_in_worker, ((compute_chunk, chunk, (self.names, True)),))
+        return async_result.get
+
+    def start_pool(self):
+        """Start worker processes, they open the database anew.
+
+        A read-only storage opened by a worker may not see transactions
+        committed later, each phase of the rebuild uses its own workers.
+        """
+        if self.processes <= 1:
+            return
+
+        catalog_path = '/'.join(self.portal_catalog.getPhysicalPath())
+        self.pool = multiprocessing.Pool(
+            self.processes, initializer=_init_worker,
+            initargs=(catalog_path, self.open_database))
+
+    def stop_pool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def process(self, paths, target, track_last_path=False):
+        """Catalog the objects at paths into target chunk by chunk.
+
+        Workers compute a few chunks in advance. They are fed from the
+        current process, the database connection is only used by it.
+        """
+        window = self.processes * self.chunks_per_process
+        pending = deque()
+        self.start_pool()
+        try:
+            for chunk in self.iter_chunks(paths):
+                pending.append((chunk, self.submit(chunk)))
+                if len(pending) >= window:
+                    chunk, get_results = pending.popleft()
+                    self.apply_chunk(
+                        chunk, get_results(), target, track_last_path)
+
+            while pending:
+                chunk, get_results = pending.popleft()
+                self.apply_chunk(
+                    chunk, get_results(), target, track_last_path)
+        finally:
+            self.stop_pool()
+
+    def apply_chunk(self, chunk, results, target, track_last_path):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                counts = self.apply_results(results, target)
+                if track_last_path:
+                    self.state['last_path'] = chunk[-1]
+                transaction.commit()
+                break
+            except ConflictError:
+                transaction.abort()
+                if attempt == self.max_attempts:
+                    raise
+
+        self.result.report_chunk(*counts)
+        self.info(' Cataloged {} objects, at {}'.format(
+            self.result.cataloged, chunk[-1]))
+        self.free_cache()
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise TimeBudgetExceeded()
+
+    def apply_results(self, results, target):
+        cataloged = uncataloged = 0
+        failed = self.state['failed']
+        for path, values, error in results:
+            if error is not None:
+                failed[path] = error
+                continue
+
+            if path in failed:
+                del failed[path]
+            if values is not None:
+                target.catalogObject(IndexableValues(values), path)
+                cataloged += 1
+            elif path in target.uids:
+                target.uncatalogObject(path)
+                uncataloged += 1
+        return cataloged, uncataloged
+
+    def retry_failed(self, target):
+        """Catalog the objects that could not be cataloged so far into
+        target again.
+
+        Return whether all of them could be cataloged.
+        """
+        failed = self.state['failed']
+        if not failed:
+            return True
+
+        self.info('Retrying {} objects that could not be cataloged.'.format(
+            len(failed)))
+        self.process(list(failed.keys()), target)
+        return not failed
+
+    def report_failed(self):
+        if self.state is not None:
+            self.result.failed = list(self.state['failed'].items())
+
+    def free_cache(self):
+        connection = self.portal_catalog._p_jar
+        if connection is not None:
+            connection.cacheGC()
+
+    def catch_up(self, source, target):
+        """Catalog the objects whose entries in the source catalog changed
+        since the tid of the state into target again.
+
+        Return the number of changed paths.
+        """
+        after = self.state['tid']
+        until = self.storage.lastTransaction()
+        transaction.abort()
+
+        paths = self.find_changed_paths(source, after, until)
+        self.info('Catching up with {} changed paths.'.format(len(paths)))
+        self.process(sorted(paths), target)
+        self.state['tid'] = until
+        transaction.commit()
+        return len(paths)
+
+    def find_changed_paths(self, source, after, until):
+        """Return the paths of the entries of the source catalog changed in
+        transactions after tid `after` up to tid `until`.
+
+        Only the changed buckets of the BTrees of the catalog are loaded, in
+        their state as of `after` and in their current state.
+        """
+        if after == until:
+            return set()
+
+        changed_oids = find_changed_oids(self.storage, after, until)
+        connection = self.portal_catalog._p_jar.db().open(at=after)
+        try:
+            previous = connection.get(source._p_oid)
+            catalogs = (previous, aq_base(source))
+
+            rids = set()
+            paths = set()
+            for catalog in catalogs:
+                for tree in get_rid_keyed_trees(catalog):
+                    for oid, bucket in iter_buckets(tree):
+                        if oid in changed_oids:
+                            rids.update(bucket.keys())
+                for oid, bucket in iter_buckets(catalog.uids):
+                    if oid in changed_oids:
+                        paths.update(bucket.keys())
+
+            for catalog in catalogs:
+                for rid in rids:
+                    path = catalog.paths.get(rid)
+                    if path is not None:
+                        paths.add(path)
+            return paths
+        finally:
+            connection.close()
+
+    def swap(self):
+        previous = aq_base(self.catalog)
+        self.portal_catalog._catalog = self.state['catalog']
+        self.state['catalog'] = previous
+        self.state['phase'] = 'swapped'
+        # invalidate cached query results
+        increment_counter = getattr(
+            self.portal_catalog, '_increment_counter', None)
+        if increment_counter is not None:
+            increment_counter()
+        transaction.commit()
+        self.result.swapped = True
+        self.info('Swapped in rebuilt catalog.')
+
+    def finish(self):
+        delattr(self.portal_catalog, STATE_ATTRIBUTE)
+        transaction.commit()
+        self.state = None
+        self.result.length = len(self.catalog)
+
+
+class CatalogRebuildResult(object):
+    """Provide the result of one catalog rebuild run."""
+
+    def __init__(self, sample_size=10):
+        self.sample_size = sample_size
+        self.cataloged = 0
+        self.uncataloged = 0
+        # `(path, error)` tuples of the objects still failing
+        self.failed = []
+        self.interrupted = False
+        self.swapped = False
+        self.length = None
+
+    def report_chunk(self, cataloged, uncataloged):
+        self.cataloged += cataloged
+        self.uncataloged += uncataloged
+
+    def is_finished(self):
+        return self.length is not None
+
+    def write_result(self, formatter):
+        """Log result to logger."""
+
+        formatter.info('Cataloged {} objects, uncataloged {} objects.'.format(
+            self.cataloged, self.uncataloged))
+        if self.failed:
+            formatter.info('Could not catalog {} objects:'.format(
+                len(self.failed)))
+            for path, error in self.failed[:self.sample_size]:
+                formatter.info(' {}: {}'.format(path, error))
+            remaining = len(self.failed) - self.sample_size
+            if remaining > 0:
+                formatter.info(' ... and {} more'.format(remaining))
+
+        if self.is_finished():
+            formatter.info(
+                'Rebuild was successful, catalog length is {}.'.format(
+                    self.length))
+        elif self.failed and not self.interrupted:
+            formatter.info(
+                'Rebuild can not be finished while objects can not be '
+                'cataloged, fix them and run it again to resume.')
+        else:
+            formatter.info(
+                'Rebuild was interrupted, run it again to resume.')
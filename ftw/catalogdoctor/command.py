@@ -1,7 +1,21 @@
 from __future__ import print_function
+from ftw.catalogdoctor.btreecheck import BTreeCheck
+from ftw.catalogdoctor.catalogrebuild import CatalogRebuild
 from ftw.catalogdoctor.compat import processQueue
+from ftw.catalogdoctor.exceptions import CantPerformSurgery
 from ftw.catalogdoctor.healthcheck import CatalogHealthCheck
+from ftw.catalogdoctor.incremental import IncrementalHealthCheck
+from ftw.catalogdoctor.lengths import LengthRepair
+from ftw.catalogdoctor.rebuild import IndexRebuild
+from ftw.catalogdoctor.rebuild import MappingRebuild
+from ftw.catalogdoctor.report import AggregatedReport
+from ftw.catalogdoctor.resumable import ResumableHealthCheck
+from ftw.catalogdoctor.sampling import SamplingHealthCheck
+from ftw.catalogdoctor.scheduler import BatchedSurgery
 from ftw.catalogdoctor.scheduler import SurgeryScheduler
+from ftw.catalogdoctor.sharding import ShardedHealthCheck
+from ftw.catalogdoctor.sweep import IndexSweep
+from ftw.catalogdoctor.triage import CatalogTriage
 from Products.CMFCore.utils import getToolByName
 from Products.CMFPlone.interfaces import IPloneSiteRoot
 from zope.component.hooks import setSite
@@ -51,11 +65,77 @@ class ConsoleOutput(object):
 def healthcheck_command(portal_catalog, args, formatter):
     transaction.doom()  # extra paranoia, prevent erroneous commit
 
-    return _run_healthcheck(portal_catalog, formatter)
+    if args.sample:
+        sampling_result = SamplingHealthCheck(
+            catalog=portal_catalog, sample_size=args.sample).run()
+        sampling_result.write_result(formatter)
+        if sampling_result.is_healthy():
+            return sampling_result
+        formatter.info('')
+        formatter.info('Sample contains unhealthy rids, running full '
+                       'healthcheck:')
+
+    if args.cursor:
+        healthcheck = ResumableHealthCheck(
+            args.cursor, time_budget=args.time_budget,
+            catalog=portal_catalog, chunk_size=args.chunk_size)
+    elif args.checkpoint:
+        healthcheck = IncrementalHealthCheck(
+            args.checkpoint, catalog=portal_catalog,
+            healthcheck=_create_healthcheck(portal_catalog, args))
+    else:
+        healthcheck = _create_healthcheck(portal_catalog, args)
+
+    result = healthcheck.run()
+    if result is None:
+        formatter.info(
+            'Time budget exceeded, progress has been saved to {}. Run the '
+            'healthcheck again to continue.'.format(args.cursor))
+        return None
+
+    if args.aggregate or args.details_file:
+        AggregatedReport(
+            result, details_path=args.details_file).write_result(formatter)
+    else:
+        result.write_result(formatter)
+    return result
+
+
+def triage_command(portal_catalog, args, formatter):
+    transaction.doom()  # extra paranoia, prevent erroneous commit
+
+    result = CatalogTriage(catalog=portal_catalog).run()
+    result.write_result(formatter)
+    if not result.is_consistent():
+        sys.exit(1)
+    return result
 
 
-def _run_healthcheck(portal_catalog, formatter):
-    result = CatalogHealthCheck(catalog=portal_catalog).run()
+def btreecheck_command(portal_catalog, args, formatter):
+    transaction.doom()  # extra paranoia, prevent erroneous commit
+
+    formatter.info('Checking BTrees:')
+    result = BTreeCheck(
+        catalog=portal_catalog, processes=args.processes,
+        formatter=formatter).run()
+    result.write_result(formatter)
+    return result
+
+
+def _create_healthcheck(portal_catalog, args):
+    if args.processes > 1:
+        return ShardedHealthCheck(
+            catalog=portal_catalog, processes=args.processes,
+            chunk_size=args.chunk_size,
+            check_indexes=getattr(args, 'indexes', False))
+    return CatalogHealthCheck(
+        catalog=portal_catalog, chunk_size=args.chunk_size,
+        check_indexes=getattr(args, 'indexes', False))
+
+
+def _run_healthcheck(portal_catalog, args, formatter):
+    healthcheck = _create_healthcheck(portal_catalog, args)
+    result = healthcheck.run()
     result.write_result(formatter)
     return result
 
@@ -66,7 +146,10 @@ def surgery_command(portal_catalog, args, formatter):
         formatter.info('')
         transaction.doom()
 
-    result = _run_healthcheck(portal_catalog, formatter)
+    if args.batch_size:
+        return batched_surgery_command(portal_catalog, args, formatter)
+
+    result = _run_healthcheck(portal_catalog, args, formatter)
     if result.is_healthy():
         transaction.doom()  # extra paranoia, prevent erroneous commit
         formatter.info('Catalog is healthy, no surgery is needed.')
@@ -74,15 +157,16 @@ def surgery_command(portal_catalog, args, formatter):
 
     formatter.info('Performing surgery:')
     scheduler = SurgeryScheduler(result, catalog=portal_catalog)
-    scheduler.perform_surgeries()
+    scheduler.perform_surgeries(savepoint_interval=args.savepoint_interval)
     scheduler.write_result(formatter)
     if not scheduler.is_successful():
         return
 
     processQueue()
 
-    formatter.info('Performing post-surgery healthcheck:')
-    post_result = _run_healthcheck(portal_catalog, formatter)
+    formatter.info('Performing post-surgery healthcheck of touched rids:')
+    post_result = scheduler.verify()
+    post_result.write_result(formatter)
     if not post_result.is_healthy():
         transaction.doom()   # extra paranoia, prevent erroneous commit
         formatter.info('Not all health problems could be fixed, aborting.')
@@ -97,6 +181,170 @@ def surgery_command(portal_catalog, args, formatter):
                        'be fixed!')
 
 
+def batched_surgery_command(portal_catalog, args, formatter):
+    surgery = BatchedSurgery(
+        catalog=portal_catalog, batch_size=args.batch_size,
+        progress_path=args.progress_file,
+        savepoint_interval=args.savepoint_interval, dryrun=args.dryrun,
+        chunk_size=args.chunk_size)
+
+    unhealthy_rids = surgery.load_progress()
+    if unhealthy_rids is None:
+        result = _run_healthcheck(portal_catalog, args, formatter)
+        if result.is_healthy():
+            transaction.doom()  # extra paranoia, prevent erroneous commit
+            formatter.info('Catalog is healthy, no surgery is needed.')
+            return
+        unhealthy_rids = list(result.get_unhealthy_rids())
+    else:
+        formatter.info(
+            'Resuming surgery from {}, {} unhealthy rids remaining.'.format(
+                args.progress_file, len(unhealthy_rids)))
+
+    formatter.info('Performing surgery in batches of {} rids:'.format(
+        args.batch_size))
+    if not surgery.run(unhealthy_rids, formatter):
+        if args.dryrun:
+            formatter.info('Surgery was aborted, treated batches have not '
+                           'been committed due to dryrun.')
+        else:
+            formatter.info('Surgery was aborted, treated batches have been '
+                           'committed.')
+        sys.exit(1)
+
+    processQueue()
+
+    formatter.info('Performing post-surgery healthcheck of touched rids:')
+    post_result = surgery.verify()
+    post_result.write_result(formatter)
+    if not post_result.is_healthy():
+        transaction.doom()   # extra paranoia, prevent erroneous commit
+        if not post_result.is_length_healthy():
+            formatter.info('Surgery does not fix inconsistent lengths, use '
+                           'repair-lengths to reset the length counters.')
+        formatter.info('Not all health problems could be fixed.')
+        sys.exit(1)
+    elif args.dryrun:
+        formatter.info('Surgery would have been successful, but was aborted '
+                       'due to dryrun!')
+    else:
+        formatter.info('Surgery was successful, known health problems could '
+                       'be fixed!')
+
+
+def sweep_command(portal_catalog, args, formatter):
+    if args.dryrun:
+        formatter.info('Performing dryrun!')
+        formatter.info('')
+        transaction.doom()
+
+    formatter.info('Sweeping stale rids from indexes:')
+    result = IndexSweep(catalog=portal_catalog).run()
+    result.write_result(formatter)
+    if not result.has_swept():
+        transaction.doom()  # extra paranoia, prevent erroneous commit
+        return result
+
+    if args.dryrun:
+        formatter.info('Sweep would have been successful, but was aborted '
+                       'due to dryrun!')
+    else:
+        transaction.commit()
+        formatter.info('Sweep was successful, stale rids have been removed '
+                       'from indexes!')
+    return result
+
+
+def repair_lengths_command(portal_catalog, args, formatter):
+    if args.dryrun:
+        formatter.info('Performing dryrun!')
+        formatter.info('')
+        transaction.doom()
+
+    formatter.info('Repairing length counters:')
+    result = LengthRepair(
+        catalog=portal_catalog, chunk_size=args.chunk_size).run()
+    result.write_result(formatter)
+    if not result.has_repaired():
+        transaction.doom()  # extra paranoia, prevent erroneous commit
+        return result
+
+    if args.dryrun:
+        formatter.info('Repair would have been successful, but was aborted '
+                       'due to dryrun!')
+    else:
+        transaction.commit()
+        formatter.info('Repair was successful, length counters have been '
+                       'reset!')
+    return result
+
+
+def rebuild_index_command(portal_catalog, args, formatter):
+    if args.dryrun:
+        formatter.info('Performing dryrun!')
+        formatter.info('')
+        transaction.doom()
+
+    rebuild = IndexRebuild(
+        args.index, catalog=portal_catalog,
+        from_forward_index=args.from_forward_index)
+    try:
+        result = rebuild.run()
+    except CantPerformSurgery as exc:
+        transaction.doom()  # extra paranoia, prevent erroneous commit
+        formatter.info('Index could not be rebuilt: {}'.format(exc))
+        return None
+
+    result.write_result(formatter)
+    if args.dryrun:
+        formatter.info('Rebuild would have been successful, but was aborted '
+                       'due to dryrun!')
+    else:
+        transaction.commit()
+        formatter.info('Rebuild was successful!')
+    return result
+
+
+def rebuild_mapping_command(portal_catalog, args, formatter):
+    if args.dryrun:
+        formatter.info('Performing dryrun!')
+        formatter.info('')
+        transaction.doom()
+
+    rebuild = MappingRebuild(args.mapping, catalog=portal_catalog)
+    result = rebuild.run()
+    result.write_result(formatter)
+    if args.dryrun:
+        formatter.info('Rebuild would have been successful, but was aborted '
+                       'due to dryrun!')
+    else:
+        transaction.commit()
+        formatter.info('Rebuild was successful!')
+    return result
+
+
+def rebuild_command(portal_catalog, args, formatter):
+    if args.dryrun:
+        formatter.info('Rebuild can not be performed as dryrun, it commits '
+                       'each chunk.')
+        transaction.doom()
+        return None
+
+    rebuild = CatalogRebuild(
+        catalog=portal_catalog, processes=args.processes,
+        chunk_size=args.chunk_size, time_budget=args.time_budget,
+        restart=args.restart, formatter=formatter)
+    try:
+        result = rebuild.run()
+    except CantPerformSurgery as exc:
+        transaction.doom()  # extra paranoia, prevent erroneous commit
+        formatter.info('Catalog could not be rebuilt: {}'.format(exc))
+        return None
+
+    result.write_result(formatter)
+    return result
+
+
 def _setup_parser(app):
     parser = argparse.ArgumentParser(
         description='Provide health check and fixes for portal_catalog.',
@@ -111,24 +359,173 @@ def _setup_parser(app):
     parser.add_argument(
         '-n', '--dry-run', dest='dryrun',
         default=False, action="store_true",
-        help='Dryrun, do not commit changes. Only relevant for surgery.')
+        help='Dryrun, do not commit changes. Only relevant for surgery, '
+             'sweep, repair-lengths, rebuild-index and rebuild-mapping.')
+    parser.add_argument(
+        '--chunk-size', dest='chunk_size',
+        default=None, type=int,
+        help='Stream through the catalog in chunks of this many items and '
+             'free the database cache between chunks to bound memory usage. '
+             'The rebuild commits each chunk of this many objects.')
+    parser.add_argument(
+        '-p', '--processes', dest='processes',
+        default=1, type=int,
+        help='Split the healthcheck into shards and check them in this many '
+             'worker processes, each with its own database connection. The '
+             'btreecheck checks BTrees in this many worker processes, the '
+             'rebuild computes indexed values in this many worker '
+             'processes.')
 
     commands = parser.add_subparsers(dest='command')
     healthcheck = commands.add_parser(
         'healthcheck',
         help='Run a health check for portal_catalog.')
+    modes = healthcheck.add_mutually_exclusive_group()
+    modes.add_argument(
+        '--checkpoint', dest='checkpoint',
+        default=None,
+        help='Store a checkpoint in this file and only re-check the changes '
+             'committed since the checkpoint was stored by the last run.')
+    modes.add_argument(
+        '--cursor', dest='cursor',
+        default=None,
+        help='Save the progress of the healthcheck in this file and continue '
+             'from there when it is run again.')
+    modes.add_argument(
+        '--sample', dest='sample',
+        default=None, type=int,
+        help='Check a random sample of about this many rids and estimate '
+             'the share of unhealthy rids. Run a full healthcheck only if '
+             'unhealthy rids are found in the sample.')
+    healthcheck.add_argument(
+        '--time-budget', dest='time_budget',
+        default=None, type=float,
+        help='Stop the healthcheck after this many seconds, requires '
+             '--cursor.')
+    healthcheck.add_argument(
+        '--indexes', dest='indexes',
+        default=False, action='store_true',
+        help='Also validate the data of FieldIndex, KeywordIndex, DateIndex, '
+             'ExtendedPathIndex, DateRangeIndex, DateRecurringIndex and '
+             'ZCTextIndex indexes.')
+    healthcheck.add_argument(
+        '--aggregate', dest='aggregate',
+        default=False, action='store_true',
+        help='Group unhealthy rids by their symptoms and only report a few '
+             'rids per group.')
+    healthcheck.add_argument(
+        '--details-file', dest='details_file',
+        default=None,
+        help='Write all unhealthy rids to this file, one line per rid. '
+             'Implies --aggregate.')
     healthcheck.set_defaults(func=healthcheck_command)
 
+    triage = commands.add_parser(
+        'triage',
+        help='Quickly check whether the length counters of portal_catalog '
+             'agree, without scanning the catalog.')
+    triage.set_defaults(func=triage_command)
+
+    btreecheck = commands.add_parser(
+        'btreecheck',
+        help='Check the structural integrity of the BTrees of portal_catalog '
+             'and its indexes.')
+    btreecheck.set_defaults(func=btreecheck_command)
+
     surgery = commands.add_parser(
         'surgery',
         help='Run a healthcheck and perform surgery for unhealthy rids in '
              'portal_catalog.')
+    surgery.add_argument(
+        '--batch-size', dest='batch_size',
+        default=None, type=int,
+        help='Treat unhealthy rids in batches of this size, verify and '
+             'commit each batch separately.')
+    surgery.add_argument(
+        '--progress-file', dest='progress_file',
+        default=None,
+        help='Store the unhealthy rids still to be treated in this file '
+             'after each batch and resume from there when surgery is run '
+             'again, requires --batch-size.')
+    surgery.add_argument(
+        '--savepoint-interval', dest='savepoint_interval',
+        default=None, type=int,
+        help='Create a savepoint after this many surgeries to free memory.')
+    surgery.add_argument(
+        '--indexes', dest='indexes',
+        default=False, action='store_true',
+        help='Also validate the data of indexes. Indexes with symptoms for '
+             'a rid are scanned completely when the rid is removed from '
+             'them, surgery does not treat rids with index symptoms only.')
     surgery.set_defaults(func=surgery_command)
+
+    sweep = commands.add_parser(
+        'sweep',
+        help='Remove the entries of all rids not registered in the catalog '
+             'from all indexes of portal_catalog.')
+    sweep.set_defaults(func=sweep_command)
+
+    repair_lengths = commands.add_parser(
+        'repair-lengths',
+        help='Reset the length counters of portal_catalog and its indexes '
+             'to the size of the data they count.')
+    repair_lengths.set_defaults(func=repair_lengths_command)
+
+    rebuild_index = commands.add_parser(
+        'rebuild-index',
+        help='Rebuild the forward index of a FieldIndex, KeywordIndex, '
+             'DateIndex, DateRecurringIndex or UUIDIndex from its reverse '
+             'index, without touching content objects.')
+    rebuild_index.add_argument(
+        'index',
+        help='Name of the index to rebuild.')
+    rebuild_index.add_argument(
+        '--from-forward-index', dest='from_forward_index',
+        default=False, action='store_true',
+        help='Rebuild the reverse index from the forward index instead.')
+    rebuild_index.set_defaults(func=rebuild_index_command)
+
+    rebuild_mapping = commands.add_parser(
+        'rebuild-mapping',
+        help='Rebuild the uids mapping of portal_catalog from its paths '
+             'mapping or vice versa, cross-validated against the path and '
+             'UID index.')
+    rebuild_mapping.add_argument(
+        'mapping', choices=MappingRebuild.mappings,
+        help='Name of the mapping to rebuild.')
+    rebuild_mapping.set_defaults(func=rebuild_mapping_command)
+
+    rebuild = commands.add_parser(
+        'rebuild',
+        help='Rebuild portal_catalog from content into a fresh catalog in '
+             'committed chunks and swap it in at the end. The live catalog '
+             'remains in use meanwhile.')
+    rebuild.add_argument(
+        '--time-budget', dest='time_budget',
+        default=None, type=float,
+        help='Stop the rebuild after this many seconds, it is resumed when '
+             'it is run again.')
+    rebuild.add_argument(
+        '--restart', dest='restart',
+        default=False, action='store_true',
+        help='Discard an unfinished rebuild and start over.')
+    rebuild.set_defaults(func=rebuild_command)
     return parser
 
 
 def _parse(parser, args):
-    return parser.parse_args(args)
+    parsed_args = parser.parse_args(args)
+    if (parsed_args.command == 'healthcheck' and parsed_args.time_budget
+            and not parsed_args.cursor):
+        parser.error('--time-budget requires --cursor')
+    if getattr(parsed_args, 'progress_file', None) and (
+            not parsed_args.batch_size):
+        parser.error('--progress-file requires --batch-size')
+    if getattr(parsed_args, 'indexes', False) and (
+            parsed_args.cursor or parsed_args.checkpoint):
+        parser.error('--indexes can not be used with --cursor or '
+                     '--checkpoint')
+    return parsed_args
 
 
 def _run(parsed_args, app, formatter):
@@ -1,2 +1,6 @@
 class CantPerformSurgery(Exception):
     """Raised when a procedure cannot be performed."""
+
+
+class TimeBudgetExceeded(Exception):
+    """Raised when a health check runs out of its time budget."""
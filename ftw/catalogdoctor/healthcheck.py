@@ -1,6 +1,193 @@
+from BTrees.IIBTree import difference
+from BTrees.IIBTree import IITreeSet
+from BTrees.IIBTree import multiunion
+from ftw.catalogdoctor.indexes import get_validator
+from ftw.catalogdoctor.utils import items_after
+from ftw.catalogdoctor.utils import iter_chunked
+from ftw.catalogdoctor.utils import merge_join
+from ftw.catalogdoctor.utils import MISSING
+from functools import partial
 from plone import api
 
 
+# all symptoms the health check can report, sorted alphabetically. Unhealthy
+# rids store their symptoms as a bitmask, each symptom is represented by the
+# bit at its position in this enumeration.
+SYMPTOMS = (
+    'in_catalog_not_in_uuid_index',
+    'in_catalog_not_in_uuid_unindex',
+    'in_metadata_keys_not_in_paths_keys',
+    'in_metadata_keys_not_in_uids_values',
+    'in_paths_keys_not_in_metadata_keys',
+    'in_paths_keys_not_in_uids_values',
+    'in_paths_values_not_in_uids_keys',
+    'in_uids_keys_not_in_paths_values',
+    'in_uids_values_not_in_metadata_keys',
+    'in_uids_values_not_in_paths_keys',
+    'in_uuid_index_not_in_catalog',
+    'in_uuid_index_not_in_uuid_unindex',
+    'in_uuid_unindex_not_in_catalog',
+    'in_uuid_unindex_not_in_uuid_index',
+    'paths_tuple_mismatches_uids_tuple',
+    'uids_tuple_mismatches_paths_tuple',
+    'uuid_index_tuple_mismatches_uuid_unindex_tuple',
+    'uuid_unindex_tuple_mismatches_uuid_index_tuple',
+)
+SYMPTOM_BITS = dict(
+    (name, 1 << position) for position, name in enumerate(SYMPTOMS))
+
+_symptoms_by_mask = {0: ()}
+
+
+def symptoms_from_mask(mask):
+    """Return the sorted tuple of symptom names a bitmask represents."""
+
+    if mask not in _symptoms_by_mask:
+        _symptoms_by_mask[mask] = tuple(
+            name for name in SYMPTOMS if mask & SYMPTOM_BITS[name])
+    return _symptoms_by_mask[mask]
+
+
+def mask_from_symptoms(names):
+    """Return the bitmask representing an iterable of symptom names."""
+
+    mask = 0
+    for name in names:
+        mask |= SYMPTOM_BITS[name]
+    return mask
+
+
+class CatalogRids(object):
+    """The rids present in the catalog's data structures as `IITreeSet`s.
+
+    Sets are built in C from the BTrees and can be combined with the BTrees
+    set operations without materializing python ints.
+
+    If `iter_items` is provided it is used to iterate over the items of each
+    BTree, e.g. to stream through large BTrees chunk by chunk or to collect
+    rids of a key range only.
+    """
+    def __init__(self, catalog=None, iter_items=None):
+        self.uids_length = 0
+        self.uuid_index_length = 0
+        self.in_catalog = IITreeSet()
+        self.in_paths = IITreeSet()
+        self.in_metadata = IITreeSet()
+        self.in_uuid_index = IITreeSet()
+        self.in_uuid_unindex = IITreeSet()
+
+        if catalog is None:
+            return
+
+        uuid_index = catalog.indexes['UID']
+
+        # we consider the uids (path->rid mapping) as source of truth for the
+        # rids "registered" in the catalog. that mapping is also used  in
+        # `catalogObject` to decide whether an object is inserted or
+        # updated, i.e. if entries for an existing rid are updated or if a
+        # new rid is assigned to the path/object.
+        if iter_items is None:
+            self.uids_length = len(catalog.uids)
+            self.uuid_index_length = len(uuid_index._index)
+            self.in_catalog.update(catalog.uids.values())
+            self.in_paths.update(catalog.paths.keys())
+            self.in_metadata.update(catalog.data.keys())
+            self.in_uuid_index.update(uuid_index._index.values())
+            self.in_uuid_unindex.update(uuid_index._unindex.keys())
+        else:
+            self.collect(catalog, iter_items)
+
+    def collect(self, catalog, iter_items):
+        """Add the rids of the items returned by `iter_items` for each BTree.
+
+        Can be called again to continue an interrupted collection if
+        `iter_items` skips the items already collected.
+        """
+        uuid_index = catalog.indexes['UID']
+
+        self._collect(
+            self.in_catalog, iter_items(catalog.uids), from_values=True,
+            length='uids_length')
+        self._collect(
+            self.in_uuid_index, iter_items(uuid_index._index),
+            from_values=True, length='uuid_index_length')
+        self._collect(self.in_paths, iter_items(catalog.paths))
+        self._collect(self.in_metadata, iter_items(catalog.data))
+        self._collect(self.in_uuid_unindex, iter_items(uuid_index._unindex))
+
+    def _collect(self, rids, items, from_values=False, length=None):
+        """Add the rids in items to rids.
+
+        Items are counted in the attribute named `length` as they are
+        collected, it stays accurate when the iteration is interrupted.
+        """
+        for key, value in items:
+            rids.insert(value if from_values else key)
+            if length is not None:
+                setattr(self, length, getattr(self, length) + 1)
+
+    @classmethod
+    def merge(cls, parts):
+        """Return the union of the rids collected for several key ranges."""
+
+        rids = cls()
+        for part in parts:
+            rids.uids_length += part.uids_length
+            rids.uuid_index_length += part.uuid_index_length
+            for name in ('in_catalog', 'in_paths', 'in_metadata',
+                         'in_uuid_index', 'in_uuid_unindex'):
+                getattr(rids, name).update(getattr(part, name))
+        return rids
+
+
+class MembershipSymptoms(object):
+    """Symptoms caused by a rid missing from one of the catalog's data
+    structures.
+
+    Each symptom is computed as a single set difference of `CatalogRids`.
+    The affected rids are usually few, they are grouped by how a path is
+    attached to them:
+    - `uids_symptoms` are reported once per path pointing to the rid in uids
+    - `paths_symptoms` are reported with the rid's path in paths
+    - `rid_symptoms` are reported without path
+    """
+    def __init__(self, rids):
+        self.uids_symptoms = (
+            ('in_uids_values_not_in_paths_keys',
+             difference(rids.in_catalog, rids.in_paths)),
+            ('in_uids_values_not_in_metadata_keys',
+             difference(rids.in_catalog, rids.in_metadata)),
+            ('in_catalog_not_in_uuid_index',
+             difference(rids.in_catalog, rids.in_uuid_index)),
+            ('in_catalog_not_in_uuid_unindex',
+             difference(rids.in_catalog, rids.in_uuid_unindex)),
+        )
+        self.paths_symptoms = (
+            ('in_paths_keys_not_in_uids_values',
+             difference(rids.in_paths, rids.in_catalog)),
+            ('in_paths_keys_not_in_metadata_keys',
+             difference(rids.in_paths, rids.in_metadata)),
+        )
+        self.rid_symptoms = (
+            ('in_metadata_keys_not_in_paths_keys',
+             difference(rids.in_metadata, rids.in_paths)),
+            ('in_metadata_keys_not_in_uids_values',
+             difference(rids.in_metadata, rids.in_catalog)),
+            ('in_uuid_unindex_not_in_uuid_index',
+             difference(rids.in_uuid_unindex, rids.in_uuid_index)),
+            ('in_uuid_unindex_not_in_catalog',
+             difference(rids.in_uuid_unindex, rids.in_catalog)),
+            ('in_uuid_index_not_in_uuid_unindex',
+             difference(rids.in_uuid_index, rids.in_uuid_unindex)),
+            ('in_uuid_index_not_in_catalog',
+             difference(rids.in_uuid_index, rids.in_catalog)),
+        )
+        self.in_uids_with_symptoms = multiunion(
+            [affected for name, affected in self.uids_symptoms])
+        self.in_uuid_unindex_not_in_uuid_index = dict(
+            self.rid_symptoms)['in_uuid_unindex_not_in_uuid_index']
+
+
 class CatalogHealthCheck(object):
     """Run health check for a Products.ZCatalog.Catalog instance.
 
@@ -10,106 +197,345 @@ class CatalogHealthCheck(object):
     - the mappings are consistent, so every item is in the reverse mapping
     - for every item there is also an entry in the catalog metadata
 
-    The health check does not validate indices and index data yet.
+    Symptoms caused by a rid missing from a data structure are computed as
+    set differences of `CatalogRids`, see `MembershipSymptoms`. The
+    remaining per-item loops only compare tuples and attach paths to the few
+    unhealthy rids. The rid-keyed data structures, i.e. `paths` and the `UID`
+    index' `_unindex`, are sorted by rid and walked in lockstep in a single
+    pass.
+
+    When `chunk_size` is set the health check streams through all BTrees in
+    key ranges of at most `chunk_size` items. After each chunk all objects
+    loaded from the database are ghosted again. Memory usage is then bounded
+    by the objects of one chunk, plus the rid sets which need roughly 4 bytes
+    per rid.
+
+    When `check_indexes` is set the data of the catalog's indexes is
+    validated as well, for index types supported by a validator in
+    `ftw.catalogdoctor.indexes`.
     """
-    def __init__(self, catalog=None):
+    def __init__(self, catalog=None, chunk_size=None, check_indexes=False):
         self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
         self.catalog = self.portal_catalog._catalog
+        self.chunk_size = chunk_size
+        self.check_indexes = check_indexes
 
     def run(self):
         result = HealthCheckResult(self.catalog)
+        self.check(result)
+        return result
+
+    def check(self, result):
+        rids = self.collect_rids()
+        self.report_catalog_stats(result, rids)
+
+        symptoms = MembershipSymptoms(rids)
+        self.report_membership_symptoms(result, symptoms)
+
+        mismatching_paths = self.check_rids(result, symptoms)
+        self.check_uids(result, symptoms, mismatching_paths)
+        self.check_uuid_index(result)
+        if self.check_indexes:
+            self.check_index_data(result, rids)
+
+    def collect_rids(self):
+        if self.chunk_size:
+            return CatalogRids(self.catalog, iter_items=self.iter_items)
+        return CatalogRids(self.catalog)
+
+    def report_catalog_stats(self, result, rids):
+        uuid_index = self.catalog.indexes['UID']
+        result.report_catalog_stats(
+            len(self.catalog), rids.uids_length, len(rids.in_paths),
+            len(rids.in_metadata), len(uuid_index), rids.uuid_index_length,
+            len(rids.in_uuid_unindex))
+
+    def get_key_range(self, tree):
+        """Return the `(after, until)` range of keys checked for tree.
+
+        The full health check checks all keys.
+        """
+        return MISSING, MISSING
+
+    def items_after(self, tree, key):
+        after, until = self.get_key_range(tree)
+        if key is MISSING:
+            key = after
+        return items_after(tree, key, until=until)
+
+    def iter_chunked(self, items_after):
+        if not self.chunk_size:
+            return items_after(MISSING)
+        return iter_chunked(items_after, self.chunk_size, self.release_memory)
+
+    def iter_items(self, tree):
+        """Iterate over the items of a BTree, chunk-wise if configured."""
+
+        return self.iter_chunked(partial(self.items_after, tree))
+
+    def iter_joined(self, *trees):
+        """Iterate over BTrees with the same keys in lockstep.
+
+        See `merge_join` for details.
+        """
+        return self.iter_chunked(lambda key: merge_join(
+            *[self.items_after(tree, key) for tree in trees]))
+
+    def release_memory(self):
+        """Ghost all unmodified objects loaded by the database connection.
+
+        Called between chunks when streaming, this deactivates all BTree
+        buckets loaded for the previous chunk.
+        """
+        connection = self.catalog._p_jar
+        if connection is None:
+            return
+
+        connection.cacheGC()
+        connection.cacheMinimize()
+
+    def check_index_data(self, result, rids):
+        """Validate the data of all indexes supported by a validator."""
 
+        for name, index in sorted(self.catalog.indexes.items()):
+            validator = get_validator(name, index, self, rids.in_catalog)
+            if validator is not None:
+                validator.validate(result)
+
+    def report_membership_symptoms(self, result, symptoms):
+        """Report symptoms of rids that are missing from `paths` or
+        metadata.
+
+        Symptoms found for rids in `uids` are reported by `check_uids`.
+        """
         paths = self.catalog.paths
-        paths_values = set(self.catalog.paths.values())
+
+        for name, affected in symptoms.paths_symptoms:
+            for rid in affected:
+                result.report_symptom(name, rid, path=paths[rid])
+
+        for name, affected in symptoms.rid_symptoms:
+            for rid in affected:
+                result.report_symptom(name, rid)
+
+    def check_uids(self, result, symptoms, mismatching_paths):
+        """Check the path->rid mapping against the rid-keyed structures.
+
+        A path is present in the values of `paths` either if its rid points
+        back to it, or if it is one of the `mismatching_paths` found by
+        `check_rids`.
+        """
+        paths = self.catalog.paths
+
+        for path, rid in self.iter_items(self.catalog.uids):
+            rid_path = paths.get(rid, MISSING)
+            if rid_path != path:
+                if rid_path is not MISSING:
+                    result.report_symptom(
+                        'paths_tuple_mismatches_uids_tuple', rid, path=path)
+
+                if path not in mismatching_paths:
+                    result.report_symptom(
+                        'in_uids_keys_not_in_paths_values', rid, path=path)
+
+            if rid in symptoms.in_uids_with_symptoms:
+                for name, affected in symptoms.uids_symptoms:
+                    if rid in affected:
+                        result.report_symptom(name, rid, path=path)
+
+    def check_rids(self, result, symptoms, mismatching_paths=None):
+        """Check the rid-keyed structures in one sorted pass.
+
+        Walks `paths` (rid->path) and the `UID` index' `_unindex` in
+        lockstep, this visits each bucket only once.
+
+        Return the paths in `paths` values whose entry in `uids` points to a
+        different rid. They are added to `mismatching_paths` if given.
+        """
         uids = self.catalog.uids
-        uids_values = set(self.catalog.uids.values())
-        data = self.catalog.data
+        uuid_index = self.catalog.indexes['UID']
+        if mismatching_paths is None:
+            mismatching_paths = set()
+
+        for rid, (path, uuid) in self.iter_joined(
+                self.catalog.paths, uuid_index._unindex):
+
+            if path is not MISSING:
+                path_rid = uids.get(path, MISSING)
+                if path_rid is MISSING:
+                    result.report_symptom(
+                        'in_paths_values_not_in_uids_keys', rid, path=path)
+                elif path_rid != rid:
+                    result.report_symptom(
+                        'uids_tuple_mismatches_paths_tuple', rid, path=path)
+                    mismatching_paths.add(path)
+
+            if uuid is not MISSING and uuid_index._index.get(uuid) != rid:
+                if rid not in symptoms.in_uuid_unindex_not_in_uuid_index:
+                    result.report_symptom(
+                        'uuid_unindex_tuple_mismatches_uuid_index_tuple', rid)
+
+        return mismatching_paths
+
+    def check_uuid_index(self, result):
+        """Check the `UID` index' forward index (uuid->rid)."""
 
         uuid_index = self.catalog.indexes['UID']
-        result.report_catalog_stats(
-            len(self.catalog), len(uids), len(paths), len(data),
-            len(uuid_index), len(uuid_index._index), len(uuid_index._unindex))
 
-        for path, rid in uids.items():
-            if rid not in paths:
-                result.report_symptom(
-                    'in_uids_values_not_in_paths_keys', rid, path=path)
-            elif paths[rid] != path:
+        for uuid, rid in self.iter_items(uuid_index._index):
+            uuid_of_rid = uuid_index._unindex.get(rid, MISSING)
+            if uuid_of_rid is not MISSING and uuid_of_rid != uuid:
                 result.report_symptom(
-                    'paths_tuple_mismatches_uids_tuple', rid, path=path)
+                    'uuid_index_tuple_mismatches_uuid_unindex_tuple', rid)
 
-            if path not in paths_values:
-                result.report_symptom(
-                    'in_uids_keys_not_in_paths_values', rid, path=path)
 
-            if rid not in data:
-                result.report_symptom(
-                    'in_uids_values_not_in_metadata_keys', rid, path=path)
+class TargetedHealthCheck(object):
+    """Run the health check for some rids of a catalog only.
+
+    All symptoms of a rid are found by looking up its entries in each data
+    structure, in both directions. Entries in `uids` and in the `UID` index'
+    forward index can't be looked up by rid though. They are found via the
+    path and uuid of the rid and via the `paths` and `uuids` hints, e.g. the
+    paths attached to the rid by an earlier result. The rids these paths and
+    uuids point to are checked as well.
+
+    The result is exact for the checked rids as long as the hints contain
+    every path in `uids` and every uuid in the forward index pointing to a
+    checked rid other than its own path and uuid. Likewise every rid whose
+    path is hinted but points to a different rid in `uids` must be checked.
+    """
+    def __init__(self, catalog=None, rids=(), paths=(), uuids=()):
+        self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
+        self.catalog = self.portal_catalog._catalog
+        self.rids = set(rids)
+        self.paths = set(paths)
+        self.uuids = set(uuids)
+        self.uids_paths = {}
+        self.index_uuids = {}
+
+    def run(self):
+        result = HealthCheckResult(self.catalog)
+
+        self.expand()
+        paths = self.catalog.paths
+        paths_values = set(paths.get(rid, MISSING) for rid in self.rids)
+        for rid in sorted(self.rids):
+            self.check_rid(result, rid, paths_values)
+
+        return result
 
-        for rid, path in paths.items():
-            if path not in uids:
+    def expand(self):
+        """Add the rids, paths and uuids reachable from the hints.
+
+        Afterwards `uids_paths` and `index_uuids` map each checked rid to the
+        hinted paths and uuids pointing to it.
+        """
+        uids = self.catalog.uids
+        paths = self.catalog.paths
+        uuid_index = self.catalog.indexes['UID']
+
+        pending_rids = set(self.rids)
+        pending_paths = set(self.paths)
+        pending_uuids = set(self.uuids)
+        while pending_rids or pending_paths or pending_uuids:
+            for rid in pending_rids:
+                path = paths.get(rid, MISSING)
+                if path is not MISSING and path not in self.paths:
+                    self.paths.add(path)
+                    pending_paths.add(path)
+                uuid = uuid_index._unindex.get(rid, MISSING)
+                if uuid is not MISSING and uuid not in self.uuids:
+                    self.uuids.add(uuid)
+                    pending_uuids.add(uuid)
+
+            found = []
+            for path in pending_paths:
+                rid = uids.get(path, MISSING)
+                if rid is not MISSING:
+                    self.uids_paths.setdefault(rid, set()).add(path)
+                    found.append(rid)
+            for uuid in pending_uuids:
+                rid = uuid_index._index.get(uuid, MISSING)
+                if rid is not MISSING:
+                    self.index_uuids.setdefault(rid, set()).add(uuid)
+                    found.append(rid)
+
+            pending_rids = set(found) - self.rids
+            pending_paths = set()
+            pending_uuids = set()
+            self.rids.update(pending_rids)
+
+    def check_rid(self, result, rid, paths_values):
+        uids = self.catalog.uids
+        uuid_index = self.catalog.indexes['UID']
+
+        path = self.catalog.paths.get(rid, MISSING)
+        uuid = uuid_index._unindex.get(rid, MISSING)
+        uids_paths = self.uids_paths.get(rid, ())
+        index_uuids = self.index_uuids.get(rid, ())
+        in_metadata = rid in self.catalog.data
+
+        if path is not MISSING:
+            path_rid = uids.get(path, MISSING)
+            if path_rid is MISSING:
                 result.report_symptom(
                     'in_paths_values_not_in_uids_keys', rid, path=path)
-            elif uids[path] != rid:
+            elif path_rid != rid:
                 result.report_symptom(
                     'uids_tuple_mismatches_paths_tuple', rid, path=path)
-
-            if rid not in uids_values:
+            if not uids_paths:
                 result.report_symptom(
                     'in_paths_keys_not_in_uids_values', rid, path=path)
-
-            if rid not in data:
+            if not in_metadata:
                 result.report_symptom(
                     'in_paths_keys_not_in_metadata_keys', rid, path=path)
 
-        for rid in data:
-            if rid not in paths:
+        for uids_path in uids_paths:
+            if path is MISSING:
                 result.report_symptom(
-                    'in_metadata_keys_not_in_paths_keys', rid)
-            if rid not in uids_values:
+                    'in_uids_values_not_in_paths_keys', rid, path=uids_path)
+            elif path != uids_path:
                 result.report_symptom(
-                    'in_metadata_keys_not_in_uids_values', rid)
-
-        # we consider the uids (path->rid mapping) as source of truth for the
-        # rids "registered" in the catalog. that mapping is also used  in
-        # `catalogObject` to decide whether an object is inserted or
-        # updated, i.e. if entries for an existing rid are updated or if a
-        # new rid is assigned to the path/object.
-        rids_in_catalog = uids_values
-
-        index_values = set(uuid_index._index.values())
-
-        for uuid, rid in uuid_index._index.items():
-            if rid not in uuid_index._unindex:
+                    'paths_tuple_mismatches_uids_tuple', rid, path=uids_path)
+            if path != uids_path and uids_path not in paths_values:
                 result.report_symptom(
-                    'in_uuid_index_not_in_uuid_unindex', rid)
-            elif uuid_index._unindex[rid] != uuid:
+                    'in_uids_keys_not_in_paths_values', rid, path=uids_path)
+            if not in_metadata:
                 result.report_symptom(
-                    'uuid_index_tuple_mismatches_uuid_unindex_tuple', rid)
-            if rid not in rids_in_catalog:
+                    'in_uids_values_not_in_metadata_keys', rid,
+                    path=uids_path)
+            if not index_uuids:
                 result.report_symptom(
-                    'in_uuid_index_not_in_catalog', rid)
-
-        for rid, uuid in uuid_index._unindex.items():
-            if rid not in index_values:
+                    'in_catalog_not_in_uuid_index', rid, path=uids_path)
+            if uuid is MISSING:
                 result.report_symptom(
-                    'in_uuid_unindex_not_in_uuid_index', rid)
-            elif uuid_index._index[uuid] != rid:
+                    'in_catalog_not_in_uuid_unindex', rid, path=uids_path)
+
+        if in_metadata:
+            if path is MISSING:
                 result.report_symptom(
-                    'uuid_unindex_tuple_mismatches_uuid_index_tuple', rid)
-            if rid not in rids_in_catalog:
+                    'in_metadata_keys_not_in_paths_keys', rid)
+            if not uids_paths:
                 result.report_symptom(
-                    'in_uuid_unindex_not_in_catalog', rid)
+                    'in_metadata_keys_not_in_uids_values', rid)
 
-        for path, rid in uids.items():
-            if rid not in index_values:
+        if uuid is not MISSING:
+            if not index_uuids:
+                result.report_symptom('in_uuid_unindex_not_in_uuid_index', rid)
+            elif uuid_index._index.get(uuid) != rid:
                 result.report_symptom(
-                    'in_catalog_not_in_uuid_index', rid, path=path)
-            if rid not in uuid_index._unindex:
-                result.report_symptom(
-                    'in_catalog_not_in_uuid_unindex', rid, path=path)
+                    'uuid_unindex_tuple_mismatches_uuid_index_tuple', rid)
+            if not uids_paths:
+                result.report_symptom('in_uuid_unindex_not_in_catalog', rid)
 
-        return result
+        if index_uuids:
+            if uuid is MISSING:
+                result.report_symptom('in_uuid_index_not_in_uuid_unindex', rid)
+            elif any(index_uuid != uuid for index_uuid in index_uuids):
+                result.report_symptom(
+                    'uuid_index_tuple_mismatches_uuid_unindex_tuple', rid)
+            if not uids_paths:
+                result.report_symptom('in_uuid_index_not_in_catalog', rid)
 
 
 class UnhealthyRid(object):
@@ -119,27 +545,77 @@ class UnhealthyRid(object):
     with that rid. An `UnhealthyRid` instance groups all issues/symptoms found
     for one rid.
 
+    Badly corrupted catalogs can have hundreds of thousands of unhealthy rids,
+    instances are kept small: symptoms are stored as a bitmask over `SYMPTOMS`
+    and paths as `None`, a single path or a sorted tuple of paths.
+
+    Symptoms found in the data of an index are stored separately as sorted
+    tuple of `(index name, symptom)` pairs.
+
     """
+    __slots__ = ('rid', 'symptoms_mask', '_paths', '_index_symptoms')
+
     def __init__(self, rid):
         self.rid = rid
-        self._paths = set()
-        self._catalog_symptoms = set()
+        self.symptoms_mask = 0
+        self._paths = None
+        self._index_symptoms = None
+
+    def __getstate__(self):
+        # store names, the bits of a symptom may change in future versions
+        return (self.rid, self.paths, self.catalog_symptoms,
+                self.index_symptoms)
+
+    def __setstate__(self, state):
+        rid, paths, catalog_symptoms, index_symptoms = state
+        self.rid = rid
+        self.symptoms_mask = mask_from_symptoms(catalog_symptoms)
+        self._paths = None
+        self._index_symptoms = index_symptoms or None
+        for path in paths:
+            self.attach_path(path)
 
     def attach_path(self, path):
-        self._paths.add(path)
+        if self._paths is None:
+            self._paths = path
+        elif isinstance(self._paths, tuple):
+            if path not in self._paths:
+                self._paths = tuple(sorted(self._paths + (path,)))
+        elif path != self._paths:
+            self._paths = tuple(sorted((self._paths, path)))
 
     def report_catalog_symptom(self, name):
         """Report a symptom found in the the catalog."""
 
-        self._catalog_symptoms.add(name)
+        if name not in SYMPTOM_BITS:
+            raise ValueError('Unknown symptom {}.'.format(name))
+        self.symptoms_mask |= SYMPTOM_BITS[name]
+
+    def report_index_symptom(self, index_name, name):
+        """Report a symptom found in the data of an index."""
+
+        symptom = (index_name, name)
+        if self._index_symptoms is None:
+            self._index_symptoms = (symptom,)
+        elif symptom not in self._index_symptoms:
+            self._index_symptoms = tuple(
+                sorted(self._index_symptoms + (symptom,)))
 
     @property
     def catalog_symptoms(self):
-        return tuple(sorted(self._catalog_symptoms))
+        return symptoms_from_mask(self.symptoms_mask)
+
+    @property
+    def index_symptoms(self):
+        return self._index_symptoms or ()
 
     @property
     def paths(self):
-        return tuple(sorted(self._paths))
+        if self._paths is None:
+            return ()
+        if isinstance(self._paths, tuple):
+            return self._paths
+        return (self._paths,)
 
     def __str__(self):
         if self.paths:
@@ -152,6 +628,8 @@ class UnhealthyRid(object):
         formatter.info("{}:".format(self))
         for symptom in self.catalog_symptoms:
             formatter.info('\t- {}'.format(symptom))
+        for index_name, symptom in self.index_symptoms:
+            formatter.info('\t- {}: {}'.format(index_name, symptom))
 
 
 class HealthCheckResult(object):
@@ -160,6 +638,11 @@ class HealthCheckResult(object):
     def __init__(self, catalog):
         self.catalog = catalog
         self.unhealthy_rids = dict()
+        # symptom name or `(index name, symptom)` -> `IITreeSet` of the rids
+        # with that symptom
+        self.rids_by_symptom = dict()
+        # index name -> `(claimed length, length)`
+        self.inconsistent_index_lengths = dict()
         self.claimed_length = None
         self.uids_length = None
         self.paths_length = None
@@ -193,14 +676,59 @@ class HealthCheckResult(object):
             unhealthy_rid.attach_path(path)
         return unhealthy_rid
 
+    def _add_symptom(self, unhealthy_rid, name):
+        unhealthy_rid.report_catalog_symptom(name)
+        self._add_to_rids_by_symptom(name, unhealthy_rid.rid)
+
+    def _add_index_symptom(self, unhealthy_rid, index_name, name):
+        unhealthy_rid.report_index_symptom(index_name, name)
+        self._add_to_rids_by_symptom((index_name, name), unhealthy_rid.rid)
+
+    def _add_to_rids_by_symptom(self, symptom, rid):
+        if symptom not in self.rids_by_symptom:
+            self.rids_by_symptom[symptom] = IITreeSet()
+        self.rids_by_symptom[symptom].insert(rid)
+
     def report_symptom(self, name, rid, path=None):
         unhealthy_rid = self._get_or_add_unhealthy_rid(rid, path=path)
-        unhealthy_rid.report_catalog_symptom(name)
+        self._add_symptom(unhealthy_rid, name)
         return unhealthy_rid
 
+    def report_index_symptom(self, index_name, name, rid):
+        unhealthy_rid = self._get_or_add_unhealthy_rid(rid)
+        self._add_index_symptom(unhealthy_rid, index_name, name)
+        return unhealthy_rid
+
+    def report_index_length(self, index_name, claimed_length, length):
+        if claimed_length != length:
+            self.inconsistent_index_lengths[index_name] = (
+                claimed_length, length)
+
+    def merge_unhealthy_rids(self, unhealthy_rids):
+        """Merge unhealthy rids found by another health check run.
+
+        Used to combine the results of health checks that checked different
+        parts of the catalog.
+        """
+        for other in unhealthy_rids:
+            unhealthy_rid = self._get_or_add_unhealthy_rid(other.rid)
+            for path in other.paths:
+                unhealthy_rid.attach_path(path)
+            for name in other.catalog_symptoms:
+                self._add_symptom(unhealthy_rid, name)
+            for index_name, name in other.index_symptoms:
+                self._add_index_symptom(unhealthy_rid, index_name, name)
+
     def get_symptoms(self, rid):
         return self.unhealthy_rids[rid].catalog_symptoms
 
+    def get_rids_with_symptom(self, symptom):
+        """Return an `IITreeSet` of the unhealthy rids with a symptom.
+
+        Symptoms found in index data are queried by `(index name, symptom)`.
+        """
+        return self.rids_by_symptom.get(symptom, IITreeSet())
+
     def is_healthy(self):
         """Return whether the catalog is healthy according to this result."""
 
@@ -210,6 +738,10 @@ class HealthCheckResult(object):
         return not self.unhealthy_rids
 
     def is_length_healthy(self):
+        return (self.is_catalog_length_healthy()
+                and not self.inconsistent_index_lengths)
+
+    def is_catalog_length_healthy(self):
         return (
             self.claimed_length
             == self.uids_length
@@ -224,8 +756,22 @@ class HealthCheckResult(object):
         """Log result to logger."""
 
         formatter.info("Catalog health check report:")
+        self.write_length_result(formatter)
 
-        if self.is_length_healthy():
+        if self.is_catalog_data_healthy():
+            formatter.info("Catalog data is healthy.")
+        else:
+            formatter.info(
+                "Catalog data is unhealthy, found {} unhealthy rids:".format(
+                    len(self.unhealthy_rids)))
+            for unhealthy_rid in self.unhealthy_rids.values():
+                unhealthy_rid.write_result(formatter)
+                formatter.info('')
+
+    def write_length_result(self, formatter):
+        if self.claimed_length is None:
+            pass  # lengths have not been checked, e.g. by a targeted check
+        elif self.is_catalog_length_healthy():
             formatter.info(
                 "Catalog length is consistent at {}.".format(
                     self.claimed_length))
@@ -242,12 +788,8 @@ class HealthCheckResult(object):
             formatter.info(" uid index unindex length: {}".format(
                 self.uuid_index_unindex_length))
 
-        if self.is_catalog_data_healthy():
-            formatter.info("Catalog data is healthy.")
-        else:
+        for index_name, lengths in sorted(
+                self.inconsistent_index_lengths.items()):
             formatter.info(
-                "Catalog data is unhealthy, found {} unhealthy rids:".format(
-                    len(self.unhealthy_rids)))
-            for unhealthy_rid in self.unhealthy_rids.values():
-                unhealthy_rid.write_result(formatter)
-                formatter.info('')
+                "Inconsistent length of index {}: claimed length {}, "
+                "length {}.".format(index_name, *lengths))
@@ -0,0 +1,338 @@
+from ftw.catalogdoctor.healthcheck import CatalogHealthCheck
+from ftw.catalogdoctor.healthcheck import HealthCheckResult
+from ftw.catalogdoctor.healthcheck import TargetedHealthCheck
+from plone import api
+from ZODB.POSException import POSKeyError
+from ZODB.utils import p64
+from ZODB.utils import u64
+import os
+import pickle
+import transaction
+
+
+CHECKPOINT_VERSION = 1
+
+# symptoms of rids with an entry in the `UID` index' forward index that
+# points to them from a different uuid than their own.
+UUID_INDEX_MISMATCH_SYMPTOMS = frozenset([
+    'in_uuid_index_not_in_uuid_unindex',
+    'uuid_index_tuple_mismatches_uuid_unindex_tuple',
+])
+
+
+def get_checked_trees(catalog):
+    """Return the BTrees inspected by the health check by name."""
+
+    uuid_index = catalog.indexes['UID']
+    return {
+        'uids': catalog.uids,
+        'paths': catalog.paths,
+        'data': catalog.data,
+        'uuid_index': uuid_index._index,
+        'uuid_unindex': uuid_index._unindex,
+    }
+
+
+def iter_buckets(tree):
+    """Yield the buckets holding the items of a BTree as `(oid, bucket)`.
+
+    Only the inner nodes of the BTree are loaded, the buckets are not
+    activated. A BTree with a single bucket stores it inline, it is then
+    yielded itself.
+    """
+    state = tree.__getstate__()
+    if not state or len(state) < 2:
+        yield tree._p_oid, tree
+        return
+
+    nodes = [tree]
+    while nodes:
+        children = []
+        for node in nodes:
+            items = node.__getstate__()[0]
+            for child in items[0::2]:
+                if isinstance(child, type(tree)):
+                    children.append(child)
+                else:
+                    yield child._p_oid, child
+        nodes = children
+
+
+def items_from_state(state, is_tree):
+    """Return the items stored in the state of a BTree bucket.
+
+    The state of a BTree only contains items if the BTree stores its single
+    bucket inline.
+    """
+    if not state:
+        return []
+    if is_tree:
+        if len(state) > 1:
+            return []
+        state = state[0][0]
+    keys_and_values = state[0]
+    return zip(keys_and_values[0::2], keys_and_values[1::2])
+
+
+def find_changed_oids(storage, after, until):
+    """Return the oids of all objects changed in transactions after tid
+    `after` up to and including tid `until`.
+    """
+    changed = set()
+    iterator = storage.iterator(p64(u64(after) + 1), until)
+    try:
+        for transaction_record in iterator:
+            for record in transaction_record:
+                changed.add(record.oid)
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+    return changed
+
+
+class ChangedItems(object):
+    """Rids, paths and uuids found in changed items of the checked BTrees."""
+
+    def __init__(self):
+        self.rids = set()
+        self.paths = set()
+        self.uuids = set()
+
+    def add(self, name, items):
+        for key, value in items:
+            if name == 'uids':
+                self.paths.add(key)
+                self.rids.add(value)
+            elif name == 'paths':
+                self.rids.add(key)
+                self.paths.add(value)
+            elif name == 'data':
+                self.rids.add(key)
+            elif name == 'uuid_index':
+                self.uuids.add(key)
+                self.rids.add(value)
+            elif name == 'uuid_unindex':
+                self.rids.add(key)
+                self.uuids.add(value)
+
+
+class IncrementalHealthCheck(object):
+    """Re-check only the rids changed since the last health check.
+
+    After each run a checkpoint is stored in a file, it contains the tid of
+    the last committed transaction, the result and the number of items in
+    each bucket of the BTrees inspected by the health check. The next run
+    asks the storage for the objects changed by later transactions. Only
+    the changed buckets are loaded, in their current and in their
+    checkpointed state. The rids, paths and uuids they contain are checked
+    again with a `TargetedHealthCheck`, together with the unhealthy rids of
+    the last result. All other rids keep their last result. Lengths are
+    summed up from the bucket sizes.
+
+    This makes a run proportional to the changes since the last run instead
+    of to the size of the catalog. Without a usable checkpoint, e.g. for the
+    first run, after the catalog has been rebuilt or after the storage has
+    been packed, `healthcheck` runs a full health check instead.
+    """
+    def __init__(self, checkpoint_path, catalog=None, healthcheck=None):
+        self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
+        self.catalog = self.portal_catalog._catalog
+        self.checkpoint_path = checkpoint_path
+        self.healthcheck = healthcheck or CatalogHealthCheck(
+            catalog=self.portal_catalog)
+        self.checked_rids = None
+
+    @property
+    def connection(self):
+        return self.catalog._p_jar
+
+    @property
+    def storage(self):
+        return self.connection.db().storage
+
+    def run(self):
+        tid = self.begin()
+
+        checkpoint = self.load_checkpoint()
+        checked = None
+        if checkpoint is not None:
+            checked = self.run_incremental(checkpoint, tid)
+        if checked is None:
+            checked = self.run_full()
+
+        result, buckets, uuids = checked
+        self.save_checkpoint(tid, result, buckets, uuids)
+        return result
+
+    def begin(self):
+        """Return the tid of the last committed transaction.
+
+        The current transaction is aborted so that the connection sees at
+        least all changes up to that tid. Changes committed in between are
+        checked again by the next run.
+        """
+        tid = self.storage.lastTransaction()
+        doomed = transaction.isDoomed()
+        transaction.abort()
+        if doomed:
+            transaction.doom()
+        return tid
+
+    def get_catalog_path(self):
+        return '/'.join(self.portal_catalog.getPhysicalPath())
+
+    def get_roots(self):
+        return dict(
+            (name, tree._p_oid)
+            for name, tree in get_checked_trees(self.catalog).items())
+
+    def load_checkpoint(self):
+        """Return the checkpoint if it is usable for the catalog."""
+
+        if not os.path.exists(self.checkpoint_path):
+            return None
+
+        with open(self.checkpoint_path, 'rb') as checkpoint_file:
+            try:
+                checkpoint = pickle.load(checkpoint_file)
+            except Exception:
+                return None
+
+        if (not isinstance(checkpoint, dict)
+                or checkpoint.get('version') != CHECKPOINT_VERSION
+                or checkpoint['catalog'] != self.get_catalog_path()
+                or checkpoint['roots'] != self.get_roots()):
+            return None
+        return checkpoint
+
+    def save_checkpoint(self, tid, result, buckets, uuids):
+        checkpoint = {
+            'version': CHECKPOINT_VERSION,
+            'catalog': self.get_catalog_path(),
+            'roots': self.get_roots(),
+            'tid': tid,
+            'buckets': buckets,
+            'unhealthy_rids': list(result.get_unhealthy_rids()),
+            'uuids': uuids,
+        }
+        # write a new file first, never leave a truncated checkpoint
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'wb') as checkpoint_file:
+            pickle.dump(checkpoint, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self.checkpoint_path)
+
+    def run_full(self):
+        result = self.healthcheck.run()
+
+        buckets = {}
+        for name, tree in get_checked_trees(self.catalog).items():
+            for count, (oid, bucket) in enumerate(iter_buckets(tree), 1):
+                buckets[oid] = (name, len(bucket))
+                if (self.healthcheck.chunk_size
+                        and count % self.healthcheck.chunk_size == 0):
+                    self.healthcheck.release_memory()
+
+        rids = set(
+            unhealthy_rid.rid for unhealthy_rid in result.get_unhealthy_rids()
+            if UUID_INDEX_MISMATCH_SYMPTOMS.intersection(
+                unhealthy_rid.catalog_symptoms))
+        uuids = {}
+        if rids:
+            uuid_index = self.catalog.indexes['UID']
+            for uuid, rid in self.healthcheck.iter_items(uuid_index._index):
+                if rid in rids and uuid_index._unindex.get(rid) != uuid:
+                    uuids.setdefault(rid, set()).add(uuid)
+
+        return result, buckets, uuids
+
+    def find_changed_oids(self, after, until):
+        return find_changed_oids(self.storage, after, until)
+
+    def load_items_before(self, oid, tid, is_tree):
+        """Return the items a bucket contained at transaction tid."""
+
+        loaded = self.storage.loadBefore(oid, p64(u64(tid) + 1))
+        if loaded is None:
+            return []  # created after tid
+
+        data, serial, end = loaded
+        state = self.connection.oldstate(self.connection.get(oid), serial)
+        return items_from_state(state, is_tree)
+
+    def run_incremental(self, checkpoint, tid):
+        if u64(checkpoint['tid']) > u64(tid):
+            return None
+
+        try:
+            changed_oids = self.find_changed_oids(checkpoint['tid'], tid)
+        except (AttributeError, NotImplementedError):
+            return None  # the storage does not support iteration
+
+        roots = set(self.get_roots().values())
+        previous_buckets = checkpoint['buckets']
+        changed = ChangedItems()
+        buckets = {}
+        for name, tree in get_checked_trees(self.catalog).items():
+            for oid, bucket in iter_buckets(tree):
+                if oid in previous_buckets and oid not in changed_oids:
+                    buckets[oid] = previous_buckets[oid]
+                else:
+                    buckets[oid] = (name, len(bucket))
+                    changed.add(name, bucket.items())
+
+        try:
+            for oid in changed_oids.intersection(previous_buckets):
+                name = previous_buckets[oid][0]
+                changed.add(name, self.load_items_before(
+                    oid, checkpoint['tid'], is_tree=oid in roots))
+        except POSKeyError:
+            return None  # history has been packed away
+
+        previous_rids = checkpoint['unhealthy_rids']
+        previous_uuids = checkpoint['uuids']
+        targeted = TargetedHealthCheck(
+            catalog=self.portal_catalog,
+            rids=changed.rids.union(
+                unhealthy_rid.rid for unhealthy_rid in previous_rids),
+            paths=changed.paths.union(
+                path for unhealthy_rid in previous_rids
+                for path in unhealthy_rid.paths),
+            uuids=changed.uuids.union(
+                uuid for rid_uuids in previous_uuids.values()
+                for uuid in rid_uuids))
+        targeted_result = targeted.run()
+        self.checked_rids = targeted.rids
+
+        result = HealthCheckResult(self.catalog)
+        self.report_catalog_stats(result, buckets)
+        result.merge_unhealthy_rids(
+            unhealthy_rid for unhealthy_rid in previous_rids
+            if unhealthy_rid.rid not in targeted.rids)
+        result.merge_unhealthy_rids(targeted_result.get_unhealthy_rids())
+
+        uuid_index = self.catalog.indexes['UID']
+        uuids = {}
+        for unhealthy_rid in result.get_unhealthy_rids():
+            rid = unhealthy_rid.rid
+            if not UUID_INDEX_MISMATCH_SYMPTOMS.intersection(
+                    unhealthy_rid.catalog_symptoms):
+                continue
+            if rid in targeted.rids:
+                uuids[rid] = set(
+                    uuid for uuid in targeted.index_uuids.get(rid, ())
+                    if uuid != uuid_index._unindex.get(rid))
+            else:
+                uuids[rid] = previous_uuids.get(rid, set())
+
+        return result, buckets, uuids
+
+    def report_catalog_stats(self, result, buckets):
+        lengths = dict.fromkeys(get_checked_trees(self.catalog), 0)
+        for name, count in buckets.values():
+            lengths[name] += count
+
+        result.report_catalog_stats(
+            len(self.catalog), lengths['uids'], lengths['paths'],
+            lengths['data'], len(self.catalog.indexes['UID']),
+            lengths['uuid_index'], lengths['uuid_unindex'])
@@ -0,0 +1,503 @@
+from BTrees.IIBTree import difference
+from BTrees.IIBTree import IIBTree
+from BTrees.IIBTree import IITreeSet
+from BTrees.IOBTree import IOBTree
+from ftw.catalogdoctor.compat import DateRecurringIndex
+from ftw.catalogdoctor.utils import iter_rids
+from ftw.catalogdoctor.utils import merge_join
+from ftw.catalogdoctor.utils import MISSING
+from Products.ExtendedPathIndex.ExtendedPathIndex import ExtendedPathIndex
+from Products.PluginIndexes.DateIndex.DateIndex import DateIndex
+from Products.PluginIndexes.DateRangeIndex.DateRangeIndex import DateRangeIndex
+from Products.PluginIndexes.FieldIndex.FieldIndex import FieldIndex
+from Products.PluginIndexes.KeywordIndex.KeywordIndex import KeywordIndex
+from Products.ZCTextIndex import WidCode
+from Products.ZCTextIndex.ZCTextIndex import ZCTextIndex
+
+
+class IndexValidator(object):
+    """Validate the data of one index against itself and the catalog.
+
+    Validators report symptoms per rid to a `HealthCheckResult`, together
+    with the name of the index. `catalog_rids` contains the rids registered
+    in the catalog's `uids`. BTrees are iterated via the `healthcheck`, which
+    allows streaming through large indexes chunk by chunk.
+    """
+    def __init__(self, name, index, healthcheck, catalog_rids):
+        self.name = name
+        self.index = index
+        self.healthcheck = healthcheck
+        self.catalog_rids = catalog_rids
+
+    def validate(self, result):
+        raise NotImplementedError()
+
+    def report_symptom(self, result, name, rid):
+        result.report_index_symptom(self.name, name, rid)
+
+    def check_registered_in_catalog(self, result, rid, name):
+        if rid not in self.catalog_rids:
+            self.report_symptom(result, name, rid)
+
+
+class UnIndexValidator(IndexValidator):
+    """Validate an `UnIndex`, i.e. a FieldIndex, KeywordIndex or DateIndex.
+
+    The forward index `_index` maps values to a rid or a set of rids, the
+    reverse index `_unindex` maps rids to their value. For each rid in
+    `_unindex` the rows of its values are looked up in `_index`, which is
+    linear in the number of indexed objects. Entries of `_index` not derived
+    from any value in `_unindex` are detected by comparing the number of
+    entries found with the number of entries present. Only if they differ
+    `_index` is walked again to find the rids with surplus entries. Both
+    BTrees are streamed, only the forward index keys of inconsistent rids
+    are kept in memory. An empty sequence of keywords in `_unindex` has no
+    forward index entries and is consistent.
+
+    The `_length` counter of the index counts the keys of `_index`.
+    """
+    def validate(self, result):
+        iter_items = self.healthcheck.iter_items
+
+        length = 0
+        entries = 0
+        for value, rids_or_rid in iter_items(self.index._index):
+            length += 1
+            entries += self.count_rids(rids_or_rid)
+
+        result.report_index_length(self.name, self.index._length(), length)
+
+        # rid -> forward index keys pointing to the rid, for inconsistent
+        # rids only
+        index_values = {}
+        found = 0
+        for rid, unindex_value in iter_items(self.index._unindex):
+            self.check_registered_in_catalog(
+                result, rid, 'in_unindex_not_in_catalog')
+            values = set(self.get_unindex_values(unindex_value))
+            present = self.get_index_values(rid, values)
+            found += len(present)
+            if present:
+                self.check_registered_in_catalog(
+                    result, rid, 'in_index_not_in_catalog')
+            if present != values:
+                index_values[rid] = present
+
+        if found != entries:
+            self.find_surplus_entries(index_values)
+
+        for rid, values in sorted(index_values.items()):
+            unindex_value = self.index._unindex.get(rid, MISSING)
+            if unindex_value is MISSING:
+                self.report_symptom(result, 'in_index_not_in_unindex', rid)
+            elif not values:
+                self.report_symptom(result, 'in_unindex_not_in_index', rid)
+            elif values != set(self.get_unindex_values(unindex_value)):
+                self.report_symptom(
+                    result, 'index_tuple_mismatches_unindex_tuple', rid)
+
+            if values:
+                self.check_registered_in_catalog(
+                    result, rid, 'in_index_not_in_catalog')
+
+    def find_surplus_entries(self, index_values):
+        """Add the forward index keys pointing to rids whose value in
+        `_unindex` doesn't contain them.
+        """
+        unindex = self.index._unindex
+        for value, rids_or_rid in self.healthcheck.iter_items(
+                self.index._index):
+            for rid in iter_rids(rids_or_rid):
+                unindex_value = unindex.get(rid, MISSING)
+                if (unindex_value is not MISSING
+                        and value in self.get_unindex_values(unindex_value)):
+                    continue
+
+                if rid not in index_values:
+                    index_values[rid] = set()
+                    if unindex_value is not MISSING:
+                        index_values[rid] = self.get_index_values(
+                            rid, self.get_unindex_values(unindex_value))
+                index_values[rid].add(value)
+
+    def get_index_values(self, rid, values):
+        """Return the values whose forward index row contains rid."""
+
+        index = self.index._index
+        return set(value for value in values
+                   if self.is_in_row(index.get(value), rid))
+
+    def is_in_row(self, rids_or_rid, rid):
+        if rids_or_rid is None:
+            return False
+        if isinstance(rids_or_rid, int):
+            return rids_or_rid == rid
+        return rid in rids_or_rid
+
+    def count_rids(self, rids_or_rid):
+        if isinstance(rids_or_rid, int):
+            return 1
+        return len(rids_or_rid)
+
+    def get_unindex_values(self, unindex_value):
+        """Return the forward index keys for a value of `_unindex`."""
+
+        return (unindex_value,)
+
+
+class KeywordIndexValidator(UnIndexValidator):
+    """Validate a KeywordIndex, it stores a sequence of keywords per rid.
+
+    Also validates a DateRecurringIndex, which stores a sequence of
+    occurrences per rid.
+    """
+
+    def get_unindex_values(self, unindex_value):
+        return unindex_value
+
+
+def split_path(path):
+    """Return the components of a path as indexed by `ExtendedPathIndex`."""
+
+    return [component for component in path.split('/') if component]
+
+
+def get_path_entries(components):
+    """Return the `(component, level)` entries of a path in `_index`.
+
+    The last level is also marked by the `None` terminator.
+    """
+    entries = list(zip(components, range(len(components))))
+    entries.append((None, len(components) - 1))
+    return entries
+
+
+def get_parent_path(components):
+    return '/' + '/'.join(components[:-1])
+
+
+class ExtendedPathIndexValidator(IndexValidator):
+    """Validate an `ExtendedPathIndex`.
+
+    The reverse index `_unindex` maps rids to paths. All other data
+    structures are derived from these paths:
+    - `_index` maps each path component to levels to the rids with that
+      component at that level, a `None` component marks the last level
+    - `_index_items` maps paths to rids
+    - `_index_parents` maps parent paths to the rids of their children
+
+    For each path in `_unindex` the expected entries are derived and looked
+    up, which is linear in the number of indexed objects. Entries not
+    derived from any path in `_unindex` are detected by comparing the number
+    of entries found with the number of entries present. Only if they differ
+    the data structure is inverted to find the rids with surplus entries.
+
+    Unless `indexed_attrs` is configured the paths are the physical paths of
+    the objects, they are also compared with the catalog's `paths`.
+    """
+    def validate(self, result):
+        index = self.index
+        stats = dict(length=0, entries=0, items=0, parents=0)
+
+        if index.indexed_attrs is None:
+            items = self.healthcheck.iter_joined(
+                index._unindex, self.healthcheck.catalog.paths)
+        else:
+            items = ((rid, (path, MISSING)) for rid, path
+                     in self.healthcheck.iter_items(index._unindex))
+
+        for rid, (path, catalog_path) in items:
+            if path is MISSING:
+                self.report_symptom(
+                    result, 'in_paths_keys_not_in_unindex', rid)
+                continue
+
+            stats['length'] += 1
+            self.check_registered_in_catalog(
+                result, rid, 'in_unindex_not_in_catalog')
+            if catalog_path is not MISSING and catalog_path != path:
+                self.report_symptom(
+                    result, 'unindex_tuple_mismatches_paths_tuple', rid)
+            self.check_path(result, rid, path, stats)
+
+        result.report_index_length(
+            self.name, index._length(), stats['length'])
+
+        if stats['entries'] != self.count_index_entries():
+            self.check_index(result)
+        if stats['items'] != len(index._index_items):
+            self.check_index_items(result)
+        if stats['parents'] != self.count_index_parents():
+            self.check_index_parents(result)
+
+    def check_path(self, result, rid, path, stats):
+        """Look up the entries expected for the path of a rid."""
+
+        index = self.index
+        components = split_path(path)
+
+        for component, level in get_path_entries(components):
+            rids = index._index.get(component, {}).get(level)
+            if rids is not None and rid in rids:
+                stats['entries'] += 1
+            else:
+                self.report_symptom(result, 'in_unindex_not_in_index', rid)
+
+        item_rid = index._index_items.get(path)
+        if item_rid == rid:
+            stats['items'] += 1
+        elif item_rid is None:
+            self.report_symptom(
+                result, 'in_unindex_not_in_index_items', rid)
+        else:
+            self.report_symptom(
+                result, 'unindex_tuple_mismatches_index_items_tuple', rid)
+
+        parent_rids = index._index_parents.get(get_parent_path(components))
+        if parent_rids is not None and rid in parent_rids:
+            stats['parents'] += 1
+        else:
+            self.report_symptom(
+                result, 'in_unindex_not_in_index_parents', rid)
+
+    def count_index_entries(self):
+        return sum(
+            len(rids)
+            for component, levels in self.healthcheck.iter_items(
+                self.index._index)
+            for rids in levels.values())
+
+    def count_index_parents(self):
+        return sum(
+            len(rids) for parent_path, rids in self.healthcheck.iter_items(
+                self.index._index_parents))
+
+    def get_components(self, rid):
+        path = self.index._unindex.get(rid)
+        if path is None:
+            return None
+        return split_path(path)
+
+    def check_unknown_rid(self, result, rid, name):
+        """Report a rid which has no path in `_unindex`."""
+
+        self.report_symptom(result, name, rid)
+        self.check_registered_in_catalog(
+            result, rid, 'in_index_not_in_catalog')
+
+    def check_index(self, result):
+        for component, levels in self.healthcheck.iter_items(
+                self.index._index):
+            for level, rids in levels.items():
+                for rid in rids:
+                    components = self.get_components(rid)
+                    if components is None:
+                        self.check_unknown_rid(
+                            result, rid, 'in_index_not_in_unindex')
+                    elif (component, level) not in get_path_entries(
+                            components):
+                        self.report_symptom(
+                            result, 'index_tuple_mismatches_unindex_tuple',
+                            rid)
+
+    def check_index_items(self, result):
+        for path, rid in self.healthcheck.iter_items(
+                self.index._index_items):
+            unindex_path = self.index._unindex.get(rid)
+            if unindex_path is None:
+                self.check_unknown_rid(
+                    result, rid, 'in_index_items_not_in_unindex')
+            elif unindex_path != path:
+                self.report_symptom(
+                    result, 'index_items_tuple_mismatches_unindex_tuple',
+                    rid)
+
+    def check_index_parents(self, result):
+        for parent_path, rids in self.healthcheck.iter_items(
+                self.index._index_parents):
+            for rid in rids:
+                components = self.get_components(rid)
+                if components is None:
+                    self.check_unknown_rid(
+                        result, rid, 'in_index_parents_not_in_unindex')
+                elif get_parent_path(components) != parent_path:
+                    self.report_symptom(
+                        result,
+                        'index_parents_tuple_mismatches_unindex_tuple', rid)
+
+
+class DateRangeIndexValidator(IndexValidator):
+    """Validate a `DateRangeIndex`.
+
+    The reverse index `_unindex` maps rids to a `(since, until)` tuple. Each
+    rid is stored in exactly one of the forward data structures, depending
+    on which of its dates are set:
+    - `_always` if neither date is set
+    - `_until_only` if only until is set
+    - `_since_only` if only since is set
+    - `_since` and `_until` if both dates are set
+
+    The expected date of each rid per forward tree is recomputed from
+    `_unindex` into a temporary rid-keyed BTree in one pass. Each forward tree
+    is then walked once, the rids expected but not found are computed with
+    BTrees set operations. No content objects are loaded.
+    """
+    trees = ('_since_only', '_until_only', '_since', '_until')
+
+    def validate(self, result):
+        unindexed = IITreeSet()
+        expected_always = IITreeSet()
+        expected = dict((name, IOBTree()) for name in self.trees)
+
+        for rid, (since, until) in self.healthcheck.iter_items(
+                self.index._unindex):
+            unindexed.insert(rid)
+            self.check_registered_in_catalog(
+                result, rid, 'in_unindex_not_in_catalog')
+
+            if since is None and until is None:
+                expected_always.insert(rid)
+            elif since is None:
+                expected['_until_only'][rid] = until
+            elif until is None:
+                expected['_since_only'][rid] = since
+            else:
+                expected['_since'][rid] = since
+                expected['_until'][rid] = until
+
+        for rid in difference(self.index._always, expected_always):
+            self.check_surplus_rid(result, rid, unindexed)
+        for rid in difference(expected_always, self.index._always):
+            self.report_symptom(result, 'in_unindex_not_in_index', rid)
+
+        for name in self.trees:
+            expected_dates = expected[name]
+            found = IITreeSet()
+            for date, rids_or_rid in self.healthcheck.iter_items(
+                    getattr(self.index, name)):
+                for rid in iter_rids(rids_or_rid):
+                    if expected_dates.get(rid) == date:
+                        found.insert(rid)
+                    else:
+                        self.check_surplus_rid(result, rid, unindexed)
+
+            expected_rids = IITreeSet(expected_dates.keys())
+            for rid in difference(expected_rids, found):
+                self.report_symptom(result, 'in_unindex_not_in_index', rid)
+
+    def check_surplus_rid(self, result, rid, unindexed):
+        """Report a rid found in an unexpected forward index entry."""
+
+        if rid in unindexed:
+            self.report_symptom(
+                result, 'index_tuple_mismatches_unindex_tuple', rid)
+        else:
+            self.report_symptom(result, 'in_index_not_in_unindex', rid)
+            self.check_registered_in_catalog(
+                result, rid, 'in_index_not_in_catalog')
+
+
+class ZCTextIndexValidator(IndexValidator):
+    """Validate a `ZCTextIndex` against its lexicon and the catalog.
+
+    The text index, i.e. an `OkapiIndex` or `CosineIndex`, stores:
+    - `_docwords`, mapping rids to their encoded list of wordids
+    - `_docweight`, mapping rids to their weight
+    - `_wordinfo`, mapping wordids to the postings of the word, i.e. the rids
+      containing the word and their score
+
+    Postings are never kept in memory. Instead the number and the XOR of the
+    distinct wordids of each rid are accumulated in rid-keyed BTrees, once
+    from `_docwords` and once from `_wordinfo`, and then compared. Memory
+    usage is thus bounded by the number of rids, not by the number of
+    postings. The wordids of `_wordinfo` are compared with the lexicon in
+    the same pass, both are sorted by wordid.
+
+    Objects without text are not indexed, so cataloged rids missing in the
+    index are not reported. The claimed length of the index is its document
+    count.
+    """
+    def validate(self, result):
+        text_index = self.index.index
+
+        docwords_counts = IIBTree()
+        docwords_checksums = IIBTree()
+        for rid, (encoded_wids, weight) in self.healthcheck.iter_joined(
+                text_index._docwords, text_index._docweight):
+            if encoded_wids is MISSING:
+                self.report_symptom(
+                    result, 'in_docweight_not_in_docwords', rid)
+                self.check_registered_in_catalog(
+                    result, rid, 'in_index_not_in_catalog')
+                continue
+
+            if weight is MISSING:
+                self.report_symptom(
+                    result, 'in_docwords_not_in_docweight', rid)
+            self.check_registered_in_catalog(
+                result, rid, 'in_index_not_in_catalog')
+
+            wids = set(WidCode.decode(encoded_wids))
+            docwords_counts[rid] = len(wids)
+            docwords_checksums[rid] = self.get_checksum(wids)
+
+        result.report_index_length(
+            self.name, text_index.document_count(), len(docwords_counts))
+
+        wordinfo_counts = IIBTree()
+        wordinfo_checksums = IIBTree()
+        for wid, (postings, word) in self.healthcheck.iter_joined(
+                text_index._wordinfo, text_index._lexicon._words):
+            if postings is MISSING:
+                continue  # lexicons can be shared with other indexes
+
+            for rid in postings.keys():
+                wordinfo_counts[rid] = wordinfo_counts.get(rid, 0) + 1
+                wordinfo_checksums[rid] = (
+                    wordinfo_checksums.get(rid, 0) ^ wid)
+                if word is MISSING:
+                    self.report_symptom(
+                        result, 'in_wordinfo_not_in_lexicon', rid)
+
+        for rid, (count, wordinfo_count) in merge_join(
+                docwords_counts.items(), wordinfo_counts.items()):
+            if count is MISSING:
+                self.report_symptom(
+                    result, 'in_wordinfo_not_in_docwords', rid)
+                self.check_registered_in_catalog(
+                    result, rid, 'in_index_not_in_catalog')
+            elif wordinfo_count is MISSING:
+                if count:
+                    self.report_symptom(
+                        result, 'in_docwords_not_in_wordinfo', rid)
+            elif (count != wordinfo_count
+                    or docwords_checksums[rid] != wordinfo_checksums[rid]):
+                self.report_symptom(
+                    result, 'docwords_tuple_mismatches_wordinfo_tuple', rid)
+
+    def get_checksum(self, wids):
+        checksum = 0
+        for wid in wids:
+            checksum ^= wid
+        return checksum
+
+
+# validators by index type, subclasses are not validated
+INDEX_TO_VALIDATOR = {
+    DateIndex: UnIndexValidator,
+    DateRangeIndex: DateRangeIndexValidator,
+    DateRecurringIndex: KeywordIndexValidator,
+    ExtendedPathIndex: ExtendedPathIndexValidator,
+    FieldIndex: UnIndexValidator,
+    KeywordIndex: KeywordIndexValidator,
+    ZCTextIndex: ZCTextIndexValidator,
+}
+
+
+def get_validator(name, index, healthcheck, catalog_rids):
+    """Return a validator for an index or `None` if it is not supported."""
+
+    validator_cls = INDEX_TO_VALIDATOR.get(type(index))
+    if validator_cls is None:
+        return None
+    return validator_cls(name, index, healthcheck, catalog_rids)
@@ -0,0 +1,162 @@
+from BTrees.Length import Length
+from ftw.catalogdoctor.compat import DateRecurringIndex
+from ftw.catalogdoctor.utils import iter_chunked
+from ftw.catalogdoctor.utils import keys_after
+from functools import partial
+from plone import api
+from Products.ExtendedPathIndex.ExtendedPathIndex import ExtendedPathIndex
+from Products.PluginIndexes.BooleanIndex.BooleanIndex import BooleanIndex
+from Products.PluginIndexes.DateIndex.DateIndex import DateIndex
+from Products.PluginIndexes.FieldIndex.FieldIndex import FieldIndex
+from Products.PluginIndexes.KeywordIndex.KeywordIndex import KeywordIndex
+from Products.PluginIndexes.PathIndex.PathIndex import PathIndex
+from Products.PluginIndexes.UUIDIndex.UUIDIndex import UUIDIndex
+from Products.ZCTextIndex.ZCTextIndex import ZCTextIndex
+
+
+def get_unindex_counters(index):
+    """An `UnIndex` counts the keys of its forward index."""
+
+    return [(('_length',), index._index)]
+
+
+def get_boolean_index_counters(index):
+    """A `BooleanIndex` counts the rids of its reverse index and the rids
+    with the indexed value.
+    """
+    return [(('_length',), index._unindex),
+            (('_index_length',), index._index)]
+
+
+def get_path_index_counters(index):
+    """Path indexes count the rids of their reverse index."""
+
+    return [(('_length',), index._unindex)]
+
+
+def get_text_index_counters(index):
+    """The text index of a `ZCTextIndex` counts its words and its
+    documents.
+    """
+    return [(('index', 'length'), index.index._wordinfo),
+            (('index', 'document_count'), index.index._docwords)]
+
+
+# length counters by index type, as `(attributes, tree)` tuples of the
+# counter's attribute path and the BTree whose size it counts. The length
+# of a `DateRangeIndex` is not maintained.
+INDEX_TO_COUNTERS = {
+    BooleanIndex: get_boolean_index_counters,
+    DateIndex: get_unindex_counters,
+    DateRecurringIndex: get_unindex_counters,
+    ExtendedPathIndex: get_path_index_counters,
+    FieldIndex: get_unindex_counters,
+    KeywordIndex: get_unindex_counters,
+    PathIndex: get_path_index_counters,
+    UUIDIndex: get_unindex_counters,
+    ZCTextIndex: get_text_index_counters,
+}
+
+
+class LengthRepair(object):
+    """Reset the `BTrees.Length` counters of the catalog and its indexes.
+
+    Length counters resolve conflicting changes by adding up the deltas,
+    they can drift from the size of the data they count. This recomputes
+    the size of the counted BTrees and resets each counter that disagrees.
+    The catalog length is reset to the size of `uids`. Index data is not
+    validated, inconsistent data is left for the health check and surgery.
+
+    `len` walks the chain of buckets of a BTree without materializing its
+    items, the database cache is freed after each BTree. With `chunk_size`
+    the keys are counted in chunks and the buckets loaded for each chunk are
+    released, this bounds memory usage for large BTrees.
+    """
+    def __init__(self, catalog=None, chunk_size=None):
+        self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
+        self.catalog = self.portal_catalog._catalog
+        self.chunk_size = chunk_size
+
+    def get_counters(self):
+        """Yield `(name, owner, attribute, tree)` of each length counter."""
+
+        yield '_length', self.catalog, '_length', self.catalog.uids
+
+        for index_name, index in sorted(self.catalog.indexes.items()):
+            get_counters = INDEX_TO_COUNTERS.get(type(index))
+            if get_counters is None:
+                continue
+
+            for attributes, tree in get_counters(index):
+                owner = index
+                for name in attributes[:-1]:
+                    owner = getattr(owner, name)
+                yield ('.'.join(('indexes', index_name) + attributes),
+                       owner, attributes[-1], tree)
+
+    def run(self):
+        result = LengthRepairResult()
+        for name, owner, attribute, tree in self.get_counters():
+            counter = getattr(owner, attribute, None)
+            if not isinstance(counter, Length):
+                continue  # not maintained by older versions
+
+            claimed_length = counter()
+            length = self.count(tree)
+            if claimed_length != length:
+                counter.set(length)
+            result.report_counter(name, claimed_length, length)
+            self.release_memory()
+
+        return result
+
+    def count(self, tree):
+        if not self.chunk_size:
+            return len(tree)
+
+        keys = iter_chunked(
+            partial(keys_after, tree), self.chunk_size, self.release_memory)
+        return sum(1 for key in keys)
+
+    def release_memory(self):
+        """Ghost all unmodified objects loaded by the database connection.
+
+        The reset counters are modified and remain in memory.
+        """
+        connection = self.catalog._p_jar
+        if connection is None:
+            return
+
+        connection.cacheGC()
+        connection.cacheMinimize()
+
+
+class LengthRepairResult(object):
+    """Provide the result of one length repair run."""
+
+    def __init__(self):
+        self.counters = 0
+        # `(name, claimed length, length)` tuples of the reset counters
+        self.repaired = []
+
+    def report_counter(self, name, claimed_length, length):
+        self.counters += 1
+        if claimed_length != length:
+            self.repaired.append((name, claimed_length, length))
+
+    def has_repaired(self):
+        return bool(self.repaired)
+
+    def write_result(self, formatter):
+        """Log result to logger."""
+
+        if not self.repaired:
+            formatter.info("All {} length counters are correct.".format(
+                self.counters))
+            return
+
+        formatter.info("Reset {} of {} length counters:".format(
+            len(self.repaired), self.counters))
+        for name, claimed_length, length in self.repaired:
+            formatter.info(
+                " {}: {} -> {}".format(name, claimed_length, length))
@@ -0,0 +1,326 @@
+from BTrees.IIBTree import IITreeSet
+from BTrees.Length import Length
+from ftw.catalogdoctor.compat import DateRecurringIndex
+from ftw.catalogdoctor.exceptions import CantPerformSurgery
+from ftw.catalogdoctor.utils import iter_rids
+from ftw.catalogdoctor.utils import MISSING
+from itertools import groupby
+from operator import itemgetter
+from plone import api
+from Products.PluginIndexes.DateIndex.DateIndex import DateIndex
+from Products.PluginIndexes.FieldIndex.FieldIndex import FieldIndex
+from Products.PluginIndexes.KeywordIndex.KeywordIndex import KeywordIndex
+from Products.PluginIndexes.UUIDIndex.UUIDIndex import UUIDIndex
+
+
+def build_tree(tree_cls, sorted_items):
+    """Return a new BTree filled from items sorted by key.
+
+    Inserting sorted keys only ever appends to the last bucket, which is
+    filled up before it is split.
+    """
+    tree = tree_cls()
+    tree.update(sorted_items)
+    return tree
+
+
+class UnIndexRebuilder(object):
+    """Rebuild one side of an `UnIndex` from the other side.
+
+    The forward index `_index` maps values to a set of rids, the reverse
+    index `_unindex` maps rids to their value. The entries of the intact side
+    are sorted by the key of the side to rebuild and a new BTree is filled
+    from them, it replaces the damaged BTree. The `_length` counter, which
+    counts the keys of `_index`, is reset.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def get_keys(self, value):
+        """Return the forward index keys of a reverse index value."""
+
+        return (value,)
+
+    def make_value(self, rid, keys):
+        """Return the reverse index value of the forward index keys of a
+        rid.
+        """
+        if len(keys) != 1:
+            raise CantPerformSurgery(
+                "Expected exactly one value for rid {}, got: {}".format(
+                    rid, ", ".join(repr(key) for key in keys)))
+        return keys[0]
+
+    def make_row(self, key, rids):
+        return IITreeSet(rids)
+
+    def rebuild_forward_index(self):
+        pairs = sorted(
+            (key, rid)
+            for rid, value in self.index._unindex.items()
+            for key in self.get_keys(value))
+
+        rows = [(key, self.make_row(key, [rid for key, rid in group]))
+                for key, group in groupby(pairs, itemgetter(0))]
+        self.index._index = build_tree(type(self.index._index), rows)
+        self.finish(len(rows))
+
+    def rebuild_reverse_index(self):
+        pairs = []
+        length = 0
+        for key, rids_or_rid in self.index._index.items():
+            pairs.extend((rid, key) for rid in iter_rids(rids_or_rid))
+            length += 1
+        pairs.sort()
+
+        values = [(rid, self.make_value(rid, [key for rid, key in group]))
+                  for rid, group in groupby(pairs, itemgetter(0))]
+        self.index._unindex = build_tree(type(self.index._unindex), values)
+        self.finish(length)
+
+    def finish(self, length):
+        self.index._length.set(length)
+        # invalidate cached query results of the index
+        if getattr(self.index, '_counter', None) is not None:
+            self.index._increment_counter()
+
+
+class KeywordIndexRebuilder(UnIndexRebuilder):
+    """Rebuild an index storing a list of values per rid."""
+
+    def get_keys(self, value):
+        return value
+
+    def make_value(self, rid, keys):
+        return list(keys)
+
+
+class DateRecurringIndexRebuilder(KeywordIndexRebuilder):
+    """Rebuild a `DateRecurringIndex`, it stores a tuple of values per
+    rid.
+    """
+    def make_value(self, rid, keys):
+        return tuple(keys)
+
+
+class UUIDIndexRebuilder(UnIndexRebuilder):
+    """Rebuild an `UUIDIndex`, its forward index maps each uuid to a single
+    rid.
+    """
+    def make_row(self, key, rids):
+        if len(rids) != 1:
+            raise CantPerformSurgery(
+                "Expected exactly one rid for uuid {}, got: {}".format(
+                    key, ", ".join(str(rid) for rid in rids)))
+        return rids[0]
+
+
+class IndexRebuild(object):
+    """Rebuild the forward index of an index from its reverse index.
+
+    With `from_forward_index` the reverse index is rebuilt from the forward
+    index instead. Only the index' own data is used, content objects are not
+    touched. The rebuilt BTree replaces the damaged one when the transaction
+    is committed.
+    """
+
+    index_to_rebuilder = {
+        DateIndex: UnIndexRebuilder,
+        DateRecurringIndex: DateRecurringIndexRebuilder,
+        FieldIndex: UnIndexRebuilder,
+        KeywordIndex: KeywordIndexRebuilder,
+        UUIDIndex: UUIDIndexRebuilder,
+    }
+
+    def __init__(self, index_name, catalog=None, from_forward_index=False):
+        self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
+        self.catalog = self.portal_catalog._catalog
+        self.index_name = index_name
+        self.from_forward_index = from_forward_index
+
+    def run(self):
+        if self.index_name not in self.catalog.indexes:
+            raise CantPerformSurgery(
+                "No index named {}".format(self.index_name))
+
+        index = self.catalog.indexes[self.index_name]
+        rebuilder_cls = self.index_to_rebuilder.get(type(index))
+        if not rebuilder_cls:
+            raise CantPerformSurgery(
+                'Unhandled index type: {0!r}'.format(index))
+
+        rebuilder = rebuilder_cls(index)
+        result = IndexRebuildResult(self.index_name, self.from_forward_index)
+        if self.from_forward_index:
+            rebuilder.rebuild_reverse_index()
+        else:
+            rebuilder.rebuild_forward_index()
+        result.keys = index._length()
+        result.rids = len(index._unindex)
+        return result
+
+
+class IndexRebuildResult(object):
+    """Provide the result of rebuilding an index."""
+
+    def __init__(self, index_name, from_forward_index):
+        self.index_name = index_name
+        self.from_forward_index = from_forward_index
+        self.keys = 0
+        self.rids = 0
+
+    def write_result(self, formatter):
+        """Log result to logger."""
+
+        if self.from_forward_index:
+            formatter.info(
+                "Rebuilt reverse index of {} from its forward index.".format(
+                    self.index_name))
+        else:
+            formatter.info(
+                "Rebuilt forward index of {} from its reverse index.".format(
+                    self.index_name))
+        formatter.info(" {} keys, {} rids".format(self.keys, self.rids))
+
+
+class MappingRebuild(object):
+    """Rebuild the catalog's `uids` from its `paths` or vice versa.
+
+    Each entry of the intact mapping is cross-validated against the reverse
+    indexes of the `path` and the `UID` index. An entry is skipped if the
+    path index contradicts its path or if neither index knows its rid. When
+    several entries end up with the same key in the rebuilt mapping, the
+    entry confirmed by the path index and then the one present in the
+    damaged mapping is preferred, ambiguous entries are skipped. Skipped
+    entries are left for surgery.
+
+    The validated entries are sorted by their new key and loaded into a
+    fresh BTree, which replaces the damaged mapping. The catalog's length is
+    reset to the size of `uids`.
+    """
+    mappings = ('uids', 'paths')
+    path_index_name = 'path'
+    uuid_index_name = 'UID'
+
+    def __init__(self, mapping, catalog=None):
+        if mapping not in self.mappings:
+            raise CantPerformSurgery(
+                "Can only rebuild {}, got: {}".format(
+                    " or ".join(self.mappings), mapping))
+
+        self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
+        self.catalog = self.portal_catalog._catalog
+        self.mapping = mapping
+
+    def iter_source_entries(self):
+        """Yield `(rid, path)` for each entry of the intact mapping."""
+
+        if self.mapping == 'uids':
+            for rid, path in self.catalog.paths.items():
+                yield rid, path
+        else:
+            for path, rid in self.catalog.uids.items():
+                yield rid, path
+
+    def get_target_key(self, candidate):
+        """Return the key of a candidate in the rebuilt mapping."""
+
+        rid, path = candidate[:2]
+        return path if self.mapping == 'uids' else rid
+
+    def is_in_target(self, rid, path):
+        if self.mapping == 'uids':
+            return self.catalog.uids.get(path, MISSING) == rid
+        return self.catalog.paths.get(rid, MISSING) == path
+
+    def run(self):
+        for index_name in (self.path_index_name, self.uuid_index_name):
+            if index_name not in self.catalog.indexes:
+                raise CantPerformSurgery(
+                    "Can't rebuild {} without an index named {}, its "
+                    "reverse index is needed to validate the entries."
+                    .format(self.mapping, index_name))
+
+        result = MappingRebuildResult(self.mapping)
+        entries = self.get_validated_entries(result)
+
+        if self.mapping == 'uids':
+            self.catalog.uids = build_tree(
+                type(self.catalog.uids),
+                [(path, rid) for rid, path in entries])
+        else:
+            self.catalog.paths = build_tree(
+                type(self.catalog.paths), entries)
+
+        # skipped entries remain in `uids` when rebuilding `paths`
+        length = len(self.catalog.uids)
+        counter = getattr(self.catalog, '_length', None)
+        if isinstance(counter, Length):  # not maintained by older versions
+            counter.set(length)
+        result.length = length
+        return result
+
+    def get_validated_entries(self, result):
+        """Return the valid `(rid, path)` entries sorted by new key."""
+
+        path_unindex = self.catalog.indexes[self.path_index_name]._unindex
+        uuid_unindex = self.catalog.indexes[self.uuid_index_name]._unindex
+
+        candidates = []
+        for rid, path in self.iter_source_entries():
+            indexed_path = path_unindex.get(rid, MISSING)
+            if indexed_path is not MISSING and indexed_path != path:
+                result.report_skipped(
+                    rid, path, 'path index has {}'.format(indexed_path))
+            elif indexed_path is MISSING and rid not in uuid_unindex:
+                result.report_skipped(rid, path, 'not indexed')
+            else:
+                # prefer entries confirmed by the path index, then entries
+                # present in the damaged mapping
+                preference = (indexed_path is not MISSING,
+                              self.is_in_target(rid, path))
+                candidates.append((rid, path, preference))
+        candidates.sort(key=self.get_target_key)
+
+        entries = []
+        for key, group in groupby(candidates, key=self.get_target_key):
+            group = sorted(group, key=itemgetter(2), reverse=True)
+            if len(group) > 1 and group[0][2] == group[1][2]:
+                for rid, path, preference in group:
+                    result.report_skipped(rid, path, 'ambiguous')
+                continue
+
+            entries.append(group[0][:2])
+            for rid, path, preference in group[1:]:
+                result.report_skipped(rid, path, 'duplicate')
+        return entries
+
+
+class MappingRebuildResult(object):
+    """Provide the result of rebuilding a mapping of the catalog."""
+
+    def __init__(self, mapping, sample_size=10):
+        self.mapping = mapping
+        self.sample_size = sample_size
+        self.length = 0
+        # `(rid, path, reason)` tuples
+        self.skipped = []
+
+    def report_skipped(self, rid, path, reason):
+        self.skipped.append((rid, path, reason))
+
+    def write_result(self, formatter):
+        """Log result to logger."""
+
+        source = 'paths' if self.mapping == 'uids' else 'uids'
+        formatter.info("Rebuilt {} from {}, catalog length is {}.".format(
+            self.mapping, source, self.length))
+        if not self.skipped:
+            return
+
+        formatter.info("Skipped {} entries:".format(len(self.skipped)))
+        for rid, path, reason in sorted(self.skipped)[:self.sample_size]:
+            formatter.info(" rid {} ('{}'): {}".format(rid, path, reason))
+        remaining = len(self.skipped) - self.sample_size
+        if remaining > 0:
+            formatter.info(' ... and {} more'.format(remaining))
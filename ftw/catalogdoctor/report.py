@@ -0,0 +1,102 @@
+from ftw.catalogdoctor.healthcheck import symptoms_from_mask
+
+
+class SymptomGroup(object):
+    """The unhealthy rids sharing the same combination of symptoms."""
+
+    def __init__(self, symptoms_mask, index_symptoms=()):
+        self.symptoms_mask = symptoms_mask
+        self.index_symptoms = index_symptoms
+        self.rids = []
+
+    @property
+    def symptoms(self):
+        return symptoms_from_mask(self.symptoms_mask)
+
+    def get_symptom_names(self):
+        """Return catalog and index symptoms as strings."""
+
+        return self.symptoms + tuple(
+            '{}: {}'.format(index_name, name)
+            for index_name, name in self.index_symptoms)
+
+    def __len__(self):
+        return len(self.rids)
+
+
+class AggregatedReport(object):
+    """Report a health check result grouped by symptoms.
+
+    Writing each unhealthy rid of a badly corrupted catalog produces
+    unreadable output. Unhealthy rids are grouped by their sorted symptom
+    tuple instead, which is also what surgeries are chosen by. For each group
+    the number of rids and a bounded sample of them is reported, largest
+    groups first.
+
+    Optionally all unhealthy rids are written to a details file, one
+    tab-separated line of rid, paths and symptoms per rid. The file is
+    written group by group, without materializing the lines in memory.
+    """
+    def __init__(self, result, sample_size=5, details_path=None):
+        self.result = result
+        self.sample_size = sample_size
+        self.details_path = details_path
+
+    def get_groups(self):
+        """Return the symptom groups, largest groups first."""
+
+        groups = dict()
+        for unhealthy_rid in self.result.get_unhealthy_rids():
+            key = (unhealthy_rid.symptoms_mask, unhealthy_rid.index_symptoms)
+            if key not in groups:
+                groups[key] = SymptomGroup(*key)
+            groups[key].rids.append(unhealthy_rid.rid)
+
+        for group in groups.values():
+            group.rids.sort()
+        return sorted(groups.values(),
+                      key=lambda group: (-len(group), group.symptoms,
+                                         group.index_symptoms))
+
+    def write_result(self, formatter):
+        """Log result to logger."""
+
+        formatter.info("Catalog health check report:")
+        self.result.write_length_result(formatter)
+
+        if self.result.is_catalog_data_healthy():
+            formatter.info("Catalog data is healthy.")
+            return
+
+        groups = self.get_groups()
+        formatter.info(
+            "Catalog data is unhealthy, found {} unhealthy rids in {} symptom "
+            "groups:".format(len(self.result.unhealthy_rids), len(groups)))
+        for group in groups:
+            self.write_group(formatter, group)
+
+        if self.details_path:
+            self.write_details(groups)
+            formatter.info(
+                "Details of all unhealthy rids have been written to {}."
+                .format(self.details_path))
+
+    def write_group(self, formatter, group):
+        formatter.info("{} rids with symptoms:".format(len(group)))
+        for symptom in group.get_symptom_names():
+            formatter.info('\t- {}'.format(symptom))
+        for rid in group.rids[:self.sample_size]:
+            formatter.info(' {}'.format(self.result.unhealthy_rids[rid]))
+        remaining = len(group) - self.sample_size
+        if remaining > 0:
+            formatter.info(' ... and {} more'.format(remaining))
+        formatter.info('')
+
+    def write_details(self, groups):
+        with open(self.details_path, 'w') as details_file:
+            for group in groups:
+                symptoms = ', '.join(group.get_symptom_names())
+                for rid in group.rids:
+                    unhealthy_rid = self.result.unhealthy_rids[rid]
+                    details_file.write('{}\t{}\t{}\n'.format(
+                        rid, ', '.join(unhealthy_rid.paths), symptoms))
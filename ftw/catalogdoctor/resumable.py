@@ -0,0 +1,156 @@
+from ftw.catalogdoctor.exceptions import TimeBudgetExceeded
+from ftw.catalogdoctor.healthcheck import CatalogHealthCheck
+from ftw.catalogdoctor.healthcheck import CatalogRids
+from ftw.catalogdoctor.healthcheck import HealthCheckResult
+from ftw.catalogdoctor.utils import iter_chunked
+from ftw.catalogdoctor.utils import MISSING
+import os
+import pickle
+import time
+
+
+CURSOR_VERSION = 1
+
+
+class ResumableHealthCheck(CatalogHealthCheck):
+    """Run the health check across several invocations with limited time.
+
+    The health check streams through the catalog in chunks. Once the time
+    budget is used up it stops at the next chunk boundary, i.e. after a rid
+    or a path, and stores a cursor in a file. The cursor contains the step
+    and the last key checked by that step, as well as all partial results.
+    It is also stored regularly, a killed process only loses the progress
+    made since. The next invocation continues from the cursor.
+
+    All invocations inspect the catalog as of the last transaction committed
+    before the first invocation, via a historical database connection. The
+    final result is thus identical to the result of a single uninterrupted
+    run, even if the catalog is modified in between. The storage must not be
+    packed meanwhile.
+    """
+    default_chunk_size = 1000
+    save_interval = 60
+
+    def __init__(self, cursor_path, time_budget=None, catalog=None,
+                 chunk_size=None):
+        super(ResumableHealthCheck, self).__init__(
+            catalog=catalog, chunk_size=chunk_size or self.default_chunk_size)
+        self.cursor_path = cursor_path
+        self.time_budget = time_budget
+        self.cursor = None
+        self.result = None
+        self.deadline = None
+        self.last_saved = None
+        self.steps = 0
+
+    def run(self):
+        """Return the result, or `None` if the health check ran out of time
+        before it could be completed.
+        """
+        self.cursor = self.load_cursor() or self.create_cursor()
+        started = time.time()
+        if self.time_budget:
+            self.deadline = started + self.time_budget
+        self.last_saved = started
+        self.steps = 0
+
+        self.result = HealthCheckResult(self.catalog)
+        self.result.merge_unhealthy_rids(self.cursor['unhealthy_rids'])
+
+        catalog = self.catalog
+        connection = catalog._p_jar.db().open(at=self.cursor['tid'])
+        self.catalog = connection.get(catalog._p_oid)
+        try:
+            self.check(self.result)
+        except TimeBudgetExceeded:
+            self.save_cursor()
+            return None
+        finally:
+            self.catalog = catalog
+            connection.close()
+
+        if os.path.exists(self.cursor_path):
+            os.remove(self.cursor_path)
+        return self.result
+
+    def create_cursor(self):
+        return {
+            'version': CURSOR_VERSION,
+            'catalog': self.catalog._p_oid,
+            'tid': self.catalog._p_jar.db().storage.lastTransaction(),
+            'step': 0,
+            'last_key': MISSING,
+            'rids': CatalogRids(),
+            'mismatching_paths': set(),
+            'unhealthy_rids': [],
+        }
+
+    def load_cursor(self):
+        """Return the stored cursor if it belongs to the catalog."""
+
+        if not os.path.exists(self.cursor_path):
+            return None
+
+        with open(self.cursor_path, 'rb') as cursor_file:
+            try:
+                cursor = pickle.load(cursor_file)
+            except Exception:
+                return None
+
+        if (not isinstance(cursor, dict)
+                or cursor.get('version') != CURSOR_VERSION
+                or cursor['catalog'] != self.catalog._p_oid):
+            return None
+        return cursor
+
+    def save_cursor(self):
+        self.cursor['unhealthy_rids'] = list(self.result.get_unhealthy_rids())
+
+        # write a new file first, never leave a truncated cursor
+        temp_path = self.cursor_path + '.tmp'
+        with open(temp_path, 'wb') as cursor_file:
+            pickle.dump(self.cursor, cursor_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self.cursor_path)
+        self.last_saved = time.time()
+
+    def collect_rids(self):
+        rids = self.cursor['rids']
+        rids.collect(self.catalog, self.iter_items)
+        return rids
+
+    def check_rids(self, result, symptoms, mismatching_paths=None):
+        return super(ResumableHealthCheck, self).check_rids(
+            result, symptoms, self.cursor['mismatching_paths'])
+
+    def iter_chunked(self, items_after):
+        """Iterate over the items of the next step.
+
+        Each iteration over a BTree is a step, steps are always run in the
+        same order. Steps completed by an earlier invocation are skipped, the
+        step the cursor points to continues after its last key.
+        """
+        step = self.steps
+        self.steps += 1
+        if step < self.cursor['step']:
+            return iter(())
+        if step > self.cursor['step']:
+            self.cursor['step'] = step
+            self.cursor['last_key'] = MISSING
+        return self.iter_step(items_after)
+
+    def iter_step(self, items_after):
+        for key, value in iter_chunked(
+                items_after, self.chunk_size, self.end_chunk,
+                after=self.cursor['last_key']):
+            yield key, value
+            # resumed by the caller only once it is done with the item
+            self.cursor['last_key'] = key
+
+    def end_chunk(self):
+        self.release_memory()
+
+        now = time.time()
+        if self.deadline is not None and now >= self.deadline:
+            raise TimeBudgetExceeded()
+        if now - self.last_saved >= self.save_interval:
+            self.save_cursor()
@@ -0,0 +1,180 @@
+from ftw.catalogdoctor.healthcheck import TargetedHealthCheck
+from math import sqrt
+from plone import api
+import random
+
+
+def wilson_interval(successes, trials, z=1.96):
+    """Return the Wilson score interval of a binomial proportion.
+
+    Unlike the normal approximation the interval is meaningful for small
+    proportions, e.g. it has a positive upper bound when no successes have
+    been observed.
+    """
+    if not trials:
+        return 0.0, 1.0
+
+    proportion = float(successes) / trials
+    denominator = 1 + z * z / trials
+    center = (proportion + z * z / (2 * trials)) / denominator
+    margin = z * sqrt(
+        proportion * (1 - proportion) / trials
+        + z * z / (4 * trials * trials)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def sample_key(tree, random):
+    """Return a key drawn uniformly at random from a non-empty BTree.
+
+    Descends from the root to a bucket choosing children at random and picks
+    a random key from that bucket. Only the nodes on that path are loaded.
+    Keys in sparsely filled nodes and buckets would be picked more often,
+    this is compensated by acceptance-rejection sampling: a descent is only
+    accepted with a probability proportional to the size of the nodes and
+    the bucket passed, relative to their maximum size.
+
+    Seeking a random key in the key space is not uniform for rids, the
+    catalog assigns them in consecutive runs from random starting points.
+    """
+    max_internal_size = getattr(tree, 'max_internal_size', 500)
+    max_leaf_size = getattr(tree, 'max_leaf_size', 60)
+
+    if len(tree.__getstate__()) < 2:
+        return random.choice(tree.keys())  # single inline bucket
+
+    while True:
+        children = tree.__getstate__()[0][0::2]
+        # all descents pass the root, it does not affect uniformity
+        acceptance = 1.0
+        node = random.choice(children)
+        while isinstance(node, type(tree)):
+            children = node.__getstate__()[0][0::2]
+            acceptance *= float(len(children)) / max_internal_size
+            node = random.choice(children)
+
+        keys = node.keys()
+        acceptance *= float(len(keys)) / max_leaf_size
+        if random.random() < acceptance:
+            return random.choice(keys)
+
+
+class SamplingHealthCheck(object):
+    """Estimate the share of unhealthy rids from random samples of rids.
+
+    Rids are drawn uniformly by random descents into each of the rid-keyed
+    data structures of the catalog: `paths`, metadata and the `UID` index'
+    `_unindex`, see `sample_key`. Each of them is sampled separately, this
+    also finds rids missing from the others. Each sampled rid is checked in
+    both directions by a `TargetedHealthCheck`.
+
+    Entries in `uids` or in the `UID` index' forward index pointing to a
+    sampled rid are only found via the rid's own path and uuid. Rids that are
+    present in `uids` only are never sampled. The full health check is
+    required to find all problems, the samples only help to decide whether
+    running it is necessary.
+    """
+    def __init__(self, catalog=None, sample_size=1000, z=1.96, seed=None):
+        self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
+        self.catalog = self.portal_catalog._catalog
+        self.sample_size = sample_size
+        self.z = z
+        self.random = random.Random(seed)
+
+    def get_sampled_trees(self):
+        uuid_index = self.catalog.indexes['UID']
+        return (
+            ('paths', self.catalog.paths),
+            ('metadata', self.catalog.data),
+            ('uid index unindex', uuid_index._unindex),
+        )
+
+    def draw_rids(self, tree, size):
+        if not tree:
+            return []
+        return [sample_key(tree, self.random) for draw in range(size)]
+
+    def run(self):
+        trees = self.get_sampled_trees()
+        size = self.sample_size // len(trees)
+        drawn = [(name, self.draw_rids(tree, size)) for name, tree in trees]
+
+        targeted_result = TargetedHealthCheck(
+            catalog=self.portal_catalog,
+            rids=[rid for name, rids in drawn for rid in rids]).run()
+
+        result = SamplingResult(len(self.catalog), z=self.z)
+        for name, rids in drawn:
+            sample = result.add_sample(name)
+            for rid in rids:
+                result.report_sampled_rid(
+                    sample, targeted_result.unhealthy_rids.get(rid))
+        return result
+
+
+class Sample(object):
+    """The rids drawn from one data structure."""
+
+    def __init__(self, name, z=1.96):
+        self.name = name
+        self.z = z
+        self.size = 0
+        self.unhealthy = 0
+
+    def get_estimated_rate(self):
+        if not self.size:
+            return 0.0
+        return float(self.unhealthy) / self.size
+
+    def get_confidence_interval(self):
+        return wilson_interval(self.unhealthy, self.size, z=self.z)
+
+
+class SamplingResult(object):
+    """Provide the result of one sampling health check run."""
+
+    def __init__(self, population, z=1.96):
+        self.population = population
+        self.z = z
+        self.samples = []
+        self.unhealthy_rids = dict()
+
+    def add_sample(self, name):
+        sample = Sample(name, z=self.z)
+        self.samples.append(sample)
+        return sample
+
+    def report_sampled_rid(self, sample, unhealthy_rid):
+        """Report one draw, `unhealthy_rid` is `None` for healthy rids."""
+
+        sample.size += 1
+        if unhealthy_rid is not None:
+            sample.unhealthy += 1
+            self.unhealthy_rids[unhealthy_rid.rid] = unhealthy_rid
+
+    def is_healthy(self):
+        """Return whether no unhealthy rid has been sampled."""
+
+        return not self.unhealthy_rids
+
+    def write_result(self, formatter):
+        """Log result to logger."""
+
+        formatter.info("Catalog sampling report:")
+        formatter.info(" claimed length: {}".format(self.population))
+        for sample in self.samples:
+            lower, upper = sample.get_confidence_interval()
+            formatter.info(
+                " {}: {} of {} sampled rids unhealthy, estimated rate "
+                "{:.2%} (confidence interval {:.2%} to {:.2%}).".format(
+                    sample.name, sample.unhealthy, sample.size,
+                    sample.get_estimated_rate(), lower, upper))
+
+        if self.is_healthy():
+            formatter.info("No unhealthy rids found in samples.")
+        else:
+            formatter.info(
+                "Found {} unhealthy rids in samples:".format(
+                    len(self.unhealthy_rids)))
+            for unhealthy_rid in self.unhealthy_rids.values():
+                unhealthy_rid.write_result(formatter)
+                formatter.info('')
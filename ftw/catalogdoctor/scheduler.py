@@ -1,38 +1,190 @@
+from ftw.catalogdoctor.compat import processQueue
+from ftw.catalogdoctor.healthcheck import TargetedHealthCheck
+from ftw.catalogdoctor.lengths import LengthRepair
 from ftw.catalogdoctor.surgery import CatalogDoctor
+from ftw.catalogdoctor.surgery import KeyLookup
 from plone import api
+from ZODB.POSException import ConflictError
+import os
+import pickle
+import transaction
+
+
+PROGRESS_VERSION = 1
 
 
 class SurgeryScheduler(object):
-    """Performs surgeries based on a healthcheck result."""
+    """Performs surgeries based on a healthcheck result.
+
+    The keys of forward indexes pointing to the rids of all surgeries are
+    looked up in one pass per forward index, see `KeyLookup`.
+
+    The rids and paths touched by surgeries and post-ops are recorded, after
+    surgery only these have to be verified, see `verify`.
+
+    Post-ops of all surgeries are performed together, objects are reindexed
+    sorted by path and the indexing queue is processed once per
+    `post_op_batch_size` objects.
+    """
+    post_op_batch_size = 100
 
     def __init__(self, healtcheck, catalog=None):
         self.healtcheck = healtcheck
         self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
         self.catalog = self.portal_catalog._catalog
+        self.lookup = KeyLookup()
         self.doctors = [
-            CatalogDoctor(self.catalog, unhealthy_rid)
+            CatalogDoctor(self.catalog, unhealthy_rid, lookup=self.lookup)
             for unhealthy_rid in self.healtcheck.get_unhealthy_rids()
         ]
+        self.lookup.schedule(
+            doctor.unhealthy_rid.rid for doctor in self.doctors
+            if doctor.can_perform_surgery())
+        self.touched_rids = set()
+        self.touched_paths = set()
+        # entries of the touched rids and paths before they were changed,
+        # see `count_entries`
+        self.entries_before = (0, 0, 0, 0)
+        self.uuid_index_length_before = None
 
-    def perform_surgeries(self):
-        for doctor in self.doctors:
+    def get_treatable_doctors(self):
+        return [doctor for doctor in self.doctors
+                if doctor.can_perform_surgery()]
+
+    def perform_surgeries(self, savepoint_interval=None):
+        """Perform all surgeries, then all post-ops.
+
+        If `savepoint_interval` is provided a savepoint is created after that
+        many surgeries, it allows to free memory used by changed objects.
+        """
+        doctors = self.get_treatable_doctors()
+        self.uuid_index_length_before = len(self.catalog.indexes['UID'])
+        self.touch(
+            [doctor.unhealthy_rid.rid for doctor in doctors],
+            [path for doctor in doctors
+             for path in doctor.unhealthy_rid.paths])
+
+        for position, doctor in enumerate(self.doctors, 1):
             doctor.perform_surgery()
+            if savepoint_interval and position % savepoint_interval == 0:
+                transaction.savepoint(optimistic=True)
 
-        for doctor in self.doctors:
-            doctor.perform_post_op()
+        self.perform_post_ops()
+
+    def get_objects_to_reindex(self):
+        """Return `(path, surgery, obj)` tuples sorted by path.
+
+        Objects close to each other in the content tree are likely stored
+        close to each other in the database.
+        """
+        to_reindex = []
+        for doctor in self.get_treatable_doctors():
+            for obj in doctor.surgery.to_reindex:
+                path = '/'.join(obj.getPhysicalPath())
+                to_reindex.append((path, doctor.surgery, obj))
+        return sorted(to_reindex, key=lambda item: item[0])
+
+    def perform_post_ops(self):
+        to_reindex = self.get_objects_to_reindex()
+
+        # surgeries don't change the entries of other objects than their own,
+        # objects reindexed by post-ops are touched from here on.
+        self.touch([], [path for path, surgery, obj in to_reindex])
+
+        for position, (path, surgery, obj) in enumerate(to_reindex, 1):
+            surgery.reindex_object(obj)
+            if position % self.post_op_batch_size == 0:
+                processQueue()
+        processQueue()
+
+    def touch(self, rids, paths):
+        """Record rids and paths as touched before their entries are changed.
+
+        The rids the paths point to in `uids` are touched as well.
+        """
+        uids = self.catalog.uids
+        paths = set(paths) - self.touched_paths
+        rids = set(rids)
+        rids.update(uids[path] for path in paths if path in uids)
+        rids -= self.touched_rids
+
+        self.entries_before = tuple(
+            before + count for before, count in
+            zip(self.entries_before, self.count_entries(rids, paths)))
+        self.touched_rids.update(rids)
+        self.touched_paths.update(paths)
+
+    def count_entries(self, rids, paths):
+        """Count the entries of paths in `uids` and of rids in `paths`,
+        `data` and the `UID` index' reverse index.
+        """
+        uuid_unindex = self.catalog.indexes['UID']._unindex
+        return (
+            sum(1 for path in paths if path in self.catalog.uids),
+            sum(1 for rid in rids if rid in self.catalog.paths),
+            sum(1 for rid in rids if rid in self.catalog.data),
+            sum(1 for rid in rids if rid in uuid_unindex),
+        )
+
+    def verify(self):
+        """Run the health check for the rids and paths touched by surgery.
+
+        Call after the indexing queue has been processed. Objects reindexed
+        by post-ops may have been assigned new rids, they are found via
+        their paths.
+
+        If the healthcheck result the surgeries are based on reports the
+        catalog's length, the lengths after surgery are derived from it and
+        from the changes to the touched entries. The `UID` index' forward
+        index is only changed along with its length counter, its change is
+        taken from the counter.
+        """
+        uids = self.catalog.uids
+        new_rids = set(
+            uids[path] for path in self.touched_paths if path in uids)
+        rids = self.touched_rids | new_rids
+
+        result = TargetedHealthCheck(
+            catalog=self.portal_catalog, rids=rids,
+            paths=self.touched_paths).run()
+        if self.healtcheck.claimed_length is not None:
+            self.report_catalog_stats(result, rids)
+        return result
+
+    def report_catalog_stats(self, result, rids):
+        uuid_index = self.catalog.indexes['UID']
+        entries = self.count_entries(rids, self.touched_paths)
+        uids_length, paths_length, data_length, uuid_unindex_length = (
+            length + after - before for length, after, before in zip(
+                (self.healtcheck.uids_length,
+                 self.healtcheck.paths_length,
+                 self.healtcheck.data_length,
+                 self.healtcheck.uuid_index_unindex_length),
+                entries, self.entries_before))
+        uuid_index_length = (
+            self.healtcheck.uuid_index_index_length
+            + len(uuid_index) - self.uuid_index_length_before)
+
+        result.report_catalog_stats(
+            len(self.catalog), uids_length, paths_length, data_length,
+            len(uuid_index), uuid_index_length, uuid_unindex_length)
 
     def is_successful(self):
         return all(doctor.can_perform_surgery() for doctor in self.doctors)
 
+    def get_untreatable_rids(self):
+        return [doctor.unhealthy_rid for doctor in self.doctors
+                if not doctor.can_perform_surgery()]
+
     def write_result(self, formatter):
-        there_is_nothing_we_can_do = []
         for doctor in self.doctors:
             if doctor.can_perform_surgery():
                 doctor.write_result(formatter)
                 formatter.info('')
-            else:
-                there_is_nothing_we_can_do.append(doctor.unhealthy_rid)
+        self.write_untreatable_result(formatter)
 
+    def write_untreatable_result(self, formatter):
+        there_is_nothing_we_can_do = self.get_untreatable_rids()
         if there_is_nothing_we_can_do:
             formatter.info('The following unhealthy rids could not be fixed:')
             for unhealthy_rid in there_is_nothing_we_can_do:
@@ -40,3 +192,212 @@ class SurgeryScheduler(object):
                 formatter.info('')
 
             formatter.info('Not all health problems could be fixed, aborting.')
+
+
+class BatchedSurgery(object):
+    """Perform surgeries in batches, committing each batch separately.
+
+    Performing all surgeries in one transaction makes the transaction grow
+    without bound and on a live site it is likely to conflict with other
+    transactions. Instead the unhealthy rids are treated in batches:
+    - the current symptoms of the batch' rids are determined by a
+      `TargetedHealthCheck`, rids fixed meanwhile are skipped
+    - surgeries and post-ops are performed for the batch
+    - the touched rids are verified by another `TargetedHealthCheck`
+    - the batch is committed, the batch is retried on conflicts
+
+    The rids and paths touched by all batches are recorded, `verify` checks
+    them again once all batches have been treated. It also counts the
+    catalog's mappings and the `UID` index like the full health check does,
+    in chunks of `chunk_size` keys if set, surgery can't fix length counters
+    that disagree with them.
+
+    After each commit the unhealthy rids still to be treated are stored in a
+    progress file. When a surgery is interrupted it is resumed from there
+    instead of starting over with a full healthcheck. With `dryrun` nothing
+    is committed and no progress is stored, treated batches are kept in
+    savepoints.
+    """
+    max_attempts = 3
+
+    def __init__(self, catalog=None, batch_size=100, progress_path=None,
+                 savepoint_interval=None, dryrun=False, chunk_size=None):
+        self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
+        self.catalog = self.portal_catalog._catalog
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.progress_path = progress_path
+        self.savepoint_interval = savepoint_interval
+        self.dryrun = dryrun
+        self.treated = 0
+        self.touched_rids = set()
+        self.touched_paths = set()
+
+    def load_progress(self):
+        """Return the unhealthy rids still to be treated by an interrupted
+        surgery of the catalog, or `None`.
+        """
+        if not self.progress_path or not os.path.exists(self.progress_path):
+            return None
+
+        with open(self.progress_path, 'rb') as progress_file:
+            try:
+                progress = pickle.load(progress_file)
+            except Exception:
+                return None
+
+        if (not isinstance(progress, dict)
+                or progress.get('version') != PROGRESS_VERSION
+                or progress['catalog'] != self.catalog._p_oid):
+            return None
+        return progress['unhealthy_rids']
+
+    def save_progress(self, unhealthy_rids):
+        if not self.progress_path or self.dryrun:
+            return
+
+        progress = {
+            'version': PROGRESS_VERSION,
+            'catalog': self.catalog._p_oid,
+            'unhealthy_rids': list(unhealthy_rids),
+        }
+        # write a new file first, never leave a truncated progress file
+        temp_path = self.progress_path + '.tmp'
+        with open(temp_path, 'wb') as progress_file:
+            pickle.dump(progress, progress_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self.progress_path)
+
+    def remove_progress(self):
+        if not self.progress_path or self.dryrun:
+            return
+
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+
+    def run(self, unhealthy_rids, formatter):
+        """Treat unhealthy rids batch by batch.
+
+        Return whether all batches could be treated successfully. Stops at
+        the first batch that can't be treated, it is aborted and remains in
+        the progress file.
+        """
+        remaining = list(unhealthy_rids)
+        self.save_progress(remaining)
+        while remaining:
+            batch = remaining[:self.batch_size]
+            if not self.run_batch(batch, formatter):
+                return False
+
+            remaining = remaining[self.batch_size:]
+            self.save_progress(remaining)
+            formatter.info('Treated {} unhealthy rids, {} remaining.'.format(
+                self.treated, len(remaining)))
+            formatter.info('')
+
+        self.remove_progress()
+        return True
+
+    def run_batch(self, batch, formatter):
+        for attempt in range(1, self.max_attempts + 1):
+            savepoint = self.begin()
+            try:
+                if not self.perform_batch(batch, formatter):
+                    self.discard(savepoint)
+                    return False
+                self.commit()
+                return True
+            except ConflictError:
+                self.discard(savepoint)
+                if attempt == self.max_attempts:
+                    raise
+                formatter.info('Conflict while treating batch, retrying.')
+
+    def begin(self):
+        """Return a savepoint to discard the batch to in dryrun.
+
+        In dryrun the treated batches are only kept in savepoints, aborting
+        the transaction would discard them too.
+        """
+        if self.dryrun:
+            return transaction.savepoint(optimistic=True)
+        return None
+
+    def discard(self, savepoint):
+        if savepoint is None:
+            transaction.abort()
+        else:
+            savepoint.rollback()
+            transaction.doom()  # extra paranoia, prevent erroneous commit
+
+    def perform_batch(self, batch, formatter):
+        rids = [unhealthy_rid.rid for unhealthy_rid in batch]
+        paths = set(path for unhealthy_rid in batch
+                    for path in unhealthy_rid.paths)
+
+        current_result = TargetedHealthCheck(
+            catalog=self.portal_catalog, rids=rids, paths=paths).run()
+        # index data is not validated by the targeted health check, keep the
+        # index symptoms of the rids that are still unhealthy
+        for unhealthy_rid in batch:
+            if unhealthy_rid.rid not in current_result.unhealthy_rids:
+                continue
+            for index_name, name in unhealthy_rid.index_symptoms:
+                current_result.report_index_symptom(
+                    index_name, name, unhealthy_rid.rid)
+
+        scheduler = SurgeryScheduler(
+            current_result, catalog=self.portal_catalog)
+        if not scheduler.is_successful():
+            scheduler.write_untreatable_result(formatter)
+            return False
+
+        scheduler.perform_surgeries(savepoint_interval=self.savepoint_interval)
+        scheduler.write_result(formatter)
+        processQueue()
+
+        verification = scheduler.verify()
+        if not verification.is_catalog_data_healthy():
+            formatter.info('Not all health problems of the batch could be '
+                           'fixed, aborting:')
+            for unhealthy_rid in verification.get_unhealthy_rids():
+                unhealthy_rid.write_result(formatter)
+            return False
+
+        self.treated += len(scheduler.doctors)
+        self.touched_rids.update(scheduler.touched_rids)
+        self.touched_paths.update(scheduler.touched_paths)
+        return True
+
+    def verify(self):
+        """Run the health check for the rids and paths touched by all
+        batches.
+
+        Objects reindexed by post-ops may have been assigned new rids, they
+        are found via their paths. The catalog's lengths are checked as
+        well.
+        """
+        uids = self.catalog.uids
+        new_rids = set(
+            uids[path] for path in self.touched_paths if path in uids)
+        result = TargetedHealthCheck(
+            catalog=self.portal_catalog, rids=self.touched_rids | new_rids,
+            paths=self.touched_paths).run()
+        self.report_catalog_stats(result)
+        return result
+
+    def report_catalog_stats(self, result):
+        counter = LengthRepair(
+            catalog=self.portal_catalog, chunk_size=self.chunk_size)
+        uuid_index = self.catalog.indexes['UID']
+        result.report_catalog_stats(
+            len(self.catalog), counter.count(self.catalog.uids),
+            counter.count(self.catalog.paths),
+            counter.count(self.catalog.data), len(uuid_index),
+            counter.count(uuid_index._index),
+            counter.count(uuid_index._unindex))
+
+    def commit(self):
+        if self.dryrun:
+            transaction.savepoint(optimistic=True)
+        else:
+            transaction.commit()
@@ -0,0 +1,215 @@
+from ftw.catalogdoctor.healthcheck import CatalogHealthCheck
+from ftw.catalogdoctor.healthcheck import CatalogRids
+from ftw.catalogdoctor.healthcheck import HealthCheckResult
+from ftw.catalogdoctor.healthcheck import MembershipSymptoms
+from ftw.catalogdoctor.utils import find_key_boundaries
+from ftw.catalogdoctor.utils import split_into_ranges
+from itertools import izip_longest
+import multiprocessing
+
+
+def open_readonly_database():
+    """Open a new read-only instance of the Zope root database.
+
+    Worker processes must not share the storage or the connection of the
+    parent process, each of them opens its own database. It is opened
+    read-only, e.g. to avoid the `FileStorage` lock held by the parent.
+    """
+    from App.config import getConfiguration
+
+    dbtab = getConfiguration().dbtab
+    name = dbtab.getName('/')
+    factory = dbtab.getDatabaseFactory(name=name)
+    factory.config.storage.config.read_only = True
+    return factory.open(name, {})
+
+
+class Shard(object):
+    """The key ranges of the catalog's data structures checked by one worker.
+
+    Each range is an `(after, until)` tuple, see `items_after`. Rid-keyed data
+    structures are split by `rid_range`, `uids` by `path_range` and the `UID`
+    index' forward index by `uuid_range`. A range of `None` matches no keys.
+    """
+    def __init__(self, rid_range, path_range, uuid_range):
+        self.rid_range = rid_range
+        self.path_range = path_range
+        self.uuid_range = uuid_range
+
+
+class HealthCheckShard(CatalogHealthCheck):
+    """Health check restricted to the key ranges of one shard."""
+
+    def __init__(self, catalog, shard, chunk_size=None):
+        super(HealthCheckShard, self).__init__(
+            catalog=catalog, chunk_size=chunk_size)
+        self.shard = shard
+
+    def get_key_range(self, tree):
+        if tree is self.catalog.uids:
+            return self.shard.path_range
+        if tree is self.catalog.indexes['UID']._index:
+            return self.shard.uuid_range
+        return self.shard.rid_range
+
+    def items_after(self, tree, key):
+        if self.get_key_range(tree) is None:
+            return iter(())
+        return super(HealthCheckShard, self).items_after(tree, key)
+
+    def collect_rids(self):
+        return CatalogRids(self.catalog, iter_items=self.iter_items)
+
+
+def collect_shard_rids(portal_catalog, shard, chunk_size):
+    return HealthCheckShard(portal_catalog, shard, chunk_size).collect_rids()
+
+
+def check_shard_rids(portal_catalog, shard, chunk_size, symptoms):
+    healthcheck = HealthCheckShard(portal_catalog, shard, chunk_size)
+    result = HealthCheckResult(healthcheck.catalog)
+    mismatching_paths = healthcheck.check_rids(result, symptoms)
+    return list(result.get_unhealthy_rids()), mismatching_paths
+
+
+def check_shard_uids(portal_catalog, shard, chunk_size, symptoms,
+                     mismatching_paths):
+    healthcheck = HealthCheckShard(portal_catalog, shard, chunk_size)
+    result = HealthCheckResult(healthcheck.catalog)
+    healthcheck.check_uids(result, symptoms, mismatching_paths)
+    healthcheck.check_uuid_index(result)
+    return list(result.get_unhealthy_rids())
+
+
+_worker = {}
+
+
+def _init_worker(catalog_path, open_database, tid=None):
+    _worker['catalog_path'] = catalog_path
+    _worker['open_database'] = open_database
+    _worker['tid'] = tid
+
+
+def _get_worker_catalog():
+    """Return portal_catalog from the worker's own database connection.
+
+    The database is opened lazily by the first task, errors raised by a pool
+    initializer would make the pool restart its workers forever. With a `tid`
+    the connection is pinned to the state as of that transaction.
+    """
+    if 'portal_catalog' not in _worker:
+        connection = _worker['open_database']().open(at=_worker['tid'])
+        app = connection.root()['Application']
+        _worker['portal_catalog'] = app.unrestrictedTraverse(
+            _worker['catalog_path'])
+    return _worker['portal_catalog']
+
+
+def _run_in_worker(task):
+    func, shard, args = task
+    return func(_get_worker_catalog(), shard, *args)
+
+
+class ShardedHealthCheck(CatalogHealthCheck):
+    """Run the health check in several worker processes.
+
+    The key space of each data structure is split into ranges, one range per
+    data structure makes up a shard. Each worker process opens its own
+    database connection and checks the shards assigned to it. Checks that
+    need knowledge about the whole catalog are split into stages, only small
+    sets are exchanged between them:
+    - workers collect the rids of their shard as `CatalogRids`, the parent
+      merges them and computes `MembershipSymptoms` for the whole catalog
+    - workers check the rid-keyed data structures and return the paths whose
+      `uids` entry points to a different rid
+    - workers check `uids` and the `UID` index' forward index
+
+    The workers and the current process read the catalog as of the latest
+    transaction committed when the health check is started, their
+    connections are pinned to its tid. With less than two processes all
+    shards are checked in the current process.
+    """
+    shards_per_process = 4
+
+    def __init__(self, catalog=None, processes=None, chunk_size=None,
+                 open_database=open_readonly_database, check_indexes=False):
+        super(ShardedHealthCheck, self).__init__(
+            catalog=catalog, chunk_size=chunk_size,
+            check_indexes=check_indexes)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.open_database = open_database
+        self.pool = None
+
+    def get_shards(self):
+        count = self.processes * self.shards_per_process
+        rid_ranges = split_into_ranges(
+            find_key_boundaries(self.catalog.paths, count))
+        path_ranges = split_into_ranges(
+            find_key_boundaries(self.catalog.uids, count))
+        uuid_ranges = split_into_ranges(
+            find_key_boundaries(self.catalog.indexes['UID']._index, count))
+
+        # key spaces split into fewer ranges get no range in the last shards
+        return [
+            Shard(*ranges) for ranges in izip_longest(
+                rid_ranges, path_ranges, uuid_ranges)
+        ]
+
+    def map(self, func, shards, *args):
+        args = (self.chunk_size,) + args
+        if self.pool is None:
+            return [func(self.portal_catalog, shard, *args)
+                    for shard in shards]
+        return self.pool.map(
+            _run_in_worker, [(func, shard, args) for shard in shards])
+
+    def run(self):
+        if self.processes <= 1:
+            return self.run_shards(self.get_shards())
+
+        portal_catalog = self.portal_catalog
+        catalog_path = '/'.join(portal_catalog.getPhysicalPath())
+        db = portal_catalog._p_jar.db()
+        tid = db.storage.lastTransaction()
+        connection = db.open(at=tid)
+        self.portal_catalog = connection.get(portal_catalog._p_oid)
+        self.catalog = self.portal_catalog._catalog
+        self.pool = multiprocessing.Pool(
+            self.processes, initializer=_init_worker,
+            initargs=(catalog_path, self.open_database, tid))
+        try:
+            result = self.run_shards(self.get_shards())
+            result.catalog = portal_catalog._catalog
+            return result
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.portal_catalog = portal_catalog
+            self.catalog = portal_catalog._catalog
+            connection.close()
+
+    def run_shards(self, shards):
+        result = HealthCheckResult(self.catalog)
+
+        rids = CatalogRids.merge(self.map(collect_shard_rids, shards))
+        self.report_catalog_stats(result, rids)
+
+        symptoms = MembershipSymptoms(rids)
+        self.report_membership_symptoms(result, symptoms)
+
+        mismatching_paths = set()
+        for unhealthy_rids, paths in self.map(
+                check_shard_rids, shards, symptoms):
+            result.merge_unhealthy_rids(unhealthy_rids)
+            mismatching_paths.update(paths)
+
+        for unhealthy_rids in self.map(
+                check_shard_uids, shards, symptoms, mismatching_paths):
+            result.merge_unhealthy_rids(unhealthy_rids)
+
+        # index data is validated by the current process
+        if self.check_indexes:
+            self.check_index_data(result, rids)
+
+        return result
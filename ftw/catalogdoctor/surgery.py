@@ -1,7 +1,15 @@
+from BTrees.IIBTree import IITreeSet
 from ftw.catalogdoctor.compat import DateRecurringIndex
 from ftw.catalogdoctor.exceptions import CantPerformSurgery
+from ftw.catalogdoctor.indexes import get_parent_path
+from ftw.catalogdoctor.indexes import get_path_entries
+from ftw.catalogdoctor.indexes import split_path
+from ftw.catalogdoctor.utils import contains_or_equals_rid
 from ftw.catalogdoctor.utils import find_keys_pointing_to_rid
+from ftw.catalogdoctor.utils import find_keys_pointing_to_rids
+from ftw.catalogdoctor.utils import find_nested_keys_pointing_to_rids
 from ftw.catalogdoctor.utils import is_shorter_path_to_same_file
+from ftw.catalogdoctor.utils import MISSING
 from plone import api
 from plone.app.folder.nogopip import GopipIndex
 from Products.ExtendedPathIndex.ExtendedPathIndex import ExtendedPathIndex
@@ -14,13 +22,90 @@ from Products.PluginIndexes.UUIDIndex.UUIDIndex import UUIDIndex
 from Products.ZCTextIndex.ZCTextIndex import ZCTextIndex
 
 
-class SurgeryStep(object):
+class KeyLookup(object):
+    """Look up the keys of forward indexes pointing to rids.
+
+    Finding the keys pointing to a rid scans the whole forward index. When
+    many rids are scheduled for surgery, the keys pointing to all of them are
+    found in a single pass when a forward index is looked up for the first
+    time. The keys found for a rid are handed out once, surgery removes them.
+    Rids that have not been scheduled are looked up individually.
+    """
+    def __init__(self, rids=()):
+        self.rids = IITreeSet(rids)
+        self._keys_by_tree = dict()
+
+    def schedule(self, rids):
+        """Schedule rids, before the first lookup."""
+
+        self.rids.update(rids)
 
-    def __init__(self, index, rid):
+    def find_keys_pointing_to_rid(self, tree, rid):
+        if rid not in self.rids:
+            return find_keys_pointing_to_rid(tree, rid)
+        return self._get_keys_by_rid(
+            tree, find_keys_pointing_to_rids).pop(rid, [])
+
+    def find_nested_keys_pointing_to_rid(self, tree, rid):
+        if rid not in self.rids:
+            return find_nested_keys_pointing_to_rids(tree, (rid,)).get(
+                rid, [])
+        return self._get_keys_by_rid(
+            tree, find_nested_keys_pointing_to_rids).pop(rid, [])
+
+    def _get_keys_by_rid(self, tree, find):
+        # keep a reference to the tree so that its id is not reused
+        if id(tree) not in self._keys_by_tree:
+            self._keys_by_tree[id(tree)] = (tree, find(tree, self.rids))
+        return self._keys_by_tree[id(tree)][1]
+
+
+class SurgeryStep(object):
+    """Remove a rid from an index.
+
+    The keys of a forward index pointing to the rid are usually known from
+    the value stored for the rid in the reverse index. These candidate keys
+    are looked up directly. Only if there is no reverse index entry or one of
+    the candidate keys does not point to the rid, the whole forward index is
+    scanned for the rid.
+
+    Keys pointing to the rid that are missing in its reverse index entry are
+    not found via the candidate keys. The healthcheck's index validation
+    detects them by comparing the number of entries of both sides of the
+    index and reports symptoms for the rid. With `scan` set, e.g. because of
+    such symptoms, the whole forward index is always scanned.
+    """
+    def __init__(self, index, rid, lookup=None, scan=False):
         self.index = index
         self.rid = rid
+        self.lookup = lookup or KeyLookup()
+        self.scan = scan
+
+    def _get_unindexed_value(self, unindex):
+        return unindex.get(self.rid, MISSING)
+
+    def _points_to_rid(self, index, key):
+        try:
+            rids_or_rid = index.get(key, ())
+        except TypeError:
+            return False  # a key of the wrong type can't be stored
+        return contains_or_equals_rid(self.rid, rids_or_rid)
+
+    def _find_keys_pointing_to_rid(self, index, candidate_keys=None):
+        """Return all keys pointing to rid from a forward index.
+
+        Return `candidate_keys` if they all point to rid, otherwise scan the
+        forward index. Without candidates or with `scan` set the forward
+        index is scanned.
 
-    def _remove_keys_pointing_to_rid(self, index, linked_length=None):
+        """
+        if not self.scan and candidate_keys is not None and all(
+                self._points_to_rid(index, key) for key in candidate_keys):
+            return list(candidate_keys)
+        return self.lookup.find_keys_pointing_to_rid(index, self.rid)
+
+    def _remove_keys_pointing_to_rid(self, index, linked_length=None,
+                                     candidate_keys=None):
         """Remove all entries pointing to rid from a forward index.
 
         Rows in indices are expected to be a set, e.g. a `TreeSet`. Once the
@@ -29,7 +114,7 @@ class SurgeryStep(object):
         If `linked_length` is provided it is decreased when a row is removed.
 
         """
-        for key in find_keys_pointing_to_rid(index, self.rid):
+        for key in self._find_keys_pointing_to_rid(index, candidate_keys):
             row = index[key]
             row.remove(self.rid)
             if not row:
@@ -57,38 +142,83 @@ class NullStep(SurgeryStep):
 class RemoveFromUUIDIndex(SurgeryStep):
     """Remove rid from a `UUIDIndex`."""
 
-    def _remove_keys_pointing_to_rid(self, index, linked_length=None):
-        for key in find_keys_pointing_to_rid(index, self.rid):
+    def _remove_keys_pointing_to_rid(self, index, linked_length=None,
+                                     candidate_keys=None):
+        for key in self._find_keys_pointing_to_rid(index, candidate_keys):
             del index[key]
             self.index._length.change(-1)
 
     def perform(self):
-        self._remove_keys_pointing_to_rid(self.index._index)
+        uuid = self._get_unindexed_value(self.index._unindex)
+        self._remove_keys_pointing_to_rid(
+            self.index._index,
+            candidate_keys=None if uuid is MISSING else (uuid,))
         self._remove_rid_from_unindex(self.index._unindex)
 
 
 class RemoveFromUnIndex(SurgeryStep):
     """Remove a rid from a simple forward and reverse index."""
 
+    def get_candidate_keys(self):
+        value = self._get_unindexed_value(self.index._unindex)
+        if value is MISSING:
+            return None
+        return self.get_unindexed_keys(value)
+
+    def get_unindexed_keys(self, value):
+        return (value,)
+
     def perform(self):
         self._remove_keys_pointing_to_rid(
-            self.index._index, linked_length=self.index._length)
+            self.index._index, linked_length=self.index._length,
+            candidate_keys=self.get_candidate_keys())
         self._remove_rid_from_unindex(self.index._unindex)
 
 
+class RemoveFromKeywordIndex(RemoveFromUnIndex):
+    """Remove a rid from a forward and reverse index with multiple values
+    per rid.
+    """
+    def get_unindexed_keys(self, value):
+        return value
+
+
 class RemoveFromDateRangeIndex(SurgeryStep):
     """Remove rid from a `DateRangeIndex`."""
 
+    tree_names = ('_since_only', '_until_only', '_since', '_until')
+
+    def get_candidate_keys(self):
+        """Return the candidate keys of each forward index by name."""
+
+        value = self._get_unindexed_value(self.index._unindex)
+        if value is MISSING:
+            return dict.fromkeys(self.tree_names)
+
+        since, until = value
+        always = since is None and until is None
+        if always != (self.rid in self.index._always):
+            return dict.fromkeys(self.tree_names)
+
+        candidate_keys = dict((name, ()) for name in self.tree_names)
+        if since is None and until is not None:
+            candidate_keys['_until_only'] = (until,)
+        elif since is not None and until is None:
+            candidate_keys['_since_only'] = (since,)
+        elif since is not None and until is not None:
+            candidate_keys['_since'] = (since,)
+            candidate_keys['_until'] = (until,)
+        return candidate_keys
+
     def perform(self):
+        candidate_keys = self.get_candidate_keys()
         if self.rid in self.index._always:
             self.index._always.remove(self.rid)
 
-        for index in (
-                self.index._since_only,
-                self.index._until_only,
-                self.index._since,
-                self.index._until):
-            self._remove_keys_pointing_to_rid(index)
+        for name in self.tree_names:
+            self._remove_keys_pointing_to_rid(
+                getattr(self.index, name),
+                candidate_keys=candidate_keys[name])
 
         self._remove_rid_from_unindex(self.index._unindex)
 
@@ -113,14 +243,31 @@ class RemoveFromBooleanIndex(SurgeryStep):
 class RemoveFromExtendedPathIndex(SurgeryStep):
     """Remove rid from a `ExtendedPathIndex`."""
 
+    def get_unindexed_components(self):
+        path = self._get_unindexed_value(self.index._unindex)
+        if not isinstance(path, basestring):
+            return None
+        return split_path(path)
+
+    def _find_components_with_rid(self, components):
+        if not self.scan and components is not None:
+            entries = get_path_entries(components)
+            if all(self._points_to_rid(self.index._index.get(component, {}),
+                                       level)
+                   for component, level in entries):
+                return entries
+        return self.lookup.find_nested_keys_pointing_to_rid(
+            self.index._index, self.rid)
+
     def perform(self):
-        # _index
-        components_with_rid = []
-        for component, level_to_rid in self.index._index.items():
-            for level, rids in level_to_rid.items():
-                if self.rid in rids:
-                    components_with_rid.append((component, level,))
+        components = self.get_unindexed_components()
+        parent_keys = path_keys = None
+        if components is not None:
+            path_keys = ('/' + '/'.join(components),)
+            parent_keys = (get_parent_path(components),)
 
+        # _index
+        components_with_rid = self._find_components_with_rid(components)
         for component, level in components_with_rid:
             self.index._index[component][level].remove(self.rid)
             if not self.index._index[component][level]:
@@ -129,11 +276,13 @@ class RemoveFromExtendedPathIndex(SurgeryStep):
                 del self.index._index[component]
 
         # _index_items
-        for key in find_keys_pointing_to_rid(self.index._index_items, self.rid):
+        for key in self._find_keys_pointing_to_rid(
+                self.index._index_items, candidate_keys=path_keys):
             del self.index._index_items[key]
 
         # _index_parents
-        self._remove_keys_pointing_to_rid(self.index._index_parents)
+        self._remove_keys_pointing_to_rid(
+            self.index._index_parents, candidate_keys=parent_keys)
 
         # _unindex
         if self.rid in self.index._unindex:
@@ -155,18 +304,19 @@ class Surgery(object):
         BooleanIndex: RemoveFromBooleanIndex,
         DateIndex: RemoveFromUnIndex,
         DateRangeIndex: RemoveFromDateRangeIndex,
-        DateRecurringIndex: RemoveFromUnIndex,
+        DateRecurringIndex: RemoveFromKeywordIndex,
         ExtendedPathIndex: RemoveFromExtendedPathIndex,
         FieldIndex: RemoveFromUnIndex,
         GopipIndex: NullStep,  # not a real index
-        KeywordIndex: RemoveFromUnIndex,
+        KeywordIndex: RemoveFromKeywordIndex,
         UUIDIndex: RemoveFromUUIDIndex,
         ZCTextIndex: UnindexObject,
     }
 
-    def __init__(self, catalog, unhealthy_rid):
+    def __init__(self, catalog, unhealthy_rid, lookup=None):
         self.catalog = catalog
         self.unhealthy_rid = unhealthy_rid
+        self.lookup = lookup
         self.surgery_log = []
         self.to_reindex = []
 
@@ -175,19 +325,32 @@ class Surgery(object):
 
     def perform_post_op(self):
         for obj in self.to_reindex:
-            obj.reindexObject()
-            obj_path = '/'.join(obj.getPhysicalPath())
-            self.surgery_log.append("Reindexed object at {}".format(obj_path))
+            self.reindex_object(obj)
+
+    def reindex_object(self, obj):
+        obj.reindexObject()
+        obj_path = '/'.join(obj.getPhysicalPath())
+        self.surgery_log.append("Reindexed object at {}".format(obj_path))
+
+    def get_inconsistent_indexes(self, rid):
+        """Return the names of the indexes with symptoms for rid."""
+
+        if rid != self.unhealthy_rid.rid:
+            return set()
+        return set(index_name for index_name, symptom
+                   in self.unhealthy_rid.index_symptoms)
 
     def unindex_rid_from_all_catalog_indexes(self, rid):
-        for idx in self.catalog.indexes.values():
+        inconsistent_indexes = self.get_inconsistent_indexes(rid)
+        for name, idx in self.catalog.indexes.items():
             surgery_step = self.index_to_step.get(type(idx))
 
             if not surgery_step:
                 raise CantPerformSurgery(
                     'Unhandled index type: {0!r}'.format(idx))
 
-            surgery_step(idx, rid).perform()
+            surgery_step(idx, rid, lookup=self.lookup,
+                         scan=name in inconsistent_indexes).perform()
 
         self.surgery_log.append(
             "Removed rid from all catalog indexes.")
@@ -335,7 +498,6 @@ class RemoveRidOrReindexObject(Surgery):
       acquisition. We can remove the orphaned rid in such cases.
     - The object has not been indexed correctly, in such cases the object can
       be traversed and has to be reindexed in all indexes.
-
     """
     def perform(self):
         rid = self.unhealthy_rid.rid
@@ -438,7 +600,7 @@ class CatalogDoctor(object):
         ): RemoveRidOrReindexObject,
     }
 
-    def __init__(self, catalog, unhealthy_rid):
+    def __init__(self, catalog, unhealthy_rid, lookup=None):
         self.catalog = catalog
         self.unhealthy_rid = unhealthy_rid
 
@@ -446,7 +608,8 @@ class CatalogDoctor(object):
         if not surgery_cls:
             self.surgery = None
         else:
-            self.surgery = surgery_cls(self.catalog, self.unhealthy_rid)
+            self.surgery = surgery_cls(
+                self.catalog, self.unhealthy_rid, lookup=lookup)
 
     def can_perform_surgery(self):
         return bool(self.surgery)
@@ -0,0 +1,287 @@
+from BTrees.IIBTree import difference
+from BTrees.IIBTree import IITreeSet
+from BTrees.IIBTree import union
+from BTrees.Length import Length
+from ftw.catalogdoctor.compat import DateRecurringIndex
+from plone import api
+from plone.app.folder.nogopip import GopipIndex
+from Products.ExtendedPathIndex.ExtendedPathIndex import ExtendedPathIndex
+from Products.PluginIndexes.BooleanIndex.BooleanIndex import BooleanIndex
+from Products.PluginIndexes.DateIndex.DateIndex import DateIndex
+from Products.PluginIndexes.DateRangeIndex.DateRangeIndex import DateRangeIndex
+from Products.PluginIndexes.FieldIndex.FieldIndex import FieldIndex
+from Products.PluginIndexes.KeywordIndex.KeywordIndex import KeywordIndex
+from Products.PluginIndexes.UUIDIndex.UUIDIndex import UUIDIndex
+from Products.ZCTextIndex.ZCTextIndex import ZCTextIndex
+import transaction
+
+
+class IndexSweeper(object):
+    """Remove the entries of stale rids from an index.
+
+    A rid is stale when it is not registered in the catalog's `uids`, the
+    registered rids are passed as `IITreeSet`. Each BTree of the index is
+    walked once, the stale rids found are collected in `swept`.
+    """
+    def __init__(self, index, registered):
+        self.index = index
+        self.registered = registered
+        self.swept = IITreeSet()
+        # names of counters that are not maintained as `Length`
+        self.skipped_counters = []
+
+    def get_stale_rids(self, rids):
+        return difference(IITreeSet(rids), self.registered)
+
+    def sweep_reverse_index(self, unindex, length=None):
+        """Remove stale rids from a rid-keyed BTree.
+
+        If `length` is provided it is decreased for each removed rid.
+        """
+        stale = self.get_stale_rids(unindex.keys())
+        for rid in stale:
+            del unindex[rid]
+            if length is not None:
+                length.change(-1)
+        self.swept.update(stale)
+        return stale
+
+    def sweep_set(self, rids):
+        """Remove stale rids from a set of rids, return the removed rids."""
+
+        stale = difference(rids, self.registered)
+        for rid in stale:
+            rids.remove(rid)
+        self.swept.update(stale)
+        return stale
+
+    def sweep_forward_index(self, index, length=None):
+        """Remove stale rids from a forward index.
+
+        Rows are either a single rid or a set of rids. Rows left empty are
+        removed, if `length` is provided it is decreased for each removed row.
+        """
+        empty = []
+        for key, row in index.items():
+            if isinstance(row, int):
+                if row not in self.registered:
+                    self.swept.insert(row)
+                    empty.append(key)
+            elif self.sweep_set(row) and not row:
+                empty.append(key)
+
+        for key in empty:
+            del index[key]
+            if length is not None:
+                length.change(-1)
+
+    def sweep(self):
+        raise NotImplementedError
+
+
+class NullSweeper(IndexSweeper):
+    """Don't do anything."""
+
+    def sweep(self):
+        pass
+
+
+class UnIndexSweeper(IndexSweeper):
+    """Sweep an `UnIndex`, its `_length` counts the keys of `_index`."""
+
+    def sweep(self):
+        self.sweep_reverse_index(self.index._unindex)
+        self.sweep_forward_index(self.index._index, self.index._length)
+
+
+class BooleanIndexSweeper(IndexSweeper):
+    """Sweep a `BooleanIndex`.
+
+    `_length` counts the rids of `_unindex`, `_index_length` counts the rids
+    in `_index`, the set of rids with the indexed value. Like surgery this
+    skips inverting the index, it happens during the next reindex.
+    """
+    def sweep(self):
+        self.sweep_reverse_index(self.index._unindex, self.index._length)
+        for rid in self.sweep_set(self.index._index):
+            self.index._index_length.change(-1)
+
+
+class DateRangeIndexSweeper(IndexSweeper):
+    """Sweep a `DateRangeIndex`."""
+
+    tree_names = ('_since_only', '_until_only', '_since', '_until')
+
+    def sweep(self):
+        self.sweep_reverse_index(self.index._unindex)
+        self.sweep_set(self.index._always)
+        for name in self.tree_names:
+            self.sweep_forward_index(getattr(self.index, name))
+
+
+class ExtendedPathIndexSweeper(IndexSweeper):
+    """Sweep an `ExtendedPathIndex`, its `_length` counts the rids of
+    `_unindex`.
+    """
+    def sweep(self):
+        self.sweep_reverse_index(self.index._unindex, self.index._length)
+        self.sweep_components()
+        self.sweep_forward_index(self.index._index_items)
+        self.sweep_forward_index(self.index._index_parents)
+
+    def sweep_components(self):
+        empty_components = []
+        for component, levels in self.index._index.items():
+            self.sweep_forward_index(levels)
+            if not levels:
+                empty_components.append(component)
+
+        for component in empty_components:
+            del self.index._index[component]
+
+
+class ZCTextIndexSweeper(IndexSweeper):
+    """Sweep a `ZCTextIndex`.
+
+    The postings of the text index' `_wordinfo` are swept first, then stale
+    rids are removed from `_docwords` and `_docweight`. The counters of the
+    text index are updated as by `unindex_doc`, which can't be used as it
+    fails on inconsistent data. Text indexes created by older versions don't
+    maintain their counters as `Length`, those counters are skipped.
+    """
+    def sweep(self):
+        text_index = self.index.index
+        self.sweep_wordinfo(text_index)
+
+        stale = self.get_stale_rids(
+            union(IITreeSet(text_index._docwords.keys()),
+                  IITreeSet(text_index._docweight.keys())))
+        for rid in stale:
+            if rid in text_index._docweight:
+                # the Okapi index keeps the total length of all documents
+                if hasattr(text_index, '_change_doc_len'):
+                    text_index._change_doc_len(-text_index._docweight[rid])
+                del text_index._docweight[rid]
+            if rid in text_index._docwords:
+                del text_index._docwords[rid]
+                self.change_counter(text_index, 'document_count', -1)
+        self.swept.update(stale)
+
+    def change_counter(self, text_index, name, delta):
+        counter = getattr(text_index, name, None)
+        if isinstance(counter, Length):
+            counter.change(delta)
+        elif 'index.' + name not in self.skipped_counters:
+            self.skipped_counters.append('index.' + name)
+
+    def sweep_wordinfo(self, text_index):
+        empty = []
+        for wid, postings in text_index._wordinfo.items():
+            stale = [rid for rid in postings.keys()
+                     if rid not in self.registered]
+            if not stale:
+                continue
+
+            for rid in stale:
+                del postings[rid]
+            self.swept.update(stale)
+            if not postings:
+                empty.append(wid)
+            elif isinstance(postings, dict):
+                text_index._wordinfo[wid] = postings  # persist the change
+
+        for wid in empty:
+            del text_index._wordinfo[wid]
+            self.change_counter(text_index, 'length', -1)
+
+
+# sweepers by index type, subclasses are not swept
+INDEX_TO_SWEEPER = {
+    BooleanIndex: BooleanIndexSweeper,
+    DateIndex: UnIndexSweeper,
+    DateRangeIndex: DateRangeIndexSweeper,
+    DateRecurringIndex: UnIndexSweeper,
+    ExtendedPathIndex: ExtendedPathIndexSweeper,
+    FieldIndex: UnIndexSweeper,
+    GopipIndex: NullSweeper,  # not a real index
+    KeywordIndex: UnIndexSweeper,
+    UUIDIndex: UnIndexSweeper,
+    ZCTextIndex: ZCTextIndexSweeper,
+}
+
+
+class IndexSweep(object):
+    """Remove the entries of all stale rids from all indexes.
+
+    Stale rids in indexes are the most common kind of corruption. Surgery
+    treats them rid by rid and only for known combinations of symptoms.
+    The sweep instead computes the rids registered in the catalog's `uids`
+    once and walks each index once, removing the entries of all rids not
+    registered in `uids`. The length counters of indexes are updated along.
+
+    Rids in the catalog's `paths` and metadata are left alone, stale rids
+    there are treated by surgery. A savepoint is created after each index to
+    free memory used by changed objects.
+    """
+    def __init__(self, catalog=None):
+        self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
+        self.catalog = self.portal_catalog._catalog
+
+    def run(self):
+        result = SweepResult()
+        registered = IITreeSet(self.catalog.uids.values())
+
+        for name, index in sorted(self.catalog.indexes.items()):
+            sweeper_cls = INDEX_TO_SWEEPER.get(type(index))
+            if sweeper_cls is None:
+                result.report_unhandled_index(name, index)
+                continue
+
+            sweeper = sweeper_cls(index, registered)
+            sweeper.sweep()
+            result.report_swept_rids(name, sweeper.swept)
+            result.report_skipped_counters(name, sweeper.skipped_counters)
+            transaction.savepoint(optimistic=True)
+
+        return result
+
+
+class SweepResult(object):
+    """Provide the result of one sweep run."""
+
+    def __init__(self):
+        # index name -> number of stale rids removed from the index
+        self.swept = dict()
+        self.unhandled_indexes = []
+        # `(index name, counter name)` tuples
+        self.skipped_counters = []
+
+    def report_swept_rids(self, name, rids):
+        if rids:
+            self.swept[name] = len(rids)
+
+    def report_skipped_counters(self, name, counters):
+        self.skipped_counters.extend((name, counter) for counter in counters)
+
+    def report_unhandled_index(self, name, index):
+        self.unhandled_indexes.append((name, type(index).__name__))
+
+    def has_swept(self):
+        return bool(self.swept)
+
+    def write_result(self, formatter):
+        """Log result to logger."""
+
+        if not self.swept:
+            formatter.info('Found no stale rids in indexes.')
+        for name, count in sorted(self.swept.items()):
+            formatter.info(
+                'Removed {} stale rids from index {}.'.format(count, name))
+        for name, counter in self.skipped_counters:
+            formatter.info(
+                'Skipped length counter {} of index {}, it is not '
+                'maintained.'.format(counter, name))
+        for name, type_name in self.unhandled_indexes:
+            formatter.info(
+                'Skipped index {} of unhandled type {}.'.format(
+                    name, type_name))
@@ -1,6 +1,8 @@
 from Acquisition import aq_base
 from Acquisition import aq_inner
 from Acquisition import aq_parent
+from ftw.builder import Builder
+from ftw.builder import create
 from ftw.catalogdoctor.command import doctor_cmd
 from ftw.catalogdoctor.compat import processQueue
 from ftw.catalogdoctor.healthcheck import CatalogHealthCheck
@@ -53,9 +55,18 @@ class FunctionalTestCase(TestCase):
         self._chosen_rids = set()
 
     def run_command(self, *args):
+        """Run the doctor command, return the lines it logged.
+
+        The exit status is stored in `exit_status`.
+        """
         formatter = MockFormatter()
         command = ['-c'] + list(args)
-        doctor_cmd(self.app, command, formatter=formatter)
+        try:
+            doctor_cmd(self.app, command, formatter=formatter)
+        except SystemExit as exc:
+            self.exit_status = exc.code
+        else:
+            self.exit_status = 0
         return formatter.getlines()
 
     def run_healthcheck(self):
@@ -63,6 +74,20 @@ class FunctionalTestCase(TestCase):
         healthcheck = CatalogHealthCheck(self.portal_catalog)
         return healthcheck.run()
 
+    def run_index_healthcheck(self):
+        """Run the health check including the validation of index data."""
+
+        self.maybe_process_indexing_queue()  # enforce up to date catalog
+        healthcheck = CatalogHealthCheck(
+            self.portal_catalog, check_indexes=True)
+        return healthcheck.run()
+
+    def create_folders(self, *titles):
+        """Create a folder for each title as contributor, return them."""
+
+        self.grant('Contributor')
+        return [create(Builder('folder').titled(title)) for title in titles]
+
     def perform_surgeries(self, healthcheck_result):
         scheduler = SurgeryScheduler(
             healthcheck_result, catalog=self.portal_catalog)
@@ -0,0 +1,148 @@
+from ftw.builder import Builder
+from ftw.builder import create
+from ftw.catalogdoctor.scheduler import BatchedSurgery
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from ftw.catalogdoctor.tests import MockFormatter
+from tempfile import mkdtemp
+import os
+import shutil
+import transaction
+
+
+class TestBatchedSurgery(FunctionalTestCase):
+
+    maxDiff = None
+
+    def setUp(self):
+        super(TestBatchedSurgery, self).setUp()
+
+        self.grant('Contributor')
+        self.folders = [
+            create(Builder('folder').titled(title))
+            for title in (u'Foo', u'Bar', u'Qux')]
+        for folder in self.folders:
+            self.recatalog_object_with_new_rid(folder)
+
+        tempdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.progress_path = os.path.join(tempdir, 'progress.pickle')
+
+    def get_unhealthy_rids(self):
+        result = self.run_healthcheck()
+        return sorted(result.get_unhealthy_rids(),
+                      key=lambda unhealthy_rid: unhealthy_rid.rid)
+
+    def test_treats_unhealthy_rids_in_batches(self):
+        unhealthy_rids = self.get_unhealthy_rids()
+        self.assertEqual(3, len(unhealthy_rids))
+
+        formatter = MockFormatter()
+        surgery = BatchedSurgery(
+            self.portal_catalog, batch_size=2,
+            progress_path=self.progress_path)
+
+        self.assertTrue(surgery.run(unhealthy_rids, formatter))
+        self.assert_no_unhealthy_rids()
+        self.assertFalse(os.path.exists(self.progress_path))
+        self.assertIn(
+            'Treated 2 unhealthy rids, 1 remaining.', formatter.getlines())
+        self.assertIn(
+            'Treated 3 unhealthy rids, 0 remaining.', formatter.getlines())
+
+    def test_stores_progress_when_batch_can_not_be_treated(self):
+        untreatable_rid = self.choose_next_rid()
+        self.catalog.data[untreatable_rid] = dict()
+        unhealthy_rids = self.get_unhealthy_rids()
+        unhealthy_rids.sort(
+            key=lambda unhealthy_rid: unhealthy_rid.rid == untreatable_rid)
+
+        surgery = BatchedSurgery(
+            self.portal_catalog, batch_size=3,
+            progress_path=self.progress_path)
+
+        self.assertFalse(surgery.run(unhealthy_rids, MockFormatter()))
+        self.assertEqual(
+            [untreatable_rid],
+            [unhealthy_rid.rid for unhealthy_rid in surgery.load_progress()])
+        self.assertEqual(
+            [untreatable_rid], list(self.run_healthcheck().unhealthy_rids))
+
+    def test_resumes_with_remaining_rids(self):
+        unhealthy_rids = self.get_unhealthy_rids()
+        BatchedSurgery(
+            self.portal_catalog, progress_path=self.progress_path,
+        ).save_progress(unhealthy_rids[1:])
+
+        surgery = BatchedSurgery(
+            self.portal_catalog, progress_path=self.progress_path)
+        remaining = surgery.load_progress()
+        self.assertEqual(
+            [unhealthy_rid.rid for unhealthy_rid in unhealthy_rids[1:]],
+            [unhealthy_rid.rid for unhealthy_rid in remaining])
+
+        self.assertTrue(surgery.run(remaining, MockFormatter()))
+        self.assertEqual(
+            [unhealthy_rids[0].rid],
+            list(self.run_healthcheck().unhealthy_rids))
+
+    def test_does_not_store_progress_in_dryrun(self):
+        surgery = BatchedSurgery(
+            self.portal_catalog, batch_size=2,
+            progress_path=self.progress_path, dryrun=True)
+        surgery.save_progress(self.get_unhealthy_rids())
+
+        self.assertFalse(os.path.exists(self.progress_path))
+
+    def test_keeps_progress_of_resumed_surgery_in_dryrun(self):
+        unhealthy_rids = self.get_unhealthy_rids()
+        BatchedSurgery(
+            self.portal_catalog, progress_path=self.progress_path,
+        ).save_progress(unhealthy_rids)
+
+        surgery = BatchedSurgery(
+            self.portal_catalog, batch_size=2,
+            progress_path=self.progress_path, dryrun=True)
+        self.assertTrue(surgery.run(surgery.load_progress(), MockFormatter()))
+
+        self.assertEqual(
+            [unhealthy_rid.rid for unhealthy_rid in unhealthy_rids],
+            [unhealthy_rid.rid for unhealthy_rid in surgery.load_progress()])
+
+    def test_keeps_treated_batches_when_batch_fails_in_dryrun(self):
+        untreatable_rid = self.choose_next_rid()
+        self.catalog.data[untreatable_rid] = dict()
+        unhealthy_rids = self.get_unhealthy_rids()
+        unhealthy_rids.sort(
+            key=lambda unhealthy_rid: unhealthy_rid.rid == untreatable_rid)
+
+        surgery = BatchedSurgery(
+            self.portal_catalog, batch_size=2, dryrun=True)
+
+        self.assertFalse(surgery.run(unhealthy_rids, MockFormatter()))
+        self.assertTrue(transaction.get().isDoomed())
+        self.assertEqual(
+            sorted([unhealthy_rids[2].rid, untreatable_rid]),
+            sorted(self.run_healthcheck().unhealthy_rids))
+
+    def test_verifies_rids_touched_by_all_batches(self):
+        unhealthy_rids = self.get_unhealthy_rids()
+        surgery = BatchedSurgery(self.portal_catalog, batch_size=2)
+        self.assertTrue(surgery.run(unhealthy_rids, MockFormatter()))
+
+        self.assertTrue(
+            set(unhealthy_rid.rid for unhealthy_rid in unhealthy_rids)
+            <= surgery.touched_rids)
+        self.assertTrue(surgery.verify().is_healthy())
+
+    def test_verify_reports_inconsistent_catalog_length(self):
+        unhealthy_rids = self.get_unhealthy_rids()
+        self.catalog._length.change(1)
+        surgery = BatchedSurgery(self.portal_catalog, batch_size=2)
+        self.assertTrue(surgery.run(unhealthy_rids, MockFormatter()))
+
+        result = surgery.verify()
+
+        self.assertTrue(result.is_catalog_data_healthy())
+        self.assertFalse(result.is_length_healthy())
+        self.assertEqual(4, result.claimed_length)
+        self.assertEqual(3, result.uids_length)
@@ -0,0 +1,80 @@
+from ftw.builder import Builder
+from ftw.builder import create
+from ftw.catalogdoctor.btreecheck import BTreeCheck
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from ftw.catalogdoctor.tests import MockFormatter
+
+
+class TestBTreeCheck(FunctionalTestCase):
+
+    def setUp(self):
+        super(TestBTreeCheck, self).setUp()
+
+        self.grant('Contributor')
+        self.folder = create(Builder('folder').titled(u'Foo'))
+        self.other_folder = create(Builder('folder').titled(u'Bar'))
+
+    def run_btreecheck(self, formatter=None):
+        self.maybe_process_indexing_queue()
+        return BTreeCheck(self.portal_catalog, formatter=formatter).run()
+
+    def get_tree_result(self, result, name):
+        for tree_result in result.tree_results:
+            if tree_result.name == name:
+                return tree_result
+        return None
+
+    def test_intact_btrees_are_healthy(self):
+        result = self.run_btreecheck()
+
+        self.assertTrue(result.is_healthy())
+        paths = self.get_tree_result(result, 'paths')
+        self.assertEqual(2, paths.length)
+        self.assertEqual(1, paths.buckets)
+        self.assertEqual(1, paths.depth)
+
+    def test_checks_btrees_of_indexes(self):
+        result = self.run_btreecheck()
+
+        names = [tree_result.name for tree_result in result.tree_results]
+        self.assertIn('indexes.UID._index', names)
+        self.assertIn('indexes.path._index_parents', names)
+        self.assertIn('indexes.SearchableText.index._wordinfo', names)
+
+    def test_checks_shared_lexicon_once(self):
+        result = self.run_btreecheck()
+
+        lexicon_words = [
+            tree_result.name for tree_result in result.tree_results
+            if tree_result.name.endswith('._lexicon._words')]
+        self.assertEqual(1, len(lexicon_words))
+
+    def test_detects_keys_out_of_order(self):
+        bucket = self.catalog.paths._firstbucket
+        items = bucket.__getstate__()[0]
+        bucket.__setstate__((items[2:4] + items[0:2],))
+
+        result = self.run_btreecheck()
+
+        self.assertFalse(result.is_healthy())
+        self.assertEqual(
+            ['paths'],
+            [tree_result.name for tree_result in result.get_damaged_trees()])
+
+    def test_reports_each_tree_when_checked(self):
+        formatter = MockFormatter()
+        result = self.run_btreecheck(formatter=formatter)
+
+        lines = formatter.getlines()
+        self.assertEqual(len(result.tree_results), len(lines))
+        self.assertEqual(' uids: 2 keys in 1 buckets, depth 1', lines[0])
+
+    def test_logging(self):
+        result = self.run_btreecheck()
+        formatter = MockFormatter()
+        result.write_result(formatter)
+
+        self.assertEqual(
+            ['All {} BTrees are structurally intact.'.format(
+                len(result.tree_results))],
+            formatter.getlines())
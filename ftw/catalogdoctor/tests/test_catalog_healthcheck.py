@@ -1,8 +1,14 @@
 from ftw.builder import Builder
 from ftw.builder import create
+from ftw.catalogdoctor.healthcheck import CatalogHealthCheck
+from ftw.catalogdoctor.healthcheck import CatalogRids
+from ftw.catalogdoctor.healthcheck import TargetedHealthCheck
+from ftw.catalogdoctor.healthcheck import UnhealthyRid
 from ftw.catalogdoctor.tests import FunctionalTestCase
 from ftw.catalogdoctor.tests import Mock
 from ftw.catalogdoctor.tests import MockFormatter
+from unittest import TestCase
+import pickle
 
 
 class TestCatalogHealthCheck(FunctionalTestCase):
@@ -19,11 +25,25 @@ class TestCatalogHealthCheck(FunctionalTestCase):
         self.assertTrue(result.is_healthy())
         self.assertTrue(result.is_length_healthy())
 
+    def test_catalog_rids(self):
+        rid = self.get_rid(self.folder)
+        extra_rid = self.choose_next_rid()
+        self.catalog.data[extra_rid] = dict()
+
+        rids = CatalogRids(self.catalog)
+
+        self.assertEqual([rid], list(rids.in_catalog))
+        self.assertEqual([rid], list(rids.in_paths))
+        self.assertEqual(sorted([rid, extra_rid]), list(rids.in_metadata))
+        self.assertEqual([rid], list(rids.in_uuid_index))
+        self.assertEqual([rid], list(rids.in_uuid_unindex))
+
     def test_unhealthy_rids_make_catalog_unhealthy(self):
         result = self.run_healthcheck()
         self.assertTrue(result.is_healthy())
 
-        result.report_symptom('foo', self.choose_next_rid())
+        result.report_symptom(
+            'in_metadata_keys_not_in_paths_keys', self.choose_next_rid())
         self.assertFalse(result.is_healthy())
 
     def test_longer_uids_make_catalog_unhealthy(self):
@@ -240,6 +260,52 @@ class TestCatalogHealthCheck(FunctionalTestCase):
             ),
             result.get_symptoms(extra_rid))
 
+    def test_streaming_healthcheck_reports_same_result(self):
+        create(Builder('folder').titled(u'Bar'))
+        create(Builder('folder').titled(u'Qux'))
+        path = self.get_physical_path(self.folder)
+        rid = self.catalog.uids.pop(path)
+        extra_rid = self.choose_next_rid()
+        self.catalog.data[extra_rid] = dict()
+
+        result = self.run_healthcheck()
+        streamed_result = CatalogHealthCheck(
+            self.portal_catalog, chunk_size=1).run()
+
+        self.assertEqual(2, len(streamed_result.unhealthy_rids))
+        self.assertEqual(
+            result.get_symptoms(rid), streamed_result.get_symptoms(rid))
+        self.assertEqual(
+            result.get_symptoms(extra_rid),
+            streamed_result.get_symptoms(extra_rid))
+        self.assertEqual(3, streamed_result.paths_length)
+        self.assertEqual(2, streamed_result.uids_length)
+        self.assertEqual(4, streamed_result.data_length)
+
+    def test_targeted_healthcheck_reports_symptoms_of_given_rids(self):
+        other_folder = create(Builder('folder').titled(u'Bar'))
+        path = self.get_physical_path(self.folder)
+        rid = self.get_rid(self.folder)
+        del self.catalog.paths[rid]
+        extra_rid = self.choose_next_rid()
+        self.catalog.uids['/plone/extra'] = extra_rid
+
+        result = self.run_healthcheck()
+        # the extra rid is reachable only via the path hint
+        targeted_result = TargetedHealthCheck(
+            self.portal_catalog, rids=[rid], paths=['/plone/extra']).run()
+
+        self.assertEqual(2, len(targeted_result.unhealthy_rids))
+        self.assertEqual(
+            result.get_symptoms(rid), targeted_result.get_symptoms(rid))
+        self.assertEqual(
+            result.get_symptoms(extra_rid),
+            targeted_result.get_symptoms(extra_rid))
+        self.assertEqual(
+            (path,), targeted_result.unhealthy_rids[rid].paths)
+        self.assertNotIn(
+            self.get_rid(other_folder), targeted_result.unhealthy_rids)
+
     def test_logging(self):
         extra_rid = self.choose_next_rid()
         self.catalog.data[extra_rid] = dict()
@@ -264,3 +330,61 @@ class TestCatalogHealthCheck(FunctionalTestCase):
             '',
         ]
         self.assertEqual(expected, formatter.getlines())
+
+
+class TestUnhealthyRid(TestCase):
+
+    def test_symptoms_are_sorted(self):
+        unhealthy_rid = UnhealthyRid(1)
+        unhealthy_rid.report_catalog_symptom(
+            'uids_tuple_mismatches_paths_tuple')
+        unhealthy_rid.report_catalog_symptom(
+            'in_paths_keys_not_in_uids_values')
+        unhealthy_rid.report_catalog_symptom(
+            'uids_tuple_mismatches_paths_tuple')
+
+        self.assertEqual(
+            (
+                'in_paths_keys_not_in_uids_values',
+                'uids_tuple_mismatches_paths_tuple',
+            ),
+            unhealthy_rid.catalog_symptoms)
+
+    def test_unknown_symptom_is_rejected(self):
+        unhealthy_rid = UnhealthyRid(1)
+
+        with self.assertRaises(ValueError):
+            unhealthy_rid.report_catalog_symptom('foo')
+
+    def test_paths_are_sorted_and_unique(self):
+        unhealthy_rid = UnhealthyRid(1)
+        self.assertEqual((), unhealthy_rid.paths)
+
+        unhealthy_rid.attach_path('/plone/foo')
+        unhealthy_rid.attach_path('/plone/foo')
+        self.assertEqual(('/plone/foo',), unhealthy_rid.paths)
+
+        unhealthy_rid.attach_path('/plone/bar')
+        unhealthy_rid.attach_path('/plone/foo')
+        self.assertEqual(('/plone/bar', '/plone/foo'), unhealthy_rid.paths)
+
+    def test_has_no_instance_dict(self):
+        self.assertFalse(hasattr(UnhealthyRid(1), '__dict__'))
+
+    def test_pickle(self):
+        unhealthy_rid = UnhealthyRid(1)
+        unhealthy_rid.attach_path('/plone/foo')
+        unhealthy_rid.report_catalog_symptom(
+            'in_paths_keys_not_in_uids_values')
+        unhealthy_rid.report_index_symptom(
+            'portal_type', 'in_index_not_in_unindex')
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(unhealthy_rid, protocol))
+            self.assertEqual(1, copy.rid)
+            self.assertEqual(('/plone/foo',), copy.paths)
+            self.assertEqual(
+                ('in_paths_keys_not_in_uids_values',), copy.catalog_symptoms)
+            self.assertEqual(
+                (('portal_type', 'in_index_not_in_unindex'),),
+                copy.index_symptoms)
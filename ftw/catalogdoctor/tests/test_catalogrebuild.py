@@ -0,0 +1,186 @@
+from Acquisition import aq_base
+from ftw.builder import Builder
+from ftw.builder import create
+from ftw.catalogdoctor.catalogrebuild import CatalogRebuild
+from ftw.catalogdoctor.catalogrebuild import STATE_ATTRIBUTE
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from ftw.catalogdoctor.tests import MockFormatter
+import transaction
+
+
+class TestCatalogRebuild(FunctionalTestCase):
+
+    maxDiff = None
+
+    def setUp(self):
+        super(TestCatalogRebuild, self).setUp()
+
+        self.folder, self.other_folder = self.create_folders(
+            u'Foo', u'Bar')
+        self.maybe_process_indexing_queue()
+        transaction.commit()
+
+    def run_rebuild(self, **kwargs):
+        self.maybe_process_indexing_queue()
+        transaction.commit()
+        return CatalogRebuild(catalog=self.portal_catalog, **kwargs).run()
+
+    def get_state(self):
+        return getattr(aq_base(self.portal_catalog), STATE_ATTRIBUTE, None)
+
+    def break_indexing(self, obj):
+        """Make computing the title of obj fail until the test ends."""
+        cls = type(aq_base(obj))
+        original = vars(cls).get('Title')
+        title = cls.Title
+        path = self.get_physical_path(obj)
+
+        def broken_title(context):
+            if '/'.join(context.getPhysicalPath()) == path:
+                raise ValueError('broken')
+            return title(context)
+
+        def restore():
+            if vars(cls).get('Title') is not broken_title:
+                return
+            if original is None:
+                del cls.Title
+            else:
+                cls.Title = original
+
+        cls.Title = broken_title
+        self.addCleanup(restore)
+        return restore
+
+    def search_paths(self, **query):
+        return sorted(brain.getPath() for brain in
+                      self.portal_catalog.unrestrictedSearchResults(**query))
+
+    def test_rebuilds_corrupt_catalog(self):
+        path = self.get_physical_path(self.folder)
+        del self.catalog.uids[path]
+        self.catalog._length.change(-1)
+        transaction.commit()
+        self.assertFalse(self.run_index_healthcheck().is_healthy())
+
+        result = self.run_rebuild()
+
+        self.assertTrue(result.is_finished())
+        self.assertTrue(result.swapped)
+        self.assertEqual(2, result.length)
+        self.assertIsNone(self.get_state())
+        self.assertIsNot(self.catalog, self.portal_catalog._catalog)
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+        self.assertEqual(
+            [path], self.search_paths(Title='Foo', portal_type='Folder'))
+
+    def test_interrupted_rebuild_is_resumed(self):
+        result = self.run_rebuild(chunk_size=1, time_budget=0)
+
+        self.assertTrue(result.interrupted)
+        self.assertFalse(result.is_finished())
+        self.assertEqual(1, result.cataloged)
+        self.assertEqual('walk', self.get_state()['phase'])
+        self.assertIs(self.catalog, self.portal_catalog._catalog)
+
+        result = self.run_rebuild(chunk_size=1)
+
+        self.assertTrue(result.is_finished())
+        self.assertEqual(2, result.length)
+        self.assertIsNone(self.get_state())
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_catches_up_with_changes_committed_meanwhile(self):
+        self.run_rebuild(chunk_size=1, time_budget=0)
+
+        new_folder = create(Builder('folder').titled(u'Qux'))
+        self.folder.setTitle(u'Changed')
+        self.folder.reindexObject(idxs=['Title'])
+        self.portal.manage_delObjects([self.other_folder.getId()])
+        self.maybe_process_indexing_queue()
+        transaction.commit()
+
+        result = self.run_rebuild(chunk_size=1)
+
+        self.assertEqual(2, result.length)
+        self.assertEqual(
+            [self.get_physical_path(self.folder),
+             self.get_physical_path(new_folder)],
+            self.search_paths(portal_type='Folder'))
+        self.assertEqual(
+            [self.get_physical_path(self.folder)],
+            self.search_paths(Title='Changed'))
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_restart_discards_unfinished_rebuild(self):
+        self.run_rebuild(chunk_size=1, time_budget=0)
+        self.assertIsNotNone(self.get_state())
+
+        result = self.run_rebuild(restart=True)
+
+        self.assertTrue(result.is_finished())
+        self.assertEqual(2, result.cataloged)
+        self.assertIsNone(self.get_state())
+
+    def test_does_not_swap_while_objects_can_not_be_cataloged(self):
+        path = self.get_physical_path(self.folder)
+        fix = self.break_indexing(self.folder)
+
+        result = self.run_rebuild()
+
+        self.assertFalse(result.is_finished())
+        self.assertFalse(result.swapped)
+        self.assertEqual([(path, 'ValueError: broken')], result.failed)
+        self.assertEqual('catch-up', self.get_state()['phase'])
+        self.assertEqual([path], list(self.get_state()['failed'].keys()))
+        self.assertIs(self.catalog, self.portal_catalog._catalog)
+
+        fix()
+        result = self.run_rebuild()
+
+        self.assertTrue(result.is_finished())
+        self.assertEqual([], result.failed)
+        self.assertEqual(2, result.length)
+        self.assertIsNone(self.get_state())
+        self.assertEqual([path], self.search_paths(Title='Foo'))
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_logging(self):
+        result = self.run_rebuild()
+        formatter = MockFormatter()
+        result.write_result(formatter)
+
+        self.assertEqual(
+            [
+                'Cataloged 2 objects, uncataloged 0 objects.',
+                'Rebuild was successful, catalog length is 2.',
+            ],
+            formatter.getlines())
+
+    def test_logging_when_objects_can_not_be_cataloged(self):
+        self.break_indexing(self.folder)
+        result = self.run_rebuild()
+        formatter = MockFormatter()
+        result.write_result(formatter)
+
+        self.assertEqual(
+            [
+                'Cataloged 1 objects, uncataloged 0 objects.',
+                'Could not catalog 1 objects:',
+                ' /plone/foo: ValueError: broken',
+                'Rebuild can not be finished while objects can not be '
+                'cataloged, fix them and run it again to resume.',
+            ],
+            formatter.getlines())
+
+    def test_logging_when_interrupted(self):
+        result = self.run_rebuild(chunk_size=1, time_budget=0)
+        formatter = MockFormatter()
+        result.write_result(formatter)
+
+        self.assertEqual(
+            [
+                'Cataloged 1 objects, uncataloged 0 objects.',
+                'Rebuild was interrupted, run it again to resume.',
+            ],
+            formatter.getlines())
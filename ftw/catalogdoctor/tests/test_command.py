@@ -1,6 +1,10 @@
 from ftw.builder import Builder
 from ftw.builder import create
 from ftw.catalogdoctor.tests import FunctionalTestCase
+from tempfile import mkdtemp
+import os
+import shutil
+import transaction
 
 
 class TestDoctorCommand(FunctionalTestCase):
@@ -42,6 +46,140 @@ class TestDoctorCommand(FunctionalTestCase):
         ]
         self.assertEqual(expected, self.run_command('doctor', 'healthcheck'))
 
+    def test_healthcheck_unhealthy_catalog_in_chunks(self):
+        create(Builder('folder').titled(u'Bar'))
+        extra_rid = self.choose_next_rid()
+        self.catalog.data[extra_rid] = dict()
+
+        expected = [
+            'Catalog health check report:',
+            'Inconsistent catalog length:',
+            ' claimed length: 2',
+            ' uids length: 2',
+            ' paths length: 2',
+            ' metadata length: 3',
+            ' uid index claimed length: 2',
+            ' uid index index length: 2',
+            ' uid index unindex length: 2',
+            'Catalog data is unhealthy, found 1 unhealthy rids:',
+            'rid {} (--no path--):'.format(extra_rid),
+            '\t- in_metadata_keys_not_in_paths_keys',
+            '\t- in_metadata_keys_not_in_uids_values',
+            '',
+        ]
+        self.assertEqual(
+            expected,
+            self.run_command('doctor', '--chunk-size', '1', 'healthcheck'))
+
+    def test_healthcheck_aggregated(self):
+        extra_rid = self.choose_next_rid()
+        self.catalog.data[extra_rid] = dict()
+
+        expected = [
+            'Catalog health check report:',
+            'Inconsistent catalog length:',
+            ' claimed length: 1',
+            ' uids length: 1',
+            ' paths length: 1',
+            ' metadata length: 2',
+            ' uid index claimed length: 1',
+            ' uid index index length: 1',
+            ' uid index unindex length: 1',
+            'Catalog data is unhealthy, found 1 unhealthy rids in 1 symptom '
+            'groups:',
+            '1 rids with symptoms:',
+            '\t- in_metadata_keys_not_in_paths_keys',
+            '\t- in_metadata_keys_not_in_uids_values',
+            ' rid 98 (--no path--)',
+            '',
+        ]
+        self.assertEqual(
+            expected,
+            self.run_command('doctor', 'healthcheck', '--aggregate'))
+
+    def test_healthcheck_with_time_budget_saves_progress(self):
+        tempdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        cursor_path = os.path.join(tempdir, 'cursor')
+        transaction.commit()
+
+        expected = [
+            'Time budget exceeded, progress has been saved to {}. Run the '
+            'healthcheck again to continue.'.format(cursor_path),
+        ]
+        self.assertEqual(
+            expected,
+            self.run_command(
+                'doctor', '--chunk-size', '1', 'healthcheck',
+                '--cursor', cursor_path, '--time-budget', '0.000001'))
+        self.assertTrue(os.path.exists(cursor_path))
+
+        expected = [
+            'Catalog health check report:',
+            'Catalog length is consistent at 1.',
+            'Catalog data is healthy.']
+        self.assertEqual(
+            expected,
+            self.run_command(
+                'doctor', 'healthcheck', '--cursor', cursor_path))
+        self.assertFalse(os.path.exists(cursor_path))
+
+    def test_healthcheck_sample_escalates_to_full_healthcheck(self):
+        extra_rid = self.choose_next_rid()
+        self.catalog.data[extra_rid] = dict()
+
+        output = self.run_command('doctor', 'healthcheck', '--sample', '300')
+
+        self.assertEqual('Catalog sampling report:', output[0])
+        self.assertIn(
+            'Sample contains unhealthy rids, running full healthcheck:',
+            output)
+        self.assertIn(
+            'Catalog data is unhealthy, found 1 unhealthy rids:', output)
+
+    def test_triage_healthy_catalog(self):
+        expected = [
+            'Catalog triage report:',
+            ' claimed length: 1',
+            ' uid index claimed length: 1',
+            ' path index claimed length: 1',
+            ' uids depth: 1',
+            ' paths depth: 1',
+            ' metadata depth: 1',
+            ' uid index index depth: 1',
+            ' uid index unindex depth: 1',
+            'Length counters are consistent.',
+        ]
+        self.assertEqual(expected, self.run_command('doctor', 'triage'))
+        self.assertEqual(0, self.exit_status)
+
+    def test_triage_inconsistent_counters(self):
+        self.catalog._length.change(1)
+
+        expected = [
+            'Catalog triage report:',
+            ' claimed length: 2',
+            ' uid index claimed length: 1',
+            ' path index claimed length: 1',
+            ' uids depth: 1',
+            ' paths depth: 1',
+            ' metadata depth: 1',
+            ' uid index index depth: 1',
+            ' uid index unindex depth: 1',
+            'Length counters are inconsistent, run a healthcheck.',
+        ]
+        self.assertEqual(expected, self.run_command('doctor', 'triage'))
+        self.assertEqual(1, self.exit_status)
+
+    def test_btreecheck_healthy_catalog(self):
+        lines = self.run_command('doctor', 'btreecheck')
+
+        self.assertEqual('Checking BTrees:', lines[0])
+        self.assertEqual(' uids: 1 keys in 1 buckets, depth 1', lines[1])
+        self.assertEqual(
+            'All {} BTrees are structurally intact.'.format(len(lines) - 2),
+            lines[-1])
+
     def test_surgery_healthy_catlog(self):
         expected = [
             'Catalog health check report:',
@@ -112,7 +250,7 @@ class TestDoctorCommand(FunctionalTestCase):
             '\t- Removed rid from paths (the rid->path mapping).',
             '\t- Removed rid from catalog metadata.',
             '',
-            'Performing post-surgery healthcheck:',
+            'Performing post-surgery healthcheck of touched rids:',
             'Catalog health check report:',
             'Catalog length is consistent at 0.',
             'Catalog data is healthy.',
@@ -154,7 +292,7 @@ class TestDoctorCommand(FunctionalTestCase):
             '\t- Removed rid from paths (the rid->path mapping).',
             '\t- Removed rid from catalog metadata.',
             '',
-            'Performing post-surgery healthcheck:',
+            'Performing post-surgery healthcheck of touched rids:',
             'Catalog health check report:',
             'Catalog length is consistent at 0.',
             'Catalog data is healthy.',
@@ -162,3 +300,161 @@ class TestDoctorCommand(FunctionalTestCase):
             'dryrun!',
         ]
         self.assertEqual(expected, self.run_command('doctor', '-n', 'surgery'))
+
+    def test_batched_surgery_unhealthy_catalog_dryrun(self):
+        path = self.get_physical_path(self.folder)
+        rid = self.catalog.uids.pop(path)
+        # drop from uid index index, leave in unindex
+        uid_index = self.catalog.indexes['UID']
+        uid_index.removeForwardIndexEntry(uid_index._unindex[rid], rid)
+        self.portal._delObject(self.folder.getId(), suppress_events=True)
+
+        expected = [
+            'Performing dryrun!',
+            '',
+            'Catalog health check report:',
+            'Inconsistent catalog length:',
+            ' claimed length: 1',
+            ' uids length: 0',
+            ' paths length: 1',
+            ' metadata length: 1',
+            ' uid index claimed length: 0',
+            ' uid index index length: 0',
+            ' uid index unindex length: 1',
+            'Catalog data is unhealthy, found 1 unhealthy rids:',
+            'rid {} (\'/plone/foo\'):'.format(rid),
+            '\t- in_metadata_keys_not_in_uids_values',
+            '\t- in_paths_keys_not_in_uids_values',
+            '\t- in_paths_values_not_in_uids_keys',
+            '\t- in_uuid_unindex_not_in_catalog',
+            '\t- in_uuid_unindex_not_in_uuid_index',
+            '',
+            'Performing surgery in batches of 5 rids:',
+            'rid {} (\'/plone/foo\'):'.format(rid),
+            '\t- Removed rid from all catalog indexes.',
+            '\t- Removed rid from paths (the rid->path mapping).',
+            '\t- Removed rid from catalog metadata.',
+            '',
+            'Treated 1 unhealthy rids, 0 remaining.',
+            '',
+            'Performing post-surgery healthcheck of touched rids:',
+            'Catalog health check report:',
+            'Catalog length is consistent at 0.',
+            'Catalog data is healthy.',
+            'Surgery would have been successful, but was aborted due to '
+            'dryrun!',
+        ]
+        self.assertEqual(
+            expected,
+            self.run_command('doctor', '-n', 'surgery', '--batch-size', '5'))
+        self.assertEqual(0, self.exit_status)
+
+    def test_batched_surgery_reports_inconsistent_lengths(self):
+        self.catalog._length.change(1)
+        inconsistent_length = [
+            'Inconsistent catalog length:',
+            ' claimed length: 2',
+            ' uids length: 1',
+            ' paths length: 1',
+            ' metadata length: 1',
+            ' uid index claimed length: 1',
+            ' uid index index length: 1',
+            ' uid index unindex length: 1',
+        ]
+
+        expected = [
+            'Performing dryrun!',
+            '',
+            'Catalog health check report:',
+        ] + inconsistent_length + [
+            'Catalog data is healthy.',
+            'Performing surgery in batches of 5 rids:',
+            'Performing post-surgery healthcheck of touched rids:',
+            'Catalog health check report:',
+        ] + inconsistent_length + [
+            'Catalog data is healthy.',
+            'Surgery does not fix inconsistent lengths, use repair-lengths '
+            'to reset the length counters.',
+            'Not all health problems could be fixed.',
+        ]
+        self.assertEqual(
+            expected,
+            self.run_command('doctor', '-n', 'surgery', '--batch-size', '5'))
+        self.assertEqual(1, self.exit_status)
+
+    def test_sweep_healthy_catalog(self):
+        expected = [
+            'Sweeping stale rids from indexes:',
+            'Found no stale rids in indexes.',
+        ]
+        self.assertEqual(expected, self.run_command('doctor', 'sweep'))
+
+    def test_sweep_stale_rid_dryrun(self):
+        extra_rid = self.choose_next_rid()
+        self.catalog.indexes['UID']._unindex[extra_rid] = 'qux'
+
+        expected = [
+            'Performing dryrun!',
+            '',
+            'Sweeping stale rids from indexes:',
+            'Removed 1 stale rids from index UID.',
+            'Sweep would have been successful, but was aborted due to '
+            'dryrun!',
+        ]
+        self.assertEqual(expected, self.run_command('doctor', '-n', 'sweep'))
+
+    def test_rebuild_index_dryrun(self):
+        expected = [
+            'Performing dryrun!',
+            '',
+            'Rebuilt forward index of portal_type from its reverse index.',
+            ' 1 keys, 1 rids',
+            'Rebuild would have been successful, but was aborted due to '
+            'dryrun!',
+        ]
+        self.assertEqual(
+            expected,
+            self.run_command('doctor', '-n', 'rebuild-index', 'portal_type'))
+
+    def test_rebuild_index_unhandled_index_type(self):
+        lines = self.run_command('doctor', 'rebuild-index', 'path')
+
+        self.assertEqual(1, len(lines))
+        self.assertTrue(lines[0].startswith(
+            'Index could not be rebuilt: Unhandled index type:'))
+
+    def test_rebuild_mapping_dryrun(self):
+        expected = [
+            'Performing dryrun!',
+            '',
+            'Rebuilt uids from paths, catalog length is 1.',
+            'Rebuild would have been successful, but was aborted due to '
+            'dryrun!',
+        ]
+        self.assertEqual(
+            expected,
+            self.run_command('doctor', '-n', 'rebuild-mapping', 'uids'))
+
+    def test_repair_lengths_dryrun(self):
+        self.catalog._length.change(1)
+
+        lines = self.run_command('doctor', '-n', 'repair-lengths')
+
+        self.assertEqual(
+            ['Performing dryrun!', '', 'Repairing length counters:'],
+            lines[:3])
+        self.assertTrue(lines[3].startswith('Reset 1 of '))
+        self.assertEqual(
+            [
+                ' _length: 2 -> 1',
+                'Repair would have been successful, but was aborted due to '
+                'dryrun!',
+            ],
+            lines[4:])
+
+    def test_rebuild_dryrun_is_not_supported(self):
+        expected = [
+            'Rebuild can not be performed as dryrun, it commits each chunk.',
+        ]
+        self.assertEqual(
+            expected, self.run_command('doctor', '-n', 'rebuild'))
@@ -0,0 +1,114 @@
+from ftw.builder import Builder
+from ftw.builder import create
+from ftw.catalogdoctor.incremental import IncrementalHealthCheck
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from tempfile import mkdtemp
+import os
+import shutil
+import transaction
+
+
+class TestIncrementalHealthCheck(FunctionalTestCase):
+
+    def setUp(self):
+        super(TestIncrementalHealthCheck, self).setUp()
+
+        self.grant('Contributor')
+        self.folder = create(Builder('folder').titled(u'Foo'))
+        self.other_folder = create(Builder('folder').titled(u'Bar'))
+        self.maybe_process_indexing_queue()
+        transaction.commit()
+
+        self.tempdir = mkdtemp()
+        self.checkpoint_path = os.path.join(self.tempdir, 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(TestIncrementalHealthCheck, self).tearDown()
+
+    def run_incremental_healthcheck(self):
+        self.maybe_process_indexing_queue()
+        transaction.commit()
+        healthcheck = IncrementalHealthCheck(
+            self.checkpoint_path, catalog=self.portal_catalog)
+        return healthcheck, healthcheck.run()
+
+    def assert_same_result(self, expected, result):
+        self.assertEqual(
+            set(expected.unhealthy_rids), set(result.unhealthy_rids))
+        for rid in expected.unhealthy_rids:
+            self.assertEqual(
+                expected.get_symptoms(rid), result.get_symptoms(rid))
+            self.assertEqual(
+                expected.unhealthy_rids[rid].paths,
+                result.unhealthy_rids[rid].paths)
+        self.assertEqual(expected.uids_length, result.uids_length)
+        self.assertEqual(expected.paths_length, result.paths_length)
+        self.assertEqual(expected.data_length, result.data_length)
+        self.assertEqual(
+            expected.uuid_index_index_length, result.uuid_index_index_length)
+        self.assertEqual(
+            expected.uuid_index_unindex_length,
+            result.uuid_index_unindex_length)
+
+    def test_first_run_is_a_full_healthcheck(self):
+        healthcheck, result = self.run_incremental_healthcheck()
+
+        self.assertIsNone(healthcheck.checked_rids)
+        self.assertTrue(result.is_healthy())
+        self.assertTrue(os.path.exists(self.checkpoint_path))
+
+    def test_rechecks_changes_since_checkpoint(self):
+        self.run_incremental_healthcheck()
+
+        rid = self.get_rid(self.folder)
+        del self.catalog.paths[rid]
+        extra_rid = self.choose_next_rid()
+        self.catalog.data[extra_rid] = dict()
+
+        healthcheck, result = self.run_incremental_healthcheck()
+
+        self.assertIn(rid, healthcheck.checked_rids)
+        self.assertIn(extra_rid, healthcheck.checked_rids)
+        self.assertFalse(result.is_healthy())
+        self.assert_same_result(self.run_healthcheck(), result)
+
+    def test_keeps_unhealthy_rids_of_last_result(self):
+        path = self.get_physical_path(self.folder)
+        rid = self.catalog.uids.pop(path)
+        self.run_incremental_healthcheck()
+
+        self.reindex_object(self.other_folder)
+        healthcheck, result = self.run_incremental_healthcheck()
+
+        self.assertIsNotNone(healthcheck.checked_rids)
+        self.assertEqual(
+            (
+                'in_metadata_keys_not_in_uids_values',
+                'in_paths_keys_not_in_uids_values',
+                'in_paths_values_not_in_uids_keys',
+                'in_uuid_index_not_in_catalog',
+                'in_uuid_unindex_not_in_catalog',
+            ),
+            result.get_symptoms(rid))
+        self.assert_same_result(self.run_healthcheck(), result)
+
+    def test_fixed_symptoms_disappear(self):
+        path = self.get_physical_path(self.folder)
+        rid = self.catalog.uids.pop(path)
+        self.run_incremental_healthcheck()
+
+        self.catalog.uids[path] = rid
+        healthcheck, result = self.run_incremental_healthcheck()
+
+        self.assertIsNotNone(healthcheck.checked_rids)
+        self.assertTrue(result.is_healthy())
+
+    def test_unusable_checkpoint_runs_full_healthcheck(self):
+        with open(self.checkpoint_path, 'wb') as checkpoint_file:
+            checkpoint_file.write('garbage')
+
+        healthcheck, result = self.run_incremental_healthcheck()
+
+        self.assertIsNone(healthcheck.checked_rids)
+        self.assertTrue(result.is_healthy())
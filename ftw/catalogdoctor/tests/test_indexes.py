@@ -0,0 +1,273 @@
+from BTrees.IIBTree import IITreeSet
+from BTrees.IOBTree import IOBTree
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from ftw.catalogdoctor.tests import MockFormatter
+from Products.ZCTextIndex import WidCode
+
+
+class TestUnIndexValidation(FunctionalTestCase):
+
+    def setUp(self):
+        super(TestUnIndexValidation, self).setUp()
+
+        self.folder, = self.create_folders(u'Foo')
+
+    def test_initial_index_data_is_healthy(self):
+        result = self.run_index_healthcheck()
+
+        self.assertTrue(result.is_healthy())
+
+    def test_detects_rid_missing_in_field_index_unindex(self):
+        rid = self.get_rid(self.folder)
+        del self.catalog.indexes['portal_type']._unindex[rid]
+
+        result = self.run_index_healthcheck()
+
+        self.assertFalse(result.is_healthy())
+        self.assertEqual(
+            (('portal_type', 'in_index_not_in_unindex'),),
+            result.unhealthy_rids[rid].index_symptoms)
+        self.assertEqual((), result.get_symptoms(rid))
+        self.assertEqual(
+            [rid],
+            list(result.get_rids_with_symptom(
+                ('portal_type', 'in_index_not_in_unindex'))))
+
+    def test_detects_mismatching_keywords(self):
+        rid = self.get_rid(self.folder)
+        self.catalog.indexes['object_provides']._unindex[rid] = ['IFoo']
+
+        result = self.run_index_healthcheck()
+
+        self.assertFalse(result.is_healthy())
+        self.assertEqual(
+            (('object_provides', 'index_tuple_mismatches_unindex_tuple'),),
+            result.unhealthy_rids[rid].index_symptoms)
+
+    def test_empty_keywords_in_unindex_are_healthy(self):
+        rid = self.get_rid(self.folder)
+        unindex = self.catalog.indexes['Subject']._unindex
+        for empty in ((), []):
+            unindex[rid] = empty
+
+            result = self.run_index_healthcheck()
+
+            self.assertTrue(result.is_healthy())
+
+    def test_detects_extra_rid_in_date_index_unindex(self):
+        rid = self.get_rid(self.folder)
+        extra_rid = self.choose_next_rid()
+        index = self.catalog.indexes['modified']
+        index._unindex[extra_rid] = index._unindex[rid]
+
+        result = self.run_index_healthcheck()
+
+        self.assertFalse(result.is_healthy())
+        self.assertEqual([extra_rid], list(result.unhealthy_rids))
+        self.assertEqual(
+            (
+                ('modified', 'in_unindex_not_in_catalog'),
+                ('modified', 'in_unindex_not_in_index'),
+            ),
+            result.unhealthy_rids[extra_rid].index_symptoms)
+
+    def test_detects_rid_in_index_not_in_catalog(self):
+        path = self.get_physical_path(self.folder)
+        rid = self.catalog.uids.pop(path)
+
+        result = self.run_index_healthcheck()
+
+        self.assertIn(
+            ('portal_type', 'in_index_not_in_catalog'),
+            result.unhealthy_rids[rid].index_symptoms)
+        self.assertIn(
+            ('portal_type', 'in_unindex_not_in_catalog'),
+            result.unhealthy_rids[rid].index_symptoms)
+
+    def test_detects_inconsistent_index_length(self):
+        self.catalog.indexes['portal_type']._length.change(1)
+
+        result = self.run_index_healthcheck()
+
+        self.assertFalse(result.is_length_healthy())
+        self.assertTrue(result.is_catalog_data_healthy())
+        self.assertEqual(
+            {'portal_type': (2, 1)}, result.inconsistent_index_lengths)
+
+        formatter = MockFormatter()
+        result.write_result(formatter)
+        self.assertEqual(
+            [
+                'Catalog health check report:',
+                'Catalog length is consistent at 1.',
+                'Inconsistent length of index portal_type: claimed length 2, '
+                'length 1.',
+                'Catalog data is healthy.',
+            ],
+            formatter.getlines())
+
+    def test_index_data_is_not_validated_by_default(self):
+        rid = self.get_rid(self.folder)
+        del self.catalog.indexes['portal_type']._unindex[rid]
+
+        result = self.run_healthcheck()
+
+        self.assertTrue(result.is_healthy())
+
+
+class TestExtendedPathIndexValidation(FunctionalTestCase):
+
+    def setUp(self):
+        super(TestExtendedPathIndexValidation, self).setUp()
+
+        self.folder, = self.create_folders(u'Foo')
+        self.index = self.catalog.indexes['path']
+
+    def test_detects_missing_index_items_entry(self):
+        rid = self.get_rid(self.folder)
+        del self.index._index_items[self.get_physical_path(self.folder)]
+
+        result = self.run_index_healthcheck()
+
+        self.assertEqual(
+            (('path', 'in_unindex_not_in_index_items'),),
+            result.unhealthy_rids[rid].index_symptoms)
+
+    def test_detects_surplus_component_entry(self):
+        rid = self.get_rid(self.folder)
+        self.index._index['qux'] = IOBTree({0: IITreeSet([rid])})
+
+        result = self.run_index_healthcheck()
+
+        self.assertEqual(
+            (('path', 'index_tuple_mismatches_unindex_tuple'),),
+            result.unhealthy_rids[rid].index_symptoms)
+
+    def test_detects_rid_missing_in_unindex(self):
+        rid = self.get_rid(self.folder)
+        del self.index._unindex[rid]
+        self.index._length.change(-1)
+
+        result = self.run_index_healthcheck()
+
+        self.assertEqual(
+            (
+                ('path', 'in_index_items_not_in_unindex'),
+                ('path', 'in_index_not_in_unindex'),
+                ('path', 'in_index_parents_not_in_unindex'),
+                ('path', 'in_paths_keys_not_in_unindex'),
+            ),
+            result.unhealthy_rids[rid].index_symptoms)
+
+    def test_detects_path_mismatching_catalog_path(self):
+        rid = self.get_rid(self.folder)
+        self.catalog.paths[rid] = '/plone/qux'
+
+        result = self.run_index_healthcheck()
+
+        self.assertIn(
+            ('path', 'unindex_tuple_mismatches_paths_tuple'),
+            result.unhealthy_rids[rid].index_symptoms)
+
+
+class TestDateRangeIndexValidation(FunctionalTestCase):
+
+    def setUp(self):
+        super(TestDateRangeIndexValidation, self).setUp()
+
+        self.folder, = self.create_folders(u'Foo')
+        self.index = self.catalog.indexes['effectiveRange']
+
+    def test_initial_index_data_is_healthy(self):
+        result = self.run_index_healthcheck()
+
+        self.assertTrue(result.is_healthy())
+
+    def test_detects_stale_rid(self):
+        extra_rid = self.choose_next_rid()
+        self.index._always.insert(extra_rid)
+
+        result = self.run_index_healthcheck()
+
+        self.assertEqual([extra_rid], list(result.unhealthy_rids))
+        self.assertEqual(
+            (
+                ('effectiveRange', 'in_index_not_in_catalog'),
+                ('effectiveRange', 'in_index_not_in_unindex'),
+            ),
+            result.unhealthy_rids[extra_rid].index_symptoms)
+
+    def test_detects_forward_entries_mismatching_unindex(self):
+        rid = self.get_rid(self.folder)
+        self.index._unindex[rid] = (12345, None)
+
+        result = self.run_index_healthcheck()
+
+        self.assertEqual([rid], list(result.unhealthy_rids))
+        self.assertEqual(
+            (
+                ('effectiveRange', 'in_unindex_not_in_index'),
+                ('effectiveRange', 'index_tuple_mismatches_unindex_tuple'),
+            ),
+            result.unhealthy_rids[rid].index_symptoms)
+
+
+class TestZCTextIndexValidation(FunctionalTestCase):
+
+    def setUp(self):
+        super(TestZCTextIndexValidation, self).setUp()
+
+        self.folder, = self.create_folders(u'Foo')
+        self.text_index = self.catalog.indexes['SearchableText'].index
+
+    def get_wids(self, rid):
+        return WidCode.decode(self.text_index._docwords[rid])
+
+    def test_initial_index_data_is_healthy(self):
+        result = self.run_index_healthcheck()
+
+        self.assertTrue(result.is_healthy())
+
+    def test_detects_stale_rid(self):
+        rid = self.get_rid(self.folder)
+        extra_rid = self.choose_next_rid()
+        self.text_index._docwords[extra_rid] = self.text_index._docwords[rid]
+        self.text_index._docweight[extra_rid] = (
+            self.text_index._docweight[rid])
+
+        result = self.run_index_healthcheck()
+
+        self.assertEqual([extra_rid], list(result.unhealthy_rids))
+        self.assertEqual(
+            (
+                ('SearchableText', 'in_docwords_not_in_wordinfo'),
+                ('SearchableText', 'in_index_not_in_catalog'),
+            ),
+            result.unhealthy_rids[extra_rid].index_symptoms)
+        self.assertEqual(
+            {'SearchableText': (1, 2)}, result.inconsistent_index_lengths)
+
+    def test_detects_missing_posting(self):
+        rid = self.get_rid(self.folder)
+        wid = self.get_wids(rid)[0]
+        del self.text_index._wordinfo[wid][rid]
+
+        result = self.run_index_healthcheck()
+
+        self.assertEqual([rid], list(result.unhealthy_rids))
+        self.assertEqual(
+            (('SearchableText', 'docwords_tuple_mismatches_wordinfo_tuple'),),
+            result.unhealthy_rids[rid].index_symptoms)
+
+    def test_detects_wid_missing_in_lexicon(self):
+        rid = self.get_rid(self.folder)
+        wid = self.get_wids(rid)[0]
+        del self.text_index._lexicon._words[wid]
+
+        result = self.run_index_healthcheck()
+
+        self.assertEqual([rid], list(result.unhealthy_rids))
+        # the lexicon is shared with other text indexes
+        self.assertIn(
+            ('SearchableText', 'in_wordinfo_not_in_lexicon'),
+            result.unhealthy_rids[rid].index_symptoms)
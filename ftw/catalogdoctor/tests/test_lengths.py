@@ -0,0 +1,88 @@
+from ftw.catalogdoctor.lengths import LengthRepair
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from ftw.catalogdoctor.tests import MockFormatter
+
+
+class TestLengthRepair(FunctionalTestCase):
+
+    def setUp(self):
+        super(TestLengthRepair, self).setUp()
+
+        self.folder, self.other_folder = self.create_folders(
+            u'Foo', u'Bar')
+
+    def run_repair(self, chunk_size=None):
+        self.maybe_process_indexing_queue()
+        return LengthRepair(self.portal_catalog, chunk_size=chunk_size).run()
+
+    def test_healthy_catalog_is_not_changed(self):
+        result = self.run_repair()
+
+        self.assertFalse(result.has_repaired())
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_resets_catalog_length(self):
+        self.catalog._length.change(3)
+        self.assertFalse(self.run_index_healthcheck().is_length_healthy())
+
+        result = self.run_repair()
+
+        self.assertEqual([('_length', 5, 2)], result.repaired)
+        self.assertEqual(2, len(self.catalog))
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_resets_index_lengths(self):
+        self.catalog.indexes['UID']._length.change(-1)
+        self.catalog.indexes['path']._length.set(0)
+        self.catalog.indexes['SearchableText'].index.document_count.change(1)
+        self.assertFalse(self.run_index_healthcheck().is_healthy())
+
+        result = self.run_repair()
+
+        self.assertEqual(
+            [
+                ('indexes.SearchableText.index.document_count', 3, 2),
+                ('indexes.UID._length', 1, 2),
+                ('indexes.path._length', 0, 2),
+            ],
+            result.repaired)
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_resets_boolean_index_length(self):
+        index = self.catalog.indexes['is_folderish']
+        length = index._index_length()
+        index._index_length.change(4)
+
+        result = self.run_repair()
+
+        self.assertEqual(
+            [('indexes.is_folderish._index_length', length + 4, length)],
+            result.repaired)
+        self.assertEqual(length, index._index_length())
+
+    def test_counts_in_chunks(self):
+        index = self.catalog.indexes['is_folderish']
+        length = index._index_length()
+        index._index_length.change(1)
+        self.catalog._length.change(3)
+
+        result = self.run_repair(chunk_size=1)
+
+        self.assertEqual(
+            [('_length', 5, 2),
+             ('indexes.is_folderish._index_length', length + 1, length)],
+            result.repaired)
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_logging(self):
+        self.catalog._length.change(3)
+
+        result = self.run_repair()
+        formatter = MockFormatter()
+        result.write_result(formatter)
+
+        lines = formatter.getlines()
+        self.assertEqual(
+            ['Reset 1 of {} length counters:'.format(result.counters),
+             ' _length: 5 -> 2'],
+            lines)
@@ -0,0 +1,228 @@
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree
+from ftw.catalogdoctor.exceptions import CantPerformSurgery
+from ftw.catalogdoctor.rebuild import IndexRebuild
+from ftw.catalogdoctor.rebuild import MappingRebuild
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from ftw.catalogdoctor.tests import MockFormatter
+
+
+class TestIndexRebuild(FunctionalTestCase):
+
+    def setUp(self):
+        super(TestIndexRebuild, self).setUp()
+
+        self.folder, self.other_folder = self.create_folders(
+            u'Foo', u'Bar')
+
+    def run_rebuild(self, index_name, from_forward_index=False):
+        self.maybe_process_indexing_queue()
+        return IndexRebuild(
+            index_name, catalog=self.portal_catalog,
+            from_forward_index=from_forward_index).run()
+
+    def test_rebuilds_forward_index_from_reverse_index(self):
+        index = self.catalog.indexes['portal_type']
+        index._index = OOBTree()
+        index._length.set(7)
+        self.assertFalse(self.run_index_healthcheck().is_healthy())
+
+        result = self.run_rebuild('portal_type')
+
+        self.assertEqual(1, result.keys)
+        self.assertEqual(2, result.rids)
+        self.assertEqual(
+            [self.get_rid(self.folder), self.get_rid(self.other_folder)],
+            sorted(index._index['Folder']))
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_rebuilds_keyword_index(self):
+        index = self.catalog.indexes['object_provides']
+        rid = self.get_rid(self.folder)
+        keywords = sorted(index._unindex[rid])
+        for keyword in keywords:
+            index._index[keyword].remove(rid)
+
+        self.run_rebuild('object_provides')
+
+        for keyword in keywords:
+            self.assertIn(rid, index._index[keyword])
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_rebuilds_reverse_index_from_forward_index(self):
+        index = self.catalog.indexes['object_provides']
+        rid = self.get_rid(self.folder)
+        keywords = sorted(index._unindex[rid])
+        del index._unindex[rid]
+
+        self.run_rebuild('object_provides', from_forward_index=True)
+
+        self.assertEqual(keywords, index._unindex[rid])
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_rebuilds_uuid_index(self):
+        index = self.catalog.indexes['UID']
+        rid = self.get_rid(self.folder)
+        del index._index[index._unindex[rid]]
+
+        result = self.run_rebuild('UID')
+
+        self.assertEqual(2, result.keys)
+        self.assertEqual(rid, index._index[index._unindex[rid]])
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_does_not_rebuild_uuid_index_with_duplicate_uuids(self):
+        index = self.catalog.indexes['UID']
+        original = index._index
+        rid = self.get_rid(self.folder)
+        other_rid = self.get_rid(self.other_folder)
+        index._unindex[other_rid] = index._unindex[rid]
+
+        with self.assertRaises(CantPerformSurgery):
+            self.run_rebuild('UID')
+        self.assertIs(original, index._index)
+
+    def test_does_not_rebuild_unhandled_index_type(self):
+        with self.assertRaises(CantPerformSurgery):
+            self.run_rebuild('path')
+
+    def test_logging(self):
+        result = self.run_rebuild('portal_type')
+        formatter = MockFormatter()
+        result.write_result(formatter)
+
+        self.assertEqual(
+            [
+                'Rebuilt forward index of portal_type from its reverse '
+                'index.',
+                ' 1 keys, 2 rids',
+            ],
+            formatter.getlines())
+
+
+class TestMappingRebuild(FunctionalTestCase):
+
+    maxDiff = None
+
+    def setUp(self):
+        super(TestMappingRebuild, self).setUp()
+
+        self.folder, self.other_folder = self.create_folders(
+            u'Foo', u'Bar')
+
+    def run_rebuild(self, mapping):
+        self.maybe_process_indexing_queue()
+        return MappingRebuild(mapping, catalog=self.portal_catalog).run()
+
+    def test_rebuilds_uids_from_paths(self):
+        expected = dict(self.catalog.uids.items())
+        self.catalog.uids = OOBTree()
+        self.catalog._length.set(0)
+        self.assertFalse(self.run_healthcheck().is_healthy())
+
+        result = self.run_rebuild('uids')
+
+        self.assertEqual(2, result.length)
+        self.assertEqual([], result.skipped)
+        self.assertEqual(expected, dict(self.catalog.uids.items()))
+        self.assertEqual(2, len(self.catalog))
+        self.assertTrue(self.run_healthcheck().is_healthy())
+
+    def test_rebuilds_paths_from_uids(self):
+        expected = dict(self.catalog.paths.items())
+        self.catalog.paths = IOBTree()
+
+        result = self.run_rebuild('paths')
+
+        self.assertEqual(2, result.length)
+        self.assertEqual(expected, dict(self.catalog.paths.items()))
+        self.assertTrue(self.run_healthcheck().is_healthy())
+
+    def test_skips_entries_contradicted_by_path_index(self):
+        rid = self.get_rid(self.folder)
+        self.catalog.paths[rid] = '/plone/qux'
+
+        result = self.run_rebuild('uids')
+
+        self.assertEqual(
+            [(rid, '/plone/qux',
+              'path index has {}'.format(self.get_physical_path(
+                  self.folder)))],
+            result.skipped)
+        self.assertNotIn('/plone/qux', self.catalog.uids)
+        self.assertEqual(1, len(self.catalog))
+
+    def test_skips_entries_not_indexed(self):
+        extra_rid = self.choose_next_rid()
+        self.catalog.paths[extra_rid] = '/plone/qux'
+
+        result = self.run_rebuild('uids')
+
+        self.assertEqual([(extra_rid, '/plone/qux', 'not indexed')],
+                         result.skipped)
+        self.assertEqual(2, len(self.catalog))
+
+    def test_prefers_entry_confirmed_by_path_index(self):
+        rid = self.get_rid(self.folder)
+        path = self.get_physical_path(self.folder)
+        extra_rid = self.choose_next_rid()
+        self.catalog.paths[extra_rid] = path
+        self.catalog.indexes['UID']._unindex[extra_rid] = 'qux'
+
+        result = self.run_rebuild('uids')
+
+        self.assertEqual(rid, self.catalog.uids[path])
+        self.assertEqual([(extra_rid, path, 'duplicate')], result.skipped)
+
+    def test_resets_length_to_uids_when_rebuilding_paths(self):
+        rid = self.get_rid(self.folder)
+        self.catalog.uids['/plone/qux'] = rid
+
+        result = self.run_rebuild('paths')
+
+        self.assertEqual(
+            [(rid, '/plone/qux', 'path index has {}'.format(
+                self.get_physical_path(self.folder)))],
+            result.skipped)
+        self.assertEqual(3, len(self.catalog.uids))
+        self.assertEqual(3, len(self.catalog))
+        self.assertEqual(3, result.length)
+
+    def test_does_not_reset_plain_int_length(self):
+        self.catalog._length = 2
+
+        result = self.run_rebuild('uids')
+
+        self.assertEqual(2, result.length)
+        self.assertEqual(2, self.catalog._length)
+
+    def test_does_not_rebuild_without_path_and_uid_index(self):
+        self.catalog.delIndex('UID')
+
+        with self.assertRaises(CantPerformSurgery) as cm:
+            self.run_rebuild('uids')
+
+        self.assertEqual(
+            "Can't rebuild uids without an index named UID, its reverse "
+            "index is needed to validate the entries.",
+            str(cm.exception))
+
+    def test_does_not_rebuild_other_mappings(self):
+        with self.assertRaises(CantPerformSurgery):
+            MappingRebuild('data', catalog=self.portal_catalog)
+
+    def test_logging(self):
+        extra_rid = self.choose_next_rid()
+        self.catalog.paths[extra_rid] = '/plone/qux'
+
+        result = self.run_rebuild('uids')
+        formatter = MockFormatter()
+        result.write_result(formatter)
+
+        self.assertEqual(
+            [
+                'Rebuilt uids from paths, catalog length is 2.',
+                'Skipped 1 entries:',
+                " rid {} ('/plone/qux'): not indexed".format(extra_rid),
+            ],
+            formatter.getlines())
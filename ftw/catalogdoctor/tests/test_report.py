@@ -0,0 +1,112 @@
+from ftw.builder import Builder
+from ftw.builder import create
+from ftw.catalogdoctor.report import AggregatedReport
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from ftw.catalogdoctor.tests import MockFormatter
+from tempfile import mkdtemp
+import os
+import shutil
+
+
+class TestAggregatedReport(FunctionalTestCase):
+
+    maxDiff = None
+
+    def setUp(self):
+        super(TestAggregatedReport, self).setUp()
+
+        self.grant('Contributor')
+        self.folder = create(Builder('folder').titled(u'Foo'))
+
+        self.extra_rids = sorted(self.choose_next_rid() for i in range(3))
+        for rid in self.extra_rids:
+            self.catalog.data[rid] = dict()
+
+        self.unindexed_rid = self.choose_next_rid()
+        self.catalog.indexes['UID']._unindex[self.unindexed_rid] = 'qux'
+
+    def test_groups_rids_by_symptoms(self):
+        result = self.run_healthcheck()
+        groups = AggregatedReport(result).get_groups()
+
+        self.assertEqual([3, 1], [len(group) for group in groups])
+        self.assertEqual(self.extra_rids, groups[0].rids)
+        self.assertEqual(
+            (
+                'in_metadata_keys_not_in_paths_keys',
+                'in_metadata_keys_not_in_uids_values',
+            ),
+            groups[0].symptoms)
+        self.assertEqual([self.unindexed_rid], groups[1].rids)
+
+    def test_rids_by_symptom(self):
+        result = self.run_healthcheck()
+
+        self.assertEqual(
+            self.extra_rids,
+            list(result.get_rids_with_symptom(
+                'in_metadata_keys_not_in_paths_keys')))
+        self.assertEqual(
+            [self.unindexed_rid],
+            list(result.get_rids_with_symptom(
+                'in_uuid_unindex_not_in_uuid_index')))
+        self.assertEqual(
+            [], list(result.get_rids_with_symptom(
+                'in_uuid_index_not_in_catalog')))
+
+    def test_logging_reports_bounded_sample_per_group(self):
+        result = self.run_healthcheck()
+        formatter = MockFormatter()
+        AggregatedReport(result, sample_size=2).write_result(formatter)
+
+        expected = [
+            'Catalog health check report:',
+            'Inconsistent catalog length:',
+            ' claimed length: 1',
+            ' uids length: 1',
+            ' paths length: 1',
+            ' metadata length: 4',
+            ' uid index claimed length: 1',
+            ' uid index index length: 1',
+            ' uid index unindex length: 2',
+            'Catalog data is unhealthy, found 4 unhealthy rids in 2 symptom '
+            'groups:',
+            '3 rids with symptoms:',
+            '\t- in_metadata_keys_not_in_paths_keys',
+            '\t- in_metadata_keys_not_in_uids_values',
+            ' rid {} (--no path--)'.format(self.extra_rids[0]),
+            ' rid {} (--no path--)'.format(self.extra_rids[1]),
+            ' ... and 1 more',
+            '',
+            '1 rids with symptoms:',
+            '\t- in_uuid_unindex_not_in_catalog',
+            '\t- in_uuid_unindex_not_in_uuid_index',
+            ' rid {} (--no path--)'.format(self.unindexed_rid),
+            '',
+        ]
+        self.assertEqual(expected, formatter.getlines())
+
+    def test_writes_all_rids_to_details_file(self):
+        tempdir = mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        details_path = os.path.join(tempdir, 'details.tsv')
+
+        result = self.run_healthcheck()
+        formatter = MockFormatter()
+        AggregatedReport(
+            result, sample_size=1, details_path=details_path,
+        ).write_result(formatter)
+
+        self.assertEqual(
+            'Details of all unhealthy rids have been written to {}.'.format(
+                details_path),
+            formatter.getlines()[-1])
+        with open(details_path) as details_file:
+            lines = details_file.read().splitlines()
+        self.assertEqual(
+            ['{}\t\tin_metadata_keys_not_in_paths_keys, '
+             'in_metadata_keys_not_in_uids_values'.format(rid)
+             for rid in self.extra_rids]
+            + ['{}\t\tin_uuid_unindex_not_in_catalog, '
+               'in_uuid_unindex_not_in_uuid_index'.format(self.unindexed_rid)],
+            lines)
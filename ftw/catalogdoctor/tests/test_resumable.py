@@ -0,0 +1,86 @@
+from ftw.builder import Builder
+from ftw.builder import create
+from ftw.catalogdoctor.resumable import ResumableHealthCheck
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from tempfile import mkdtemp
+import os
+import shutil
+import transaction
+
+
+class TestResumableHealthCheck(FunctionalTestCase):
+
+    def setUp(self):
+        super(TestResumableHealthCheck, self).setUp()
+
+        self.grant('Contributor')
+        self.folder = create(Builder('folder').titled(u'Foo'))
+        self.other_folder = create(Builder('folder').titled(u'Bar'))
+        self.maybe_process_indexing_queue()
+
+        self.tempdir = mkdtemp()
+        self.cursor_path = os.path.join(self.tempdir, 'cursor')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super(TestResumableHealthCheck, self).tearDown()
+
+    def run_resumable_healthcheck(self, time_budget=None):
+        return ResumableHealthCheck(
+            self.cursor_path, time_budget=time_budget,
+            catalog=self.portal_catalog, chunk_size=1).run()
+
+    def run_until_completed(self):
+        """Run with a time budget that only allows for one chunk per run."""
+
+        runs = 1
+        result = self.run_resumable_healthcheck(time_budget=1e-9)
+        while result is None:
+            self.assertTrue(os.path.exists(self.cursor_path))
+            runs += 1
+            result = self.run_resumable_healthcheck(time_budget=1e-9)
+        return runs, result
+
+    def test_completes_without_time_budget(self):
+        transaction.commit()
+
+        result = self.run_resumable_healthcheck()
+
+        self.assertTrue(result.is_healthy())
+        self.assertFalse(os.path.exists(self.cursor_path))
+
+    def test_resumed_healthcheck_reports_same_result(self):
+        path = self.get_physical_path(self.folder)
+        rid = self.catalog.uids.pop(path)
+        extra_rid = self.choose_next_rid()
+        self.catalog.data[extra_rid] = dict()
+        transaction.commit()
+
+        runs, result = self.run_until_completed()
+        expected = self.run_healthcheck()
+
+        self.assertGreater(runs, 1)
+        self.assertFalse(os.path.exists(self.cursor_path))
+        self.assertEqual(2, len(result.unhealthy_rids))
+        self.assertEqual(
+            expected.get_symptoms(rid), result.get_symptoms(rid))
+        self.assertEqual(
+            expected.get_symptoms(extra_rid), result.get_symptoms(extra_rid))
+        self.assertEqual(expected.uids_length, result.uids_length)
+        self.assertEqual(expected.paths_length, result.paths_length)
+        self.assertEqual(expected.data_length, result.data_length)
+        self.assertEqual(
+            expected.uuid_index_index_length, result.uuid_index_index_length)
+
+    def test_resumed_healthcheck_ignores_later_changes(self):
+        transaction.commit()
+        self.assertIsNone(self.run_resumable_healthcheck(time_budget=1e-9))
+
+        extra_rid = self.choose_next_rid()
+        self.catalog.data[extra_rid] = dict()
+        transaction.commit()
+
+        runs, result = self.run_until_completed()
+
+        self.assertTrue(result.is_healthy())
+        self.assertFalse(self.run_healthcheck().is_healthy())
@@ -0,0 +1,120 @@
+from BTrees.IOBTree import IOBTree
+from ftw.builder import Builder
+from ftw.builder import create
+from ftw.catalogdoctor.sampling import sample_key
+from ftw.catalogdoctor.sampling import SamplingHealthCheck
+from ftw.catalogdoctor.sampling import wilson_interval
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from ftw.catalogdoctor.tests import MockFormatter
+from unittest import TestCase
+import random
+
+
+class TestWilsonInterval(TestCase):
+
+    def test_no_trials_allow_any_rate(self):
+        self.assertEqual((0.0, 1.0), wilson_interval(0, 0))
+
+    def test_no_successes_have_positive_upper_bound(self):
+        lower, upper = wilson_interval(0, 100)
+
+        self.assertEqual(0.0, lower)
+        self.assertAlmostEqual(0.037, upper, places=3)
+
+    def test_interval_contains_proportion(self):
+        lower, upper = wilson_interval(5, 10)
+
+        self.assertAlmostEqual(0.237, lower, places=3)
+        self.assertAlmostEqual(0.763, upper, places=3)
+
+
+class TestSampleKey(TestCase):
+
+    def test_samples_from_single_bucket(self):
+        tree = IOBTree({1: 'a', 2: 'b', 3: 'c'})
+        rand = random.Random(0)
+
+        keys = set(sample_key(tree, rand) for i in range(100))
+
+        self.assertEqual(set([1, 2, 3]), keys)
+
+    def test_samples_all_keys_of_multiple_buckets(self):
+        tree = IOBTree()
+        # rids are assigned in runs, key ranges are distributed unevenly
+        for key in range(1000):
+            tree[key] = 'a'
+        for key in range(10 ** 6, 10 ** 6 + 50):
+            tree[key] = 'b'
+        rand = random.Random(0)
+
+        values = [tree[sample_key(tree, rand)] for i in range(5000)]
+
+        share = values.count('b') / float(len(values))
+        self.assertAlmostEqual(50 / 1050.0, share, delta=0.02)
+
+
+class TestSamplingHealthCheck(FunctionalTestCase):
+
+    maxDiff = None
+
+    def setUp(self):
+        super(TestSamplingHealthCheck, self).setUp()
+
+        self.grant('Contributor')
+        self.folder = create(Builder('folder').titled(u'Foo'))
+
+    def run_sampling(self, sample_size=300):
+        self.maybe_process_indexing_queue()
+        return SamplingHealthCheck(
+            self.portal_catalog, sample_size=sample_size, seed=0).run()
+
+    def test_healthy_catalog(self):
+        result = self.run_sampling()
+
+        self.assertTrue(result.is_healthy())
+        self.assertEqual(
+            ['paths', 'metadata', 'uid index unindex'],
+            [sample.name for sample in result.samples])
+        for sample in result.samples:
+            self.assertEqual(100, sample.size)
+            self.assertEqual(0.0, sample.get_estimated_rate())
+
+    def test_finds_rid_missing_from_other_data_structures(self):
+        extra_rid = self.choose_next_rid()
+        self.catalog.data[extra_rid] = dict()
+
+        result = self.run_sampling()
+
+        self.assertFalse(result.is_healthy())
+        self.assertEqual([extra_rid], list(result.unhealthy_rids))
+        self.assertEqual(
+            (
+                'in_metadata_keys_not_in_paths_keys',
+                'in_metadata_keys_not_in_uids_values',
+            ),
+            result.unhealthy_rids[extra_rid].catalog_symptoms)
+
+        paths, metadata, uuid_unindex = result.samples
+        self.assertEqual(0, paths.unhealthy)
+        self.assertEqual(0, uuid_unindex.unhealthy)
+        self.assertGreater(metadata.unhealthy, 0)
+        lower, upper = metadata.get_confidence_interval()
+        self.assertLess(lower, 0.5)
+        self.assertGreater(upper, 0.5)
+
+    def test_logging(self):
+        result = self.run_sampling(sample_size=30)
+        formatter = MockFormatter()
+        result.write_result(formatter)
+        expected = [
+            'Catalog sampling report:',
+            ' claimed length: 1',
+            ' paths: 0 of 10 sampled rids unhealthy, estimated rate 0.00% '
+            '(confidence interval 0.00% to 27.75%).',
+            ' metadata: 0 of 10 sampled rids unhealthy, estimated rate 0.00% '
+            '(confidence interval 0.00% to 27.75%).',
+            ' uid index unindex: 0 of 10 sampled rids unhealthy, estimated '
+            'rate 0.00% (confidence interval 0.00% to 27.75%).',
+            'No unhealthy rids found in samples.',
+        ]
+        self.assertEqual(expected, formatter.getlines())
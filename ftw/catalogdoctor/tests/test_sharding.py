@@ -0,0 +1,144 @@
+from ftw.builder import Builder
+from ftw.builder import create
+from ftw.catalogdoctor.sharding import _get_worker_catalog
+from ftw.catalogdoctor.sharding import _init_worker
+from ftw.catalogdoctor.sharding import _worker
+from ftw.catalogdoctor.sharding import HealthCheckShard
+from ftw.catalogdoctor.sharding import Shard
+from ftw.catalogdoctor.sharding import ShardedHealthCheck
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from ftw.catalogdoctor.utils import MISSING
+from ftw.catalogdoctor.utils import split_into_ranges
+from itertools import izip_longest
+import transaction
+
+
+class TestShardedHealthCheck(FunctionalTestCase):
+
+    def setUp(self):
+        super(TestShardedHealthCheck, self).setUp()
+
+        self.grant('Contributor')
+        self.folder = create(Builder('folder').titled(u'Foo'))
+        self.other_folder = create(Builder('folder').titled(u'Bar'))
+        self.another_folder = create(Builder('folder').titled(u'Qux'))
+
+    def make_shards(self, rid_boundaries, path_boundaries, uuid_boundaries):
+        return [
+            Shard(*ranges) for ranges in izip_longest(
+                split_into_ranges(rid_boundaries),
+                split_into_ranges(path_boundaries),
+                split_into_ranges(uuid_boundaries))
+        ]
+
+    def run_sharded_healthcheck(self, shards):
+        healthcheck = ShardedHealthCheck(self.portal_catalog, processes=1)
+        return healthcheck.run_shards(shards)
+
+    def test_shard_restricts_key_ranges(self):
+        rids = sorted(self.catalog.paths.keys())
+        shard = Shard((rids[0], rids[1]), None, (MISSING, MISSING))
+
+        healthcheck = HealthCheckShard(self.portal_catalog, shard)
+        catalog_rids = healthcheck.collect_rids()
+
+        self.assertEqual([rids[1]], list(catalog_rids.in_paths))
+        self.assertEqual([], list(catalog_rids.in_catalog))
+        self.assertEqual(3, len(catalog_rids.in_uuid_index))
+
+    def test_healthy_catalog_in_shards(self):
+        rids = sorted(self.catalog.paths.keys())
+        shards = self.make_shards(
+            rids[:1], ['/plone/bar', '/plone/foo'], [])
+
+        result = self.run_sharded_healthcheck(shards)
+
+        self.assertTrue(result.is_healthy())
+        self.assertEqual(3, result.uids_length)
+        self.assertEqual(3, result.paths_length)
+
+    def test_symptoms_spanning_shards_are_merged(self):
+        # the path of the missing rid is in a different path range than
+        # its rid
+        path = self.get_physical_path(self.folder)
+        rid = self.catalog.uids.pop(path)
+        self.catalog.uids['/plone/aaa'] = rid
+        shards = self.make_shards(
+            [rid], ['/plone/a', '/plone/qux'], [])
+
+        result = self.run_sharded_healthcheck(shards)
+
+        self.assertFalse(result.is_healthy())
+        self.assertEqual(1, len(result.unhealthy_rids))
+        self.assertEqual(
+            (
+                'in_paths_values_not_in_uids_keys',
+                'in_uids_keys_not_in_paths_values',
+                'paths_tuple_mismatches_uids_tuple',
+            ),
+            result.get_symptoms(rid))
+        self.assertEqual(
+            ('/plone/aaa', '/plone/foo'),
+            result.unhealthy_rids[rid].paths)
+
+    def test_sharded_result_equals_healthcheck_result(self):
+        extra_rid = self.choose_next_rid()
+        self.catalog.data[extra_rid] = dict()
+        self.catalog.uids['/plone/aaa'] = self.get_rid(self.other_folder)
+        rids = sorted(self.catalog.paths.keys())
+        shards = self.make_shards(rids[:2], ['/plone/bar'], [])
+
+        result = self.run_healthcheck()
+        sharded_result = self.run_sharded_healthcheck(shards)
+
+        self.assertItemsEqual(
+            result.unhealthy_rids.keys(), sharded_result.unhealthy_rids.keys())
+        for rid in result.unhealthy_rids:
+            self.assertEqual(
+                result.get_symptoms(rid), sharded_result.get_symptoms(rid))
+            self.assertEqual(
+                result.unhealthy_rids[rid].paths,
+                sharded_result.unhealthy_rids[rid].paths)
+        self.assertEqual(result.uids_length, sharded_result.uids_length)
+        self.assertEqual(result.data_length, sharded_result.data_length)
+
+    def test_sharded_result_in_worker_processes(self):
+        extra_rid = self.choose_next_rid()
+        self.catalog.data[extra_rid] = dict()
+        self.catalog.uids['/plone/aaa'] = self.get_rid(self.other_folder)
+        self.maybe_process_indexing_queue()
+        transaction.commit()
+
+        result = self.run_healthcheck()
+        # forked workers open their copy of the test database
+        healthcheck = ShardedHealthCheck(
+            self.portal_catalog, processes=2,
+            open_database=self.portal._p_jar.db)
+        sharded_result = healthcheck.run()
+
+        self.assertFalse(sharded_result.is_healthy())
+        self.assertItemsEqual(
+            result.unhealthy_rids.keys(), sharded_result.unhealthy_rids.keys())
+        for rid in result.unhealthy_rids:
+            self.assertEqual(
+                result.get_symptoms(rid), sharded_result.get_symptoms(rid))
+        self.assertEqual(result.uids_length, sharded_result.uids_length)
+        self.assertEqual(result.data_length, sharded_result.data_length)
+
+    def test_worker_connection_is_pinned_to_tid(self):
+        self.maybe_process_indexing_queue()
+        transaction.commit()
+        db = self.portal._p_jar.db()
+        tid = db.storage.lastTransaction()
+        self.portal.manage_delObjects([self.folder.getId()])
+        self.maybe_process_indexing_queue()
+        transaction.commit()
+
+        catalog_path = '/'.join(self.portal_catalog.getPhysicalPath())
+        _init_worker(catalog_path, lambda: db, tid)
+        self.addCleanup(_worker.clear)
+        worker_catalog = _get_worker_catalog()
+        self.addCleanup(worker_catalog._p_jar.close)
+
+        self.assertEqual(3, len(worker_catalog._catalog.uids))
+        self.assertEqual(2, len(self.catalog.uids))
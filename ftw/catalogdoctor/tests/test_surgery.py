@@ -1,12 +1,17 @@
+from BTrees.IIBTree import IITreeSet
+from BTrees.OOBTree import OOBTree
 from ftw.builder import Builder
 from ftw.builder import create
 from ftw.catalogdoctor.exceptions import CantPerformSurgery
+from ftw.catalogdoctor.scheduler import SurgeryScheduler
 from ftw.catalogdoctor.surgery import CatalogDoctor
+from ftw.catalogdoctor.surgery import KeyLookup
 from ftw.catalogdoctor.surgery import RemoveExtraRid
 from ftw.catalogdoctor.surgery import RemoveOrphanedRid
 from ftw.catalogdoctor.surgery import RemoveRidOrReindexObject
 from ftw.catalogdoctor.tests import FunctionalTestCase
 from plone.uuid.interfaces import IUUID
+from unittest import TestCase
 
 
 class TestSurgery(FunctionalTestCase):
@@ -264,6 +269,59 @@ class TestSurgery(FunctionalTestCase):
 
         self.assert_no_unhealthy_rids()
 
+    def test_surgery_reindexes_indexes_the_rid_was_missing_from(self):
+        self.make_missing_uuid_forward_index_entry(self.child)
+        self.catalog.indexes['portal_type'].unindex_object(
+            self.get_rid(self.child))
+
+        result = self.run_healthcheck()
+        doctor = CatalogDoctor(self.catalog, result.get_unhealthy_rids()[0])
+        doctor.perform_surgery()
+
+        self.assertEqual([self.child], doctor.surgery.to_reindex)
+
+        doctor.perform_post_op()
+        self.maybe_process_indexing_queue()
+        self.assertEqual(
+            'Folder',
+            self.catalog.indexes['portal_type'].getEntryForObject(
+                self.get_rid(self.child)))
+        self.assert_no_unhealthy_rids()
+
+    def test_surgery_removes_forward_only_stale_index_entry(self):
+        self.make_missing_uuid_forward_index_entry(self.child)
+        rid = self.get_rid(self.child)
+        portal_type_index = self.catalog.indexes['portal_type']
+        portal_type_index.insertForwardIndexEntry('Stale', rid)
+
+        result = self.run_index_healthcheck()
+        unhealthy_rid = result.unhealthy_rids[rid]
+        self.assertIn(
+            ('portal_type', 'index_tuple_mismatches_unindex_tuple'),
+            unhealthy_rid.index_symptoms)
+
+        doctor = CatalogDoctor(self.catalog, unhealthy_rid)
+        doctor.perform_surgery()
+        self.assertNotIn('Stale', portal_type_index._index)
+
+        doctor.perform_post_op()
+        self.maybe_process_indexing_queue()
+        self.assert_no_unhealthy_rids()
+
+    def test_scheduler_reindexes_objects_sorted_by_path(self):
+        self.drop_object_from_catalog_indexes(self.child)
+        self.drop_object_from_catalog_indexes(self.parent)
+
+        scheduler = SurgeryScheduler(
+            self.run_healthcheck(), catalog=self.portal_catalog)
+        for doctor in scheduler.doctors:
+            doctor.perform_surgery()
+
+        self.assertEqual(
+            ['/plone/parent', '/plone/parent/child'],
+            [path for path, surgery, obj
+             in scheduler.get_objects_to_reindex()])
+
     def test_surgery_drop_duplicate_from_acquisition_from_catalog_for_missing_uuid(self):
         grandchild = create(Builder('folder')
                             .within(self.child)
@@ -488,3 +546,107 @@ class TestSurgery(FunctionalTestCase):
         self.assertNotIn(rid, self.catalog.data)
 
         self.assert_no_unhealthy_rids()
+
+
+class TestSurgeryVerification(FunctionalTestCase):
+
+    def setUp(self):
+        super(TestSurgeryVerification, self).setUp()
+
+        self.grant('Contributor')
+        self.folder = create(Builder('folder').titled(u'Foo'))
+        self.other = create(Builder('folder').titled(u'Bar'))
+
+    def make_orphaned_rid_of_present_object(self):
+        rid = self.get_rid(self.folder)
+        del self.catalog.uids[self.get_physical_path(self.folder)]
+        uuid_index = self.catalog.indexes['UID']
+        del uuid_index._index[uuid_index._unindex[rid]]
+        uuid_index._length.change(-1)
+        return rid
+
+    def perform_surgeries(self, healthcheck_result):
+        scheduler = SurgeryScheduler(
+            healthcheck_result, catalog=self.portal_catalog)
+        scheduler.perform_surgeries()
+        self.maybe_process_indexing_queue()
+        return scheduler
+
+    def test_verifies_new_rid_of_reindexed_object(self):
+        rid = self.make_orphaned_rid_of_present_object()
+
+        scheduler = self.perform_surgeries(self.run_healthcheck())
+        verification = scheduler.verify()
+
+        new_rid = self.get_rid(self.folder)
+        self.assertNotEqual(rid, new_rid)
+        self.assertTrue(verification.is_healthy())
+        self.assertEqual(2, verification.claimed_length)
+
+        self.catalog.indexes['UID']._unindex.pop(new_rid)
+        verification = scheduler.verify()
+        self.assertFalse(verification.is_catalog_data_healthy())
+        self.assertEqual([new_rid], list(verification.unhealthy_rids))
+
+    def test_derives_catalog_length_after_surgery(self):
+        self.make_orphaned_rid_of_present_object()
+        result = self.run_healthcheck()
+        self.assertFalse(result.is_length_healthy())
+
+        scheduler = self.perform_surgeries(result)
+        verification = scheduler.verify()
+        post_result = self.run_healthcheck()
+
+        self.assertEqual(
+            (post_result.claimed_length,
+             post_result.uids_length,
+             post_result.paths_length,
+             post_result.data_length,
+             post_result.uuid_index_claimed_length,
+             post_result.uuid_index_index_length,
+             post_result.uuid_index_unindex_length),
+            (verification.claimed_length,
+             verification.uids_length,
+             verification.paths_length,
+             verification.data_length,
+             verification.uuid_index_claimed_length,
+             verification.uuid_index_index_length,
+             verification.uuid_index_unindex_length))
+
+    def test_detects_inconsistent_catalog_length_after_surgery(self):
+        self.make_orphaned_rid_of_present_object()
+
+        scheduler = self.perform_surgeries(self.run_healthcheck())
+        self.catalog._length.change(1)
+        verification = scheduler.verify()
+
+        self.assertTrue(verification.is_catalog_data_healthy())
+        self.assertFalse(verification.is_healthy())
+
+
+class TestKeyLookup(TestCase):
+
+    def test_finds_keys_of_scheduled_rids_in_one_pass(self):
+        tree = OOBTree({'foo': IITreeSet((1, 2)), 'bar': IITreeSet((2, 3))})
+        lookup = KeyLookup([1, 2])
+
+        self.assertEqual(['foo'], lookup.find_keys_pointing_to_rid(tree, 1))
+        del tree['bar']  # keys of scheduled rids have already been found
+        self.assertEqual(
+            ['bar', 'foo'], lookup.find_keys_pointing_to_rid(tree, 2))
+
+    def test_hands_out_keys_once(self):
+        tree = OOBTree({'foo': IITreeSet((1, 2))})
+        lookup = KeyLookup([1])
+
+        self.assertEqual(['foo'], lookup.find_keys_pointing_to_rid(tree, 1))
+        self.assertEqual([], lookup.find_keys_pointing_to_rid(tree, 1))
+
+    def test_looks_up_unscheduled_rids_individually(self):
+        tree = OOBTree({'foo': IITreeSet((1, 2)), 'bar': IITreeSet((2, 3))})
+        lookup = KeyLookup()
+
+        self.assertEqual(
+            ['bar', 'foo'], lookup.find_keys_pointing_to_rid(tree, 2))
+        del tree['bar']
+        self.assertEqual(['foo'], lookup.find_keys_pointing_to_rid(tree, 2))
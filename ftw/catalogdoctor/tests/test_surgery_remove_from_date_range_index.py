@@ -129,3 +129,18 @@ class TestRemoveFromDateRangeIndex(FunctionalTestCase):
 
         self.assertNotIn(rid, index._always)
         self.assertNotIn(rid, index._unindex)
+
+    def test_remove_with_mismatching_reverse_index_entry(self):
+        self.set_effective_range(date(2010, 1, 1), None)
+
+        rid = self.get_rid(self.folder)
+        index = self.catalog.indexes['effectiveRange']
+        index._unindex[rid] = (None, None)
+
+        surgery = RemoveFromDateRangeIndex(index, rid)
+        surgery.perform()
+
+        self.assertEqual(
+            0, len(find_keys_pointing_to_rid(index._since_only, rid)))
+        self.assertNotIn(rid, index._always)
+        self.assertNotIn(rid, index._unindex)
@@ -119,3 +119,20 @@ class TestRemoveFromExtendedPathIndex(FunctionalTestCase):
         self.assertEqual(2, len(index._unindex))
         # index stats
         self.assertEqual(2, len(index))
+
+    def test_remove_with_mismatching_reverse_index_entry(self):
+        rid = self.get_rid(self.sibling_folder)
+        index = self.catalog.indexes['path']
+        index._unindex[rid] = '/plone/foo/qux'
+
+        surgery = RemoveFromExtendedPathIndex(index, rid)
+        surgery.perform()
+
+        self.assertNotIn('sibling', index._index)
+        self.assertNotIn(rid, index._index['plone'][0])
+        self.assertNotIn(rid, index._index[None][1])
+        self.assertEqual(
+            [], find_keys_pointing_to_rid(index._index_items, rid))
+        self.assertEqual(
+            [], find_keys_pointing_to_rid(index._index_parents, rid))
+        self.assertNotIn(rid, index._unindex)
@@ -2,6 +2,7 @@ from datetime import date
 from ftw.builder import Builder
 from ftw.builder import create
 from ftw.catalogdoctor.compat import DateRecurringIndex
+from ftw.catalogdoctor.surgery import RemoveFromKeywordIndex
 from ftw.catalogdoctor.surgery import RemoveFromUnIndex
 from ftw.catalogdoctor.tests import FunctionalTestCase
 from ftw.catalogdoctor.utils import find_keys_pointing_to_rid
@@ -133,3 +134,31 @@ class TestRemoveFromUnIndex(FunctionalTestCase):
         self.assertEqual(0, len(entries_pointing_to_rid))
         self.assertNotIn(rid, index._unindex)
         self.assertEqual(0, len(index))
+
+    def test_remove_keywords_found_via_reverse_index(self):
+        rid = self.get_rid(self.folder)
+        index = self.catalog.indexes['object_provides']
+
+        surgery = RemoveFromKeywordIndex(index, rid)
+        self.assertItemsEqual(
+            find_keys_pointing_to_rid(index, rid),
+            surgery.get_candidate_keys())
+        surgery.perform()
+
+        entries_pointing_to_rid = find_keys_pointing_to_rid(index, rid)
+        self.assertEqual(0, len(entries_pointing_to_rid))
+        self.assertNotIn(rid, index._unindex)
+        self.assertEqual(0, len(index))
+
+    def test_remove_object_with_mismatching_reverse_index_entry(self):
+        rid = self.get_rid(self.folder)
+        index = self.catalog.indexes['Type']
+        index._unindex[rid] = 'Qux'
+
+        surgery = RemoveFromUnIndex(index, rid)
+        surgery.perform()
+
+        entries_pointing_to_rid = find_keys_pointing_to_rid(index, rid)
+        self.assertEqual(0, len(entries_pointing_to_rid))
+        self.assertNotIn(rid, index._unindex)
+        self.assertEqual(0, len(index))
@@ -0,0 +1,108 @@
+from ftw.catalogdoctor.sweep import IndexSweep
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from ftw.catalogdoctor.tests import MockFormatter
+
+
+class TestIndexSweep(FunctionalTestCase):
+
+    maxDiff = None
+
+    def setUp(self):
+        super(TestIndexSweep, self).setUp()
+
+        self.folder, self.other_folder = self.create_folders(
+            u'Foo', u'Bar')
+
+    def run_sweep(self):
+        self.maybe_process_indexing_queue()
+        return IndexSweep(self.portal_catalog).run()
+
+    def make_stale_rid(self, obj):
+        """Drop obj from the catalog but leave its index entries behind."""
+
+        path = self.get_physical_path(obj)
+        rid = self.catalog.uids.pop(path)
+        del self.catalog.paths[rid]
+        del self.catalog.data[rid]
+        self.catalog._length.change(-1)
+        return rid
+
+    def test_healthy_catalog_is_not_changed(self):
+        result = self.run_sweep()
+
+        self.assertFalse(result.has_swept())
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_removes_stale_rid_from_all_indexes(self):
+        rid = self.make_stale_rid(self.folder)
+        self.assertIn(rid, self.run_index_healthcheck().unhealthy_rids)
+
+        result = self.run_sweep()
+
+        self.assertTrue(result.has_swept())
+        self.assertEqual(1, result.swept['UID'])
+        self.assertEqual(1, result.swept['path'])
+        self.assertEqual(1, result.swept['SearchableText'])
+        self.assertNotIn('getObjPositionInParent', result.swept)
+
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+        self.assertEqual(1, len(self.catalog.indexes['UID']))
+        self.assertEqual(
+            [self.get_rid(self.other_folder)],
+            list(self.catalog.indexes['UID']._unindex.keys()))
+
+    def test_removes_stale_rid_only_present_in_forward_index(self):
+        extra_rid = self.choose_next_rid()
+        rid = self.get_rid(self.folder)
+        index = self.catalog.indexes['portal_type']
+        index._index['Folder'].insert(extra_rid)
+
+        result = self.run_sweep()
+
+        self.assertEqual({'portal_type': 1}, result.swept)
+        self.assertIn(rid, index._index['Folder'])
+        self.assertNotIn(extra_rid, index._index['Folder'])
+
+    def test_keeps_entries_of_rids_registered_in_uids(self):
+        rid = self.get_rid(self.folder)
+        del self.catalog.paths[rid]
+
+        result = self.run_sweep()
+
+        self.assertFalse(result.has_swept())
+        self.assertIn(rid, self.catalog.indexes['UID']._unindex)
+
+    def test_skips_legacy_text_index_counters(self):
+        # older text indexes don't store their counters, the class provides
+        # methods computing them instead
+        text_index = self.catalog.indexes['SearchableText'].index
+        del text_index.length
+        del text_index.document_count
+        self.make_stale_rid(self.folder)
+
+        result = self.run_sweep()
+
+        self.assertEqual(1, result.swept['SearchableText'])
+        self.assertIn(('SearchableText', 'index.document_count'),
+                      result.skipped_counters)
+        self.assertEqual(1, text_index.document_count())
+        self.assertTrue(self.run_index_healthcheck().is_healthy())
+
+    def test_logging(self):
+        self.make_stale_rid(self.folder)
+
+        result = self.run_sweep()
+        formatter = MockFormatter()
+        result.write_result(formatter)
+
+        lines = formatter.getlines()
+        self.assertIn('Removed 1 stale rids from index UID.', lines)
+        self.assertEqual(len(result.swept), len(lines))
+
+    def test_logging_without_stale_rids(self):
+        result = self.run_sweep()
+        formatter = MockFormatter()
+        result.write_result(formatter)
+
+        self.assertEqual(
+            ['Found no stale rids in indexes.'], formatter.getlines())
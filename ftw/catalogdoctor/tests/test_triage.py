@@ -0,0 +1,65 @@
+from ftw.builder import Builder
+from ftw.builder import create
+from ftw.catalogdoctor.tests import FunctionalTestCase
+from ftw.catalogdoctor.tests import MockFormatter
+from ftw.catalogdoctor.triage import CatalogTriage
+
+
+class TestCatalogTriage(FunctionalTestCase):
+
+    def setUp(self):
+        super(TestCatalogTriage, self).setUp()
+
+        self.grant('Contributor')
+        self.folder = create(Builder('folder').titled(u'Foo'))
+
+    def run_triage(self):
+        self.maybe_process_indexing_queue()
+        return CatalogTriage(self.portal_catalog).run()
+
+    def test_healthy_catalog_is_consistent(self):
+        result = self.run_triage()
+
+        self.assertTrue(result.is_consistent())
+        self.assertEqual(1, result.get_claimed_length())
+
+    def test_diverging_counters_are_inconsistent(self):
+        self.catalog._length.change(1)
+
+        result = self.run_triage()
+
+        self.assertFalse(result.is_consistent())
+
+    def test_empty_data_structure_is_inconsistent(self):
+        self.catalog.data.clear()
+
+        result = self.run_triage()
+
+        self.assertFalse(result.is_consistent())
+
+    def test_does_not_detect_problems_with_intact_counters(self):
+        self.catalog.data[self.choose_next_rid()] = dict()
+
+        self.assertTrue(self.run_triage().is_consistent())
+        self.assertFalse(self.run_healthcheck().is_healthy())
+
+    def test_logging(self):
+        self.catalog._length.change(1)
+
+        result = self.run_triage()
+        formatter = MockFormatter()
+        result.write_result(formatter)
+
+        expected = [
+            'Catalog triage report:',
+            ' claimed length: 2',
+            ' uid index claimed length: 1',
+            ' path index claimed length: 1',
+            ' uids depth: 1',
+            ' paths depth: 1',
+            ' metadata depth: 1',
+            ' uid index index depth: 1',
+            ' uid index unindex depth: 1',
+            'Length counters are inconsistent, run a healthcheck.',
+        ]
+        self.assertEqual(expected, formatter.getlines())
@@ -1,10 +1,21 @@
 from BTrees.IIBTree import IITreeSet
+from BTrees.IOBTree import IOBTree
 from BTrees.OOBTree import OOBTree
 from ftw.catalogdoctor.tests import FunctionalTestCase
 from ftw.catalogdoctor.tests import Mock
 from ftw.catalogdoctor.utils import contains_or_equals_rid
+from ftw.catalogdoctor.utils import find_key_boundaries
 from ftw.catalogdoctor.utils import find_keys_pointing_to_rid
+from ftw.catalogdoctor.utils import find_keys_pointing_to_rids
+from ftw.catalogdoctor.utils import find_nested_keys_pointing_to_rids
+from ftw.catalogdoctor.utils import get_tree_depth
 from ftw.catalogdoctor.utils import is_shorter_path_to_same_file
+from ftw.catalogdoctor.utils import items_after
+from ftw.catalogdoctor.utils import iter_chunked
+from ftw.catalogdoctor.utils import merge_join
+from ftw.catalogdoctor.utils import MISSING
+from ftw.catalogdoctor.utils import split_into_ranges
+from functools import partial
 from Products.PluginIndexes.common.UnIndex import UnIndex
 from unittest import TestCase
 
@@ -50,6 +61,28 @@ class TestFindKeysPointingToRid(FunctionalTestCase):
         self.assertItemsEqual(['a key'], find_keys_pointing_to_rid(index, -12))
 
 
+class TestFindKeysPointingToRids(TestCase):
+
+    def test_find_keys_pointing_to_rids(self):
+        dictish = OOBTree({'foo': IITreeSet((5, -17, 43)),
+                           'bar': IITreeSet(),
+                           'qux': 5,
+                           'somekey': [-17, 1]})
+
+        self.assertEqual(
+            {5: ['foo', 'qux'], -17: ['foo', 'somekey']},
+            find_keys_pointing_to_rids(dictish, [5, -17, 99]))
+
+    def test_find_nested_keys_pointing_to_rids(self):
+        dictish = OOBTree({'foo': IOBTree({0: IITreeSet((5, 7)),
+                                           1: IITreeSet((7,))}),
+                           'bar': IOBTree({1: IITreeSet((5,))})})
+
+        self.assertEqual(
+            {5: [('bar', 1), ('foo', 0)]},
+            find_nested_keys_pointing_to_rids(dictish, [5]))
+
+
 class TestContainsOrEqualsRid(FunctionalTestCase):
 
     def test_contains_rid_truthy_set(self):
@@ -134,3 +167,120 @@ class TestIsShorterPath(TestCase):
     def test_falsy_is_shorter_path_different_order(self):
         self.assertFalse(
             is_shorter_path_to_same_file('/foo/1/zwo/bar', '/foo/zwo/1/bar'))
+
+
+class TestMergeJoin(TestCase):
+
+    def test_merge_join_yields_keys_in_order(self):
+        first = IOBTree({1: 'a', 5: 'b', 9: 'c'})
+        second = IOBTree({-3: 'x', 5: 'y'})
+
+        self.assertEqual(
+            [
+                (-3, (MISSING, 'x')),
+                (1, ('a', MISSING)),
+                (5, ('b', 'y')),
+                (9, ('c', MISSING)),
+            ],
+            list(merge_join(first.items(), second.items())))
+
+    def test_merge_join_empty_iterables(self):
+        self.assertEqual([], list(merge_join([], IOBTree().items())))
+
+    def test_merge_join_single_iterable(self):
+        self.assertEqual(
+            [(1, ('a',)), (2, ('b',))],
+            list(merge_join([(1, 'a'), (2, 'b')])))
+
+
+class TestIterChunked(TestCase):
+
+    def test_iter_chunked_yields_all_items(self):
+        tree = IOBTree({1: 'a', 2: 'b', 3: 'c', 7: 'd', 9: 'e'})
+        chunks = []
+
+        items = list(iter_chunked(
+            partial(items_after, tree), 2,
+            release=lambda: chunks.append(len(chunks))))
+
+        self.assertEqual(list(tree.items()), items)
+        self.assertEqual([0, 1], chunks)
+
+    def test_iter_chunked_continues_after_last_key(self):
+        tree = IOBTree({1: 'a', 2: 'b', 3: 'c'})
+
+        def release():
+            # keys added after the current chunk are visited
+            tree[10] = 'z'
+            # keys added before the current chunk are not visited again
+            tree[-1] = 'y'
+
+        self.assertEqual(
+            [(1, 'a'), (2, 'b'), (3, 'c'), (10, 'z')],
+            list(iter_chunked(partial(items_after, tree), 3, release)))
+
+    def test_items_after(self):
+        tree = IOBTree({1: 'a', 2: 'b', 3: 'c'})
+
+        self.assertEqual([(3, 'c')], list(items_after(tree, 2)))
+        self.assertEqual(list(tree.items()), list(items_after(tree)))
+
+    def test_items_after_none_key(self):
+        tree = OOBTree({None: 'a', 'foo': 'b'})
+
+        self.assertEqual([('foo', 'b')], list(items_after(tree, None)))
+        self.assertEqual(
+            [(None, 'a'), ('foo', 'b')],
+            list(iter_chunked(partial(items_after, tree), 1)))
+
+
+class TestKeyRanges(TestCase):
+
+    def test_find_key_boundaries_of_small_tree(self):
+        tree = IOBTree({1: 'a', 2: 'b'})
+
+        self.assertEqual([], find_key_boundaries(tree, 4))
+
+    def test_find_key_boundaries_of_empty_tree(self):
+        self.assertEqual([], find_key_boundaries(IOBTree(), 4))
+
+    def test_find_key_boundaries_split_tree_evenly(self):
+        tree = IOBTree()
+        for key in range(10000):
+            tree[key] = 'value'
+
+        boundaries = find_key_boundaries(tree, 4)
+        self.assertEqual(3, len(boundaries))
+        self.assertEqual(sorted(boundaries), boundaries)
+
+        sizes = [
+            len(list(items_after(tree, after, until=until)))
+            for after, until in split_into_ranges(boundaries)
+        ]
+        self.assertEqual(10000, sum(sizes))
+        for size in sizes:
+            self.assertGreater(size, 1000)
+
+    def test_split_into_ranges(self):
+        self.assertEqual(
+            [(MISSING, 3), (3, 7), (7, MISSING)],
+            split_into_ranges([3, 7]))
+
+    def test_split_into_ranges_without_boundaries(self):
+        self.assertEqual([(MISSING, MISSING)], split_into_ranges([]))
+
+
+class TestTreeDepth(TestCase):
+
+    def test_empty_tree_has_no_levels(self):
+        self.assertEqual(0, get_tree_depth(IOBTree()))
+
+    def test_inline_bucket_is_one_level(self):
+        self.assertEqual(1, get_tree_depth(IOBTree({1: 'a'})))
+
+    def test_depth_grows_with_tree(self):
+        tree = IOBTree(dict((key, 'a') for key in range(1000)))
+        self.assertEqual(2, get_tree_depth(tree))
+
+        tree.update(dict((key, 'a') for key in range(1000, 100000)))
+        self.assertEqual(3, get_tree_depth(tree))
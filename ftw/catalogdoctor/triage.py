@@ -0,0 +1,90 @@
+from ftw.catalogdoctor.utils import get_tree_depth
+from plone import api
+
+
+# path indexes count indexed documents in their length counter, most other
+# indexes count distinct indexed values.
+PATH_INDEX_META_TYPES = ('PathIndex', 'ExtendedPathIndex')
+
+
+class CatalogTriage(object):
+    """Quickly check whether the catalog's length counters agree.
+
+    Only reads the `BTrees.Length` counters of the catalog, of the `UID`
+    index and of path indexes, they all count the cataloged objects. The
+    BTrees inspected by the health check are not scanned, only their depth
+    is determined from their leftmost inner nodes. This takes a handful of
+    object loads regardless of the catalog size.
+
+    The triage detects no problems that leave the counters intact, it is
+    meant to decide cheaply whether to run a full `CatalogHealthCheck`.
+    """
+    def __init__(self, catalog=None):
+        self.portal_catalog = catalog or api.portal.get_tool('portal_catalog')
+        self.catalog = self.portal_catalog._catalog
+
+    def run(self):
+        result = TriageResult()
+
+        result.report_counter('claimed length', len(self.catalog))
+        result.report_counter(
+            'uid index claimed length', len(self.catalog.indexes['UID']))
+        for name, index in sorted(self.catalog.indexes.items()):
+            if index.meta_type in PATH_INDEX_META_TYPES:
+                result.report_counter(
+                    '{} index claimed length'.format(name), len(index))
+
+        uuid_index = self.catalog.indexes['UID']
+        for name, tree in (('uids', self.catalog.uids),
+                           ('paths', self.catalog.paths),
+                           ('metadata', self.catalog.data),
+                           ('uid index index', uuid_index._index),
+                           ('uid index unindex', uuid_index._unindex)):
+            result.report_depth(name, get_tree_depth(tree))
+
+        return result
+
+
+class TriageResult(object):
+    """Provide the result of one catalog triage run."""
+
+    def __init__(self):
+        self.counters = []
+        self.depths = []
+
+    def report_counter(self, name, value):
+        self.counters.append((name, value))
+
+    def report_depth(self, name, depth):
+        self.depths.append((name, depth))
+
+    def get_claimed_length(self):
+        return self.counters[0][1]
+
+    def is_consistent(self):
+        """Return whether the counters agree with each other.
+
+        A non-empty catalog must not have empty data structures.
+        """
+        values = set(value for name, value in self.counters)
+        if len(values) > 1:
+            return False
+
+        if self.get_claimed_length():
+            return all(depth for name, depth in self.depths)
+        return True
+
+    def write_result(self, formatter):
+        """Log result to logger."""
+
+        formatter.info("Catalog triage report:")
+        for name, value in self.counters:
+            formatter.info(" {}: {}".format(name, value))
+        for name, depth in self.depths:
+            formatter.info(" {} depth: {}".format(name, depth))
+
+        if self.is_consistent():
+            formatter.info("Length counters are consistent.")
+        else:
+            formatter.info(
+                "Length counters are inconsistent, run a healthcheck.")
@@ -1,3 +1,110 @@
+from BTrees.IIBTree import intersection
+from BTrees.IIBTree import IITreeSet
+from itertools import dropwhile
+
+
+class _Missing(object):
+    """Marker for absent keys or values, survives pickling as a singleton."""
+
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        return 'MISSING'
+
+
+MISSING = _Missing()
+
+
+def merge_join(*sorted_items):
+    """Walk several key-sorted iterables of `(key, value)` pairs in lockstep.
+
+    Yield a `(key, values)` tuple for every key present in at least one of the
+    iterables, in ascending key order. `values` contains one entry per
+    iterable, either the value stored for key or `MISSING` when the key is
+    absent from that iterable.
+
+    This allows comparing BTrees that share the same keys, e.g. the rid-keyed
+    catalog data structures, in a single pass without random lookups.
+
+    """
+    iterators = [iter(items) for items in sorted_items]
+    heads = [next(iterator, MISSING) for iterator in iterators]
+
+    while True:
+        keys = [head[0] for head in heads if head is not MISSING]
+        if not keys:
+            return
+
+        key = min(keys)
+        values = []
+        for position, head in enumerate(heads):
+            if head is not MISSING and head[0] == key:
+                values.append(head[1])
+                heads[position] = next(iterators[position], MISSING)
+            else:
+                values.append(MISSING)
+        yield key, tuple(values)
+
+
+def items_after(tree, key=MISSING, until=MISSING):
+    """Return key-sorted items of a BTree with keys greater than key.
+
+    Returns items from the first key when key is `MISSING`. If until is
+    provided only items with keys up to and including until are returned.
+    """
+    items = tree.items(
+        min=None if key is MISSING else key,
+        max=None if until is MISSING else until,
+        excludemin=key is not MISSING)
+    if key is None:
+        # `None` is a valid key, e.g. for the terminators of an
+        # `ExtendedPathIndex`, but `min=None` means no lower bound.
+        return dropwhile(lambda item: item[0] is None, items)
+    return items
+
+
+def keys_after(tree, key=MISSING):
+    """Return `(key, None)` pairs of the sorted keys of a BTree or TreeSet
+    greater than key.
+
+    Allows iterating the keys of sets via `iter_chunked`.
+    """
+    keys = tree.keys(
+        min=None if key is MISSING else key,
+        excludemin=key is not MISSING)
+    if key is None:
+        keys = dropwhile(lambda each: each is None, keys)
+    return ((each, None) for each in keys)
+
+
+def iter_chunked(items_after, chunk_size, release=None, after=MISSING):
+    """Iterate key-sorted `(key, value)` pairs in chunks of chunk_size items.
+
+    `items_after` is called with the last key of the previous chunk, or with
+    `after` for the first chunk, and must return the key-sorted items with
+    greater keys, e.g. via `items_after`. Iteration of a new chunk always
+    starts from scratch.
+
+    After each chunk `release` is called. This allows discarding all state
+    loaded for the previous chunk, e.g. by ghosting the BTree buckets.
+    """
+    last_key = after
+    while True:
+        count = 0
+        for item in items_after(last_key):
+            yield item
+            last_key = item[0]
+            count += 1
+            if count == chunk_size:
+                break
+        else:
+            return
+
+        if release:
+            release()
+
+
 def find_keys_pointing_to_rid(dictish, rid):
     """Return all entries in dictish item pointing to rid.
 
@@ -11,6 +118,49 @@ def find_keys_pointing_to_rid(dictish, rid):
     ]
 
 
+def find_keys_pointing_to_rids(dictish, rids):
+    """Return a dict mapping each rid to the entries in dictish pointing to it.
+
+    Like `find_keys_pointing_to_rid` but finds the keys for many rids in a
+    single pass over dictish. Rids no key points to are omitted.
+
+    """
+    rids = IITreeSet(rids)
+    keys_by_rid = dict()
+    for key, rids_or_rid in dictish.items():
+        for rid in intersect_rids(rids, rids_or_rid):
+            keys_by_rid.setdefault(rid, []).append(key)
+    return keys_by_rid
+
+
+def find_nested_keys_pointing_to_rids(dictish, rids):
+    """Return a dict mapping each rid to the entries in a two-level dictish
+    pointing to it, as tuples of outer and inner key.
+
+    Used for the `_index` of an `ExtendedPathIndex`, which maps components to
+    levels to rids.
+
+    """
+    rids = IITreeSet(rids)
+    keys_by_rid = dict()
+    for key, inner in dictish.items():
+        for rid, inner_keys in find_keys_pointing_to_rids(inner, rids).items():
+            keys_by_rid.setdefault(rid, []).extend(
+                (key, inner_key) for inner_key in inner_keys)
+    return keys_by_rid
+
+
+def intersect_rids(rids, rids_or_rid):
+    """Return the rids of an index value that are also in rids."""
+
+    if isinstance(rids_or_rid, int):
+        return (rids_or_rid,) if rids_or_rid in rids else ()
+    try:
+        return intersection(rids, rids_or_rid)
+    except TypeError:
+        return [rid for rid in rids_or_rid if rid in rids]
+
+
 def contains_or_equals_rid(rid, rids_or_rid):
     """Return whether rids_or_rid contains or equals a rid."""
 
@@ -20,6 +170,15 @@ def contains_or_equals_rid(rid, rids_or_rid):
         return rid == rids_or_rid
 
 
+def iter_rids(rids_or_rid):
+    """Return the rids of an index value, either a single rid or a
+    collection of rids.
+    """
+    if isinstance(rids_or_rid, int):
+        return (rids_or_rid,)
+    return rids_or_rid
+
+
 def is_shorter_path_to_same_file(shorter, longer):
     """Return whether `shorter` is a part of `longer`.
 
@@ -41,3 +200,73 @@ def is_shorter_path_to_same_file(shorter, longer):
         if shorter_path_segments and shorter_path_segments[0] == segment:
             shorter_path_segments.pop(0)
     return len(shorter_path_segments) == 0
+
+
+def find_key_boundaries(tree, count):
+    """Return up to `count - 1` keys splitting tree into ranges of similar size.
+
+    Uses the separator keys stored in the inner nodes of the BTree instead
+    of iterating over its items. Only the topmost levels of the BTree are
+    loaded, until enough separator keys are found.
+    """
+    if count < 2:
+        return []
+
+    separators = []
+    nodes = [tree]
+    while nodes and len(separators) < count:
+        children = []
+        for node in nodes:
+            state = node.__getstate__()
+            # empty BTrees have no state and BTrees with a single bucket
+            # store that bucket inline, they don't have separator keys.
+            if not state or len(state) < 2:
+                continue
+            items = state[0]
+            separators.extend(items[1::2])
+            children.extend(
+                child for child in items[0::2]
+                if isinstance(child, type(tree)))
+        nodes = children
+
+    separators.sort()
+    boundaries = []
+    for position in range(1, count):
+        index = position * len(separators) // count
+        if index < len(separators):
+            key = separators[index]
+            if not boundaries or boundaries[-1] != key:
+                boundaries.append(key)
+    return boundaries
+
+
+def split_into_ranges(boundaries):
+    """Return `(after, until)` key ranges delimited by boundaries.
+
+    The first range starts at the smallest key, the last range ends at the
+    largest key. See `items_after` for how ranges are iterated.
+    """
+    lower = [MISSING] + list(boundaries)
+    upper = list(boundaries) + [MISSING]
+    return list(zip(lower, upper))
+
+
+def get_tree_depth(tree):
+    """Return the number of levels of a BTree, including the buckets.
+
+    Only the leftmost inner nodes are loaded. An empty BTree has no levels, a
+    BTree storing its single bucket inline has one level.
+    """
+    depth = 0
+    node = tree
+    while isinstance(node, type(tree)):
+        state = node.__getstate__()
+        if not state:
+            break
+        depth += 1
+        if len(state) < 2:
+            break
+        node = state[0][0]
+    else:
+        depth += 1  # the leftmost bucket
+    return depth